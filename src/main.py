@@ -53,93 +53,106 @@ if 'Windows' == platform.system():
     # https://www.qt.io/blog/dark-mode-on-windows-11-with-qt-6.5
     os.environ['QT_QPA_PLATFORM'] = 'windows:darkmode=1'
 
-# Give these to all our children
-global worker
-import worker
-global log
-import log
-global svgtools
-import svgtools as svgtools
+# The parallel PDF renderer starts worker processes, which re-enter
+# here when running as a frozen binary.
+import multiprocessing
+multiprocessing.freeze_support()
+
+
+def parse_args():
+    # Standard command line arguments. These are only built when
+    # running as the main program: render worker processes import this
+    # module again when they start, and must not parse the arguments
+    # or load the rest of RCU.
+    from model.docrender import DocRenderPrefs
+    from panes import paneslist
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--version',
+                        help='print version number and exit',
+                        action='store_true')
+    parser.add_argument('--autoconnect',
+                        help='immediately connect to the last-used preset',
+                        action='store_true')
+    parser.add_argument('--dark',
+                        help='force dark theme',
+                        action='store_true')
+    parser.add_argument('--no-check-compat',
+                        help='skip pane compatibility checks (load anyway)',
+                        action='store_true')
+    parser.add_argument('--no-check-reclaim-storage',
+                        help='skip check for deleted documents',
+                        action='store_true')
+    parser.add_argument('--cli',
+                        help='run headless (best used with --autoconnect)',
+                        action='store_true')
+    parser.add_argument('--purge-settings',
+                        help='delete all saved settings from PC (no confirm)',
+                        action='store_true')
+    parser.add_argument('--clear-render-cache',
+                        help='delete cached page renderings from PC (no confirm)',
+                        action='store_true')
+    # parser.add_argument('--purge-data',
+    #                     help='delete all saved data/backups from PC (no confirm)',
+    #                     action='store_true')
+
+    # The DocRenderPrefs have a large amount of CLI arguments. It manages
+    # these itself as to not clog up this file.
+    DocRenderPrefs.add_cli_args_to_parser(parser)
+    # Load CLI arguments for each of the available panes.
+    group = parser.add_mutually_exclusive_group()
+    for pane in paneslist:
+        for arg in pane.cli_args:
+            if arg[1] is True:
+                group.add_argument(arg[0],
+                                    help=arg[3],
+                                    action='store_true')
+            else:
+                group.add_argument(arg[0],
+                                    nargs=arg[1],
+                                    metavar=arg[2],
+                                    help=arg[3])
+    # Rendering RMN to PDF will not load the rest of the program and may be
+    # used alone.
+    group.add_argument('--render-rmn-pdf-b',
+                       nargs=2,
+                       metavar=('in.rmn', 'out.pdf'),
+                       help='render local RMN archive to PDF (bitmap)')
+    group.add_argument('--render-rmn-pdf-v',
+                       nargs=2,
+                       metavar=('in.rmn', 'out.pdf'),
+                       help='render local RMN archive to PDF (vector)')
+    return parser.parse_args()
 
-import model
-from controllers import MainUtilityController
-from panes import paneslist
-from model.docrender import DocRenderPrefs
-
-
-
-from pathlib import Path
-import sys
-from PySide2.QtWidgets import QApplication, QStyleFactory
-from PySide2.QtCore import QCoreApplication, Qt, QThreadPool, QSettings
-from PySide2.QtGui import QFont, QPalette, QColor, QIcon, QPixmap
-
-
-# Handle Ctrl-C
-import signal
-signal.signal(signal.SIGINT, signal.SIG_DFL)
-
-# Standard command line arguments
-import argparse
-parser = argparse.ArgumentParser()
-parser.add_argument('-v', '--version',
-                    help='print version number and exit',
-                    action='store_true')
-parser.add_argument('--autoconnect',
-                    help='immediately connect to the last-used preset',
-                    action='store_true')
-parser.add_argument('--dark',
-                    help='force dark theme',
-                    action='store_true')
-parser.add_argument('--no-check-compat',
-                    help='skip pane compatibility checks (load anyway)',
-                    action='store_true')
-parser.add_argument('--no-check-reclaim-storage',
-                    help='skip check for deleted documents',
-                    action='store_true')
-parser.add_argument('--cli',
-                    help='run headless (best used with --autoconnect)',
-                    action='store_true')
-parser.add_argument('--purge-settings',
-                    help='delete all saved settings from PC (no confirm)',
-                    action='store_true')
-# parser.add_argument('--purge-data',
-#                     help='delete all saved data/backups from PC (no confirm)',
-#                     action='store_true')
-
-# The DocRenderPrefs have a large amount of CLI arguments. It manages
-# these itself as to not clog up this file.
-DocRenderPrefs.add_cli_args_to_parser(parser)
-# Load CLI arguments for each of the available panes.
-group = parser.add_mutually_exclusive_group()
-for pane in paneslist:
-    for arg in pane.cli_args:
-        if arg[1] is True:
-            group.add_argument(arg[0],
-                                help=arg[3],
-                                action='store_true')
-        else:
-            group.add_argument(arg[0],
-                                nargs=arg[1],
-                                metavar=arg[2],
-                                help=arg[3])
-# Rendering RMN to PDF will not load the rest of the program and may be
-# used alone.
-group.add_argument('--render-rmn-pdf-b',
-                   nargs=2,
-                   metavar=('in.rmn', 'out.pdf'),
-                   help='render local RMN archive to PDF (bitmap)')
-group.add_argument('--render-rmn-pdf-v',
-                   nargs=2,
-                   metavar=('in.rmn', 'out.pdf'),
-                   help='render local RMN archive to PDF (vector)')
-
-args = parser.parse_args()
-if args.cli:
-    log.activated = False
 
 # Start main application
 if __name__ == '__main__':
+    # Give these to all our children
+    global worker
+    import worker
+    global log
+    import log
+    global svgtools
+    import svgtools as svgtools
+
+    import model
+    from controllers import MainUtilityController
+    from model.docrender import clear_render_cache
+
+    from pathlib import Path
+    from PySide2.QtWidgets import QApplication, QStyleFactory
+    from PySide2.QtCore import QCoreApplication, Qt, QThreadPool, \
+        QSettings
+    from PySide2.QtGui import QFont, QPalette, QColor, QIcon, QPixmap
+
+    # Handle Ctrl-C
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    args = parse_args()
+    if args.cli:
+        log.activated = False
+
     QCoreApplication.setAttribute(Qt.AA_DisableWindowContextHelpButton)
     QCoreApplication.setAttribute(Qt.AA_ShareOpenGLContexts)
     QCoreApplication.setAttribute(Qt.AA_EnableHighDpiScaling)
@@ -204,6 +217,11 @@ if __name__ == '__main__':
         QSettings().setValue('main/share_path', str(share_dir))
     QCoreApplication.sharePath.mkdir(parents=True, exist_ok=True)
 
+    if args.clear_render_cache:
+        log.info('clearing render cache!')
+        clear_render_cache()
+        sys.exit(0)
+
     app = QApplication(sys.argv)
     palette = QPalette()
 
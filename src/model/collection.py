@@ -39,22 +39,18 @@ class Collection(GenericNotebookType):
         # add up the documents contained within. Have to search inside
         # the model to find children, both collections and documents.
         totalsize = 0
-        for c in self.model.collections:
-            if not abort_func() and self.uuid == c.parent:
+        for c in self.model.get_child_collections(self.uuid):
+            if not abort_func():
                 totalsize += c.estimate_size(abort_func)
-        for d in self.model.documents:
-            if not abort_func() and self.uuid == d.parent:
+        for d in self.model.get_child_documents(self.uuid):
+            if not abort_func():
                 totalsize += d.estimate_size(abort_func)
         return totalsize
         
     def write_metadata_out(self):
         js = json.dumps(self.as_dict(), sort_keys=True, indent=4)
-        cmd = 'cat > "{}/{}.metadata"'.format(type(self).pathpfx,
-                                              self.uuid)
-        out, err, stdin = self.model.run_cmd(cmd, raw_noread=True,
-                                             with_stdin=True)
-        stdin.write(js)
-        stdin.close()
+        path = '{}/{}.metadata'.format(type(self).pathpfx, self.uuid)
+        self.model.transfer.put(js.encode('utf-8'), path)
 
         # TODO
         # The content_dict used to be written out here, but I moved it
@@ -65,23 +61,16 @@ class Collection(GenericNotebookType):
     def write_content_out(self):
         content_js = json.dumps(self._content_dict,
                                 sort_keys=True, indent=4)
-        cmd = 'cat > "{}/{}.content"'.format(type(self).pathpfx,
-                                             self.uuid)
-        out, err, stdin = self.model.run_cmd(cmd, raw_noread=True,
-                                             with_stdin=True)
-        stdin.write(content_js)
-        stdin.close()
+        path = '{}/{}.content'.format(type(self).pathpfx, self.uuid)
+        self.model.transfer.put(content_js.encode('utf-8'), path)
 
     def get_num_child_documents(self):
         # Recursively adds the total of the number of Documents which
         # are a descendant of this node.
         total = 0
-        for c in self.model.collections:
-            if c.parent == self.uuid:
-                total += c.get_num_child_documents()
-        for d in self.model.documents:
-            if d.parent == self.uuid:
-                total += 1
+        for c in self.model.get_child_collections(self.uuid):
+            total += c.get_num_child_documents()
+        total += len(self.model.get_child_documents(self.uuid))
         return total
 
     def save_archive(self, filepath, est_bytes,
@@ -98,13 +87,13 @@ class Collection(GenericNotebookType):
         def emitthrough(bytecount):
             bytes_cb(btransferred + bytecount)
         
-        for c in self.model.collections:
-            if not abort_func() and self.uuid == c.parent:
+        for c in self.model.get_child_collections(self.uuid):
+            if not abort_func():
                 btransferred += c.save_archive(
                     filepath / c.get_sanitized_filepath(),
                     est_bytes, emitthrough, abort_func)
-        for d in self.model.documents:
-            if not abort_func() and self.uuid == d.parent:
+        for d in self.model.get_child_documents(self.uuid):
+            if not abort_func():
                 # No unique names here! Users expect to use this as a
                 # way to dump their files, overwriting the previous
                 # backup.
@@ -125,14 +114,14 @@ class Collection(GenericNotebookType):
             mod = (docs_done / num_docs * 100) + (pct / num_docs)
             prog_cb(mod)
         
-        for c in self.model.collections:
-            if not abort_func() and self.uuid == c.parent:
+        for c in self.model.get_child_collections(self.uuid):
+            if not abort_func():
                 docs_done += c.save_pdf(
                     filepath / c.get_sanitized_filepath(),
                     vector=vector, prog_cb=progshim,
                     abort_func=abort_func)
-        for d in self.model.documents:
-            if not abort_func() and self.uuid == d.parent:
+        for d in self.model.get_child_documents(self.uuid):
+            if not abort_func():
                 # Needs to have unique during batch exports to prevent
                 # clobbering. This is _not_ in document.py, because
                 # users expect to be able to replace existing files in
@@ -163,15 +152,15 @@ class Collection(GenericNotebookType):
             mod = (docs_done / num_docs * 100) + (pct / num_docs)
             prog_cb(mod)
         
-        for c in self.model.collections:
-            if not abort_func() and self.uuid == c.parent:
+        for c in self.model.get_child_collections(self.uuid):
+            if not abort_func():
                 docs_done += c.save_original_file(
                     filepath / c.get_sanitized_filepath(),
                     filetype=filetype,
                     prog_cb=progshim,
                     abort_func=abort_func)
-        for d in self.model.documents:
-            if not abort_func() and self.uuid == d.parent:
+        for d in self.model.get_child_documents(self.uuid):
+            if not abort_func():
                 # Needs to have unique during batch exports to prevent
                 # clobbering. This is _not_ in document.py, because
                 # users expect to be able to replace existing files in
@@ -217,15 +206,15 @@ class Collection(GenericNotebookType):
             mod = (docs_done / num_docs * 100) + (pct / num_docs)
             prog_cb(mod)
         
-        for c in self.model.collections:
-            if not abort_func() and self.uuid == c.parent:
+        for c in self.model.get_child_collections(self.uuid):
+            if not abort_func():
                 docs_done += c.save_rmwebui_file(
                     filepath / c.get_sanitized_filepath(),
                     filetype=filetype,
                     prog_cb=progshim,
                     abort_func=abort_func)
-        for d in self.model.documents:
-            if not abort_func() and self.uuid == d.parent:
+        for d in self.model.get_child_documents(self.uuid):
+            if not abort_func():
                 # Needs to have unique during batch exports to prevent
                 # clobbering. This is _not_ in document.py, because
                 # users expect to be able to replace existing files in
@@ -259,14 +248,14 @@ class Collection(GenericNotebookType):
             mod = (docs_done / num_docs * 100) + (pct / num_docs)
             prog_cb(mod)
 
-        for c in self.model.collections:
-            if not abort_func() and self.uuid == c.parent:
+        for c in self.model.get_child_collections(self.uuid):
+            if not abort_func():
                 docs_done += c.save_text(
                     filepath / c.get_sanitized_filepath(),
                     prog_cb=progshim,
                     abort_func=abort_func)
-        for d in self.model.documents:
-            if not abort_func() and self.uuid == d.parent:
+        for d in self.model.get_child_documents(self.uuid):
+            if not abort_func():
                 # Needs to have unique during batch exports to prevent
                 # clobbering. This is _not_ in document.py, because
                 # users expect to be able to replace existing files in
@@ -302,14 +291,14 @@ class Collection(GenericNotebookType):
             mod = (docs_done / num_docs * 100) + (pct / num_docs)
             prog_cb(mod)
 
-        for c in self.model.collections:
-            if not abort_func() and self.uuid == c.parent:
+        for c in self.model.get_child_collections(self.uuid):
+            if not abort_func():
                 docs_done += c.save_snaphighlights(
                     filepath / c.get_sanitized_filepath(),
                     prog_cb=progshim,
                     abort_func=abort_func)
-        for d in self.model.documents:
-            if not abort_func() and self.uuid == d.parent:
+        for d in self.model.get_child_documents(self.uuid):
+            if not abort_func():
                 # Needs to have unique during batch exports to prevent
                 # clobbering. This is _not_ in document.py, because
                 # users expect to be able to replace existing files in
@@ -24,7 +24,7 @@ import paramiko
 import log
 from pathlib import Path
 import json
-from .transport import Transport
+from .transport import Transport, apply_bulk_profile
 
 class Config:
     def __init__(self):
@@ -74,6 +74,11 @@ class Config:
 
                 client.connect(host, **sshopts)
                 client.get_transport().set_keepalive(10)
+                # Larger channel windows for everything from here on.
+                # The bulk ciphers wait until a large transfer asks for
+                # them (RCU.use_bulk_profile()).
+                apply_bulk_profile(client.get_transport(),
+                                   renegotiate=False)
                 self.connection = client
                 self.cx_error = None
                 return True
@@ -97,6 +102,10 @@ class Config:
                 # timeout.
                 t = Transport(('10.11.99.1', 22))
                 t.set_keepalive(10)
+                # The recovery OS is only used for backups and
+                # restores, so it negotiates for bulk transfer from the
+                # start.
+                apply_bulk_profile(t)
                 t.connect()
                 t.auth_none('root')
                 client._transport = t
@@ -46,10 +46,24 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import log
 from PySide2.QtCore import QByteArray, QBuffer, QIODevice
-from PySide2.QtGui import QImage, QMatrix
+from PySide2.QtGui import QImage, QTransform
+from collections import namedtuple
 import math
 import gc
-import ctypes
+
+# One unrotated capture of the display. data is laid out in rows of
+# bytes_per_line, with pixel_bytes per pixel, in pixformat.
+Frame = namedtuple('Frame', ['data', 'width', 'height', 'bytes_per_line',
+                             'pixel_bytes', 'pixformat'])
+
+def image_to_png_data(image):
+    # Encodes a screen QImage as an 8-bit grayscale PNG
+    ba = QByteArray()
+    buffer = QBuffer(ba)
+    buffer.open(QIODevice.WriteOnly)
+    image.convertToFormat(QImage.Format_Grayscale8).save(buffer, 'PNG')
+    return ba.data()
+
 
 class DisplayRMGeneric:
     @classmethod
@@ -83,6 +97,8 @@ class ProtoDisplayRM:
     pixformat = QImage.Format_Grayscale16
     portrait_size = (1404, 1872)
     devicefile = '/dev/fb0'
+    # Degrees the framebuffer is turned from portrait
+    rotation_offset = 0
     
     def __init__(self, model):
         # Stores raw image buffer. The exact function that sets this may
@@ -101,8 +117,64 @@ class ProtoDisplayRM:
             log.info('clearing cached framebuffer memory address')
             self.capture_fb_cmd = None
 
+    def get_image(self, rotation=0):
+        # Returns (QImage, (width, height)) of the screen turned to
+        # rotation, or None. The QImage wraps the cached capture rather
+        # than copying it when no turn is needed.
+        # Use cached data whenever possible (refreshing takes seconds).
+        if self.raw_pixel_data:
+            frame = self._make_frame(self.raw_pixel_data)
+        else:
+            frame = self.get_frame()
+        if not frame:
+            return None
+        image = QImage(frame.data, frame.width, frame.height,
+                       frame.bytes_per_line, frame.pixformat)
+        # The QImage doesn't own its pixels, so keep them alive with it
+        image.frame_data = frame.data
+        transform = self.get_transform(rotation)
+        if not transform.isIdentity():
+            image = image.transformed(transform)
+        return (image, (image.width(), image.height()))
+
     def get_png_data(self, rotation=0):
-        return
+        # Like get_image(), but encoded as a PNG (for saving)
+        got = self.get_image(rotation)
+        if not got:
+            return None
+        image, size = got
+        return (image_to_png_data(image), size)
+
+    def get_frame(self):
+        # Grabs a fresh, unrotated Frame of the display, or None. This
+        # also refreshes the pixel cache.
+        if not hasattr(self, '_grab_fb'):
+            log.error('this display cannot be captured')
+            return None
+        raw_fb = self._grab_fb()
+        if not raw_fb:
+            return None
+        return self._make_frame(raw_fb)
+
+    def _make_frame(self, raw_fb):
+        width = type(self).screenwidth
+        height = type(self).screenheight
+        pixel_bytes = 2 if QImage.Format_Grayscale16 == self.pixformat \
+            else 1
+        bytes_per_line = len(raw_fb) // height
+        if bytes_per_line < width * pixel_bytes:
+            log.error('framebuffer was cut short')
+            return None
+        return Frame(raw_fb, width, height, bytes_per_line, pixel_bytes,
+                     self.pixformat)
+
+    def get_transform(self, rotation=0):
+        # Returns the QTransform which turns a Frame to rotation, with
+        # the result at the origin (as QImage.transformed() places it).
+        transform = QTransform().rotate(
+            rotation + type(self).rotation_offset)
+        return QImage.trueMatrix(transform, type(self).screenwidth,
+                                 type(self).screenheight)
 
 
 class DisplayRM1(ProtoDisplayRM):
@@ -116,48 +188,6 @@ class DisplayRM1(ProtoDisplayRM):
         self.raw_pixel_data = out
         return self.raw_pixel_data
 
-    def get_png_data(self, rotation=0):
-        pixformat = self.pixformat
-        realwidth = self.realwidth
-        width = self.screenwidth
-        height = self.screenheight
-
-        # Use cached data whenever possible (refreshing takes seconds).
-        if self.raw_pixel_data:
-            raw_fb = self.raw_pixel_data
-        else:
-            raw_fb = self._grab_fb()
-
-        # The copy() operation crops off the black border. Convert to
-        # Gray8 to reduce saved file size.
-        qimage = QImage(raw_fb, realwidth, height, pixformat).copy(
-            0, 0, width, height).convertToFormat(
-                QImage.Format_Grayscale8)
-
-        center = qimage.rect().center()
-        matrix = QMatrix()
-        if rotation:
-            matrix.translate(center.x(), center.y())
-            matrix.rotate(rotation)
-            if rotation in (90, 270):
-                width, height = (height, width)
-        qimage_rot = qimage.transformed(matrix)
-
-        # Dump as PNG
-        ba = QByteArray()
-        buffer = QBuffer(ba)
-        buffer.open(QIODevice.WriteOnly)
-        qimage_rot.save(buffer, 'PNG')
-        pngdata = ba.data()
-
-        ctypes.c_long.from_address(id(qimage)).value=1
-        ctypes.c_long.from_address(id(qimage_rot)).value=1
-        del qimage
-        del qimage_rot
-        gc.collect()
-        
-        return (pngdata, (width, height))
-
 
 class DisplayRM2_rm2fb(ProtoDisplayRM):
     devicefile = '/dev/shm/swtfb.01'
@@ -165,12 +195,17 @@ class DisplayRM2_rm2fb(ProtoDisplayRM):
 
     @classmethod
     def applies(cls, model):
-        cmd = 'test -e {}; echo $?'.format(cls.devicefile)
-        out, err = model.run_cmd(cmd)
-        if len(err):
-            log.error('problem testing for rm2fb')
-            log.error(err)
-            return
+        # The device probe already ran this test while connecting.
+        probe = getattr(model, 'probe', None) or {}
+        if 'rm2fb' in probe:
+            out = probe['rm2fb']
+        else:
+            cmd = 'test -e {}; echo $?'.format(cls.devicefile)
+            out, err = model.run_cmd(cmd)
+            if len(err):
+                log.error('problem testing for rm2fb')
+                log.error(err)
+                return
         out = out.strip('\n')
         if '0' == out:
             log.info('detected rm2fb')
@@ -185,6 +220,10 @@ class DisplayRM2(ProtoDisplayRM):
     bpp = 1
     pixformat = QImage.Format_Grayscale8
     pagesize = 4096
+    rotation_offset = -90
+    # RM2 only uses the 4 least significant bits (16 shades of gray),
+    # which scale up to 8 bits.
+    gray_table = bytes((b & 0b00001111) * 17 for b in range(256))
 
     def __init__(self, model):
         ProtoDisplayRM.__init__(self, model)
@@ -234,56 +273,14 @@ class DisplayRM2(ProtoDisplayRM):
             
         # Because the grab captured excess data (it was aligned to the
         # page size) we need to trim some off.
-        raw_fb_4bit = out[self.fb_offset:][:self.fb_size]
+        raw_fb_4bit = out[self.fb_offset:self.fb_offset + self.fb_size]
 
         # RM2 only uses the 4 least significant bits (16 shades of gray)
-        raw_fb_8bit = bytearray()
-        for i, b in enumerate(raw_fb_4bit):
-            raw_fb_8bit.append((b & 0b00001111) * 17)
+        raw_fb_8bit = raw_fb_4bit.translate(type(self).gray_table)
 
         self.raw_pixel_data = raw_fb_8bit
         return self.raw_pixel_data
 
-    def get_png_data(self, rotation=0):
-        width = type(self).realwidth
-        height = type(self).screenheight
-        pixformat = type(self).pixformat
-        
-        # Use cached data whenever possible (refreshing takes seconds).
-        if self.raw_pixel_data:
-            raw_fb = self.raw_pixel_data
-        else:
-            raw_fb = self._grab_fb()
-
-        qimage = QImage(raw_fb, width, height, pixformat)
-
-        # Compensate for RM2 portrait being -90deg.
-        rotation -= 90
-        center = qimage.rect().center()
-        matrix = QMatrix()
-        if rotation:
-            matrix.translate(center.x(), center.y())
-            matrix.rotate(rotation)
-        rotated_qi = qimage.transformed(matrix)
-
-        if 0 != rotation % 180:
-            width, height = (height, width)
-
-        # Dump as PNG
-        ba = QByteArray()
-        buffer = QBuffer(ba)
-        buffer.open(QIODevice.WriteOnly)
-        rotated_qi.save(buffer, 'PNG')
-        pngdata = ba.data()
-
-        ctypes.c_long.from_address(id(qimage)).value=1
-        ctypes.c_long.from_address(id(rotated_qi)).value=1
-        del qimage
-        del rotated_qi
-        gc.collect()
-        
-        return (pngdata, (width, height))
-
 
 class DisplayRM2_3_6(DisplayRM2):
     # For whatever reason, the framebuffer format changed in fw.3.6.
@@ -291,6 +288,7 @@ class DisplayRM2_3_6(DisplayRM2):
     # 0xFF are represented as 0b00011110, and need to be shifted
     # right. The image also needs a flip and transpose.
     bpp = 2
+    gray_table = bytes(min(255, (b >> 1) * 17) for b in range(256))
 
     def _grab_fb(self):
         if not self.capture_fb_cmd:
@@ -299,38 +297,24 @@ class DisplayRM2_3_6(DisplayRM2):
         if len(err):
             log.error('problem grabbing framebuffer')
             log.error(str(err))
+            return
 
         # Because the grab captured excess data (it was aligned to the
         # page size) we need to trim some off.
-        raw_fb_4bit = out[self.fb_offset:][:self.fb_size]
-
-        # Read every other byte, ignoring 0x00 in between
-        outbin = bytearray()
-        length = len(raw_fb_4bit)
-        b = 0
-        while b < length:
-            r1 = raw_fb_4bit[b]
-            r1 = (r1 >> 1) * 17  # Convert to 8bit gray
-            outbin.append(r1)
-            b += 2
-        # Reverse to match fw.3.5 framebuffer format
-        outbin.reverse()
+        raw_fb_4bit = out[self.fb_offset:self.fb_offset + self.fb_size]
+
+        # Read every other byte, ignoring 0x00 in between, and convert
+        # to 8bit gray
+        outbin = raw_fb_4bit[::2].translate(type(self).gray_table)
         del raw_fb_4bit
 
-        # Flip image to match fw.3.5 framebuffer format
-        outbin2 = bytearray()
+        # Reverse, then flip each row, to match fw.3.5 framebuffer
+        # format. Together this just puts the rows in reverse order.
         width = type(self).realwidth
-        l = 0
-        while l < len(outbin):
-            start = l
-            end = l + width
-            sect = outbin[start:end]
-            sect.reverse()
-            outbin2 += sect
-            l += width
+        raw_fb_8bit = b''.join(
+            outbin[l:l+width] for l in reversed(
+                range(0, len(outbin), width)))
         del outbin
-        raw_fb_8bit = outbin2
-        del outbin2
 
         self.raw_pixel_data = raw_fb_8bit
         return self.raw_pixel_data
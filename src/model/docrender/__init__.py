@@ -1,3 +1,4 @@
 from .document_renderer import DocRender, DocRenderPrefs
 from .document_renderer_page import DocumentPage
+from .document_renderer_cache import clear_render_cache
 from .pdf_highlight_extractor import PdfHighlightTextExtractor
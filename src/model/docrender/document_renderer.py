@@ -24,6 +24,8 @@ from model import lines
 from model.template import Template
 from model.pens.textures import PencilTextures
 from .document_renderer_page import DocumentPage
+from .document_renderer_pool import DocRenderPool
+from .document_renderer_cache import DocRenderCache
 
 from PySide2.QtGui import QPainter, QImage, QPen, QPixmap, \
     QPageSize, QColor, QBrush, QPainterPath, QTransform
@@ -32,7 +34,6 @@ from PySide2.QtCore import Qt, QByteArray, QIODevice, QBuffer, QSizeF, \
 from PySide2.QtPrintSupport import QPrinter
 
 from pathlib import Path
-import shutil
 import json
 import tempfile
 import os
@@ -130,6 +131,18 @@ class DocRenderPrefs:
                             nargs=1,
                             metavar='2',
                             help='bitmap pixel density modifier')
+        parser.add_argument('--render-workers',
+                            nargs=1,
+                            metavar='1',
+                            help='processes used to render pages (0: one per CPU)')
+        parser.add_argument('--render-cache-size',
+                            nargs=1,
+                            metavar='256',
+                            help='MiB of rendered pages kept between exports (0: off)')
+        parser.add_argument('--width-tolerance',
+                            nargs=1,
+                            metavar='0.5',
+                            help='round pen widths to this many pixels, drawing fewer paths (0: exact)')
     
     def __init__(self):
         self.page_range = None  # page numbers as set, index starts at 0
@@ -139,6 +152,11 @@ class DocRenderPrefs:
         self.grouped_annots = False
         self.layered = False
         self.res_mod = 1  # Bitmap export density
+        self.render_workers = 1  # Processes rendering pages; 0 is auto
+        self.render_cache_size = 256  # MiB, 0 disables the cache
+        # Pen widths are rounded to multiples of this (in pixels), so
+        # more of each stroke is drawn as one path. 0 keeps them exact.
+        self.width_tolerance = 0
 
         self.pencil_textures = PencilTextures()
 
@@ -154,6 +172,9 @@ class DocRenderPrefs:
             self.res_mod = 2
         if bool(int(QSettings().value('pane/notebooks/export_pdf_ocg') or 0)):
             self.layered = True
+        load_width_tolerance = QSettings().value('pane/notebooks/export_pdf_width_tolerance')
+        if load_width_tolerance:
+            self.width_tolerance = float(load_width_tolerance)
         load_black = QSettings().value('pane/notebooks/export_pdf_blackink')
         if load_black:
             self.black = load_black
@@ -230,6 +251,12 @@ class DocRenderPrefs:
             self.grouped_annots = bool(int(args.grouped_annots[0]))
         if args.res_mod:
             self.res_mod = int(args.res_mod[0])
+        if args.render_workers:
+            self.render_workers = int(args.render_workers[0])
+        if args.render_cache_size:
+            self.render_cache_size = int(args.render_cache_size[0])
+        if args.width_tolerance:
+            self.width_tolerance = float(args.width_tolerance[0])
         # Exclusive
         if args.render_rmn_pdf_b or args.export_pdf_b:
             self.vector = False
@@ -247,7 +274,13 @@ class DocRender:
 
         self.cleanup_stuff = set()
 
+        # Set by render_pdf() when pages are rendered by workers.
+        self.render_pool = None
+
     def cleanup(self, incl_extract=False):
+        if self.render_pool:
+            self.render_pool.close()
+            self.render_pool = None
         for thing in self.cleanup_stuff:
             rmdir(thing)
         if incl_extract and self.x_path:
@@ -655,7 +688,8 @@ class DocRender:
     
     def render_pdf(self, filepath, prog_cb=lambda x: (),
                    abort_func=lambda: False):
-        # Each page renders individually. Can be multithreaded later.
+        # Each page renders individually, optionally in a process pool
+        # (see prefs.render_workers).
         filepath = Path(filepath)
         pdfpath = Path(self.x_path / Path(self.doc.uuid + '.pdf'))
 
@@ -691,10 +725,12 @@ class DocRender:
             base_pdf = pikepdf.open(pdfpath, password=self.doc._pdf_password)
         # If we get to this point, then we assume the password is
         # correct, and re-use it during any save procedure.
- 
-        # This var used to be used, but I think I want to take it in
-        # a different direction (it's kind of hacky).
-        pages_drawn_since_last_save = 0
+
+        # The document is only written once, after every page has been
+        # drawn. Pages from the base PDF are read lazily from disk, and
+        # the XObjects added for each page are already compressed, so
+        # memory stays proportional to the marks drawn rather than to
+        # the size of the base PDF.
 
         # This used to use len(base_pdf.pages), but now with 2.12 it is
         # better to use doc._content_dict['pages'] since some PDF pages
@@ -715,6 +751,33 @@ class DocRender:
         tmp_bg_path = Path(tempfile.mkdtemp())
         self.cleanup_stuff.add(tmp_bg_path)
 
+        # With more than one worker, pages are painted by other
+        # processes running ahead of this loop, which then splices
+        # their results into base_pdf in page order.
+        render_pages = [p for p in range(0, numpages)
+                        if p in self.prefs.page_range]
+
+        # Pages which are unchanged since an earlier export are taken
+        # from the render cache, and aren't painted again.
+        # Entries are only loaded when their page is reached.
+        render_cache = DocRenderCache.for_renderer(self)
+        cache_keys = {}
+        cached_pages = set()
+        if render_cache:
+            for p in render_pages:
+                cache_keys[p] = render_cache.key_for_page(p)
+                if render_cache.has(cache_keys[p]):
+                    cached_pages.add(p)
+            log.info('{} of {} pages are cached'.format(
+                len(cached_pages), len(render_pages)))
+            render_pages = [p for p in render_pages
+                            if p not in cached_pages]
+
+        workers = self.get_render_workers(len(render_pages))
+        if 1 < workers:
+            self.render_pool = DocRenderPool(self, workers)
+            self.render_pool.submit(render_pages)
+
         n = -1
         num_pages_inserted = 0
         for page_i in range(0, numpages):
@@ -781,8 +844,33 @@ class DocRender:
                 base_pdf.pages.append(base_pdf.pages[page_i])
 
             pdf_page = base_pdf.pages[-1]
-            r_page = DocumentPage(self, page_i, self.x_path,
-                                  pencil_textures=self.prefs.pencil_textures)
+
+            # Paint the page's marks (portrait; render_marks() will
+            # rotate them for landscape pages). Payloads painted by a
+            # worker or taken from the cache only need placing, so the
+            # page's .rm file isn't parsed again here.
+            payloads = None
+            if page_i in cached_pages:
+                # Falls through to painting the page if the entry has
+                # gone bad or been removed since.
+                payloads = render_cache.get(cache_keys[page_i])
+            if payloads is None and self.render_pool:
+                payloads = self.render_pool.get(page_i)
+                if render_cache:
+                    render_cache.put(cache_keys[page_i], payloads)
+            if payloads is not None:
+                r_page = DocumentPage(
+                    self, page_i, self.x_path,
+                    pencil_textures=self.prefs.pencil_textures,
+                    parse=False)
+                r_page.load_layer_stubs(len(payloads))
+            else:
+                r_page = DocumentPage(
+                    self, page_i, self.x_path,
+                    pencil_textures=self.prefs.pencil_textures)
+                payloads = r_page.render_payloads()
+                if render_cache:
+                    render_cache.put(cache_keys[page_i], payloads)
 
             # Apply new size based on rM's display ratio to the
             # pdf_page. The page receives a compliant CropBox.
@@ -863,8 +951,7 @@ class DocRender:
             r_page.xobj_flip = xobj_flip
             r_page.bg_ocg_title = bg_ocg_title
             # Render the page
-            if -1 != r_page.render_marks():
-                pages_drawn_since_last_save += 1
+            r_page.render_marks(payloads)
             prog_cb((page_i+1) / numpages)
             
             # Debug expand cropbox, mediabox
@@ -873,33 +960,15 @@ class DocRender:
                 pdf_page.MediaBox = [-2000, -2000, 2000, 2000]
                 pdf_page.TrimBox = [-2000, -2000, 2000, 2000]
 
-            if pages_drawn_since_last_save >= 10 \
-               or page_i == max(self.prefs.page_range) - 1:
-                log.error('saving')
-                if self.doc._pdf_password:
-                    base_pdf.save(filepath, encryption=pikepdf.Encryption(
-                        user=self.doc._pdf_password,
-                        owner=self.doc._pdf_password))
-                else:
-                    base_pdf.save(filepath)
-                base_pdf.close()
-                # Don't use pathlib.Path.replace() because it does not
-                # work on Windows across drive letters.
-                shutil.move(filepath, pdfpath)
-                if self.doc._pdf_password:
-                    base_pdf = pikepdf.open(
-                        pdfpath, password=self.doc._pdf_password)
-                else:
-                    base_pdf = pikepdf.open(pdfpath)
-                # self.cleanup()
-                pages_drawn_since_last_save = 0
-
         # Delete the original PDF pages, which are located at the
         # beginning of the document.
         log.info('removing original pages')
         for n in range(0, pdf_orig_num_pages):
             del base_pdf.pages[0]
 
+        if render_cache:
+            render_cache.prune()
+
         # base_pdf.remove_unreferenced_resources()
         if self.doc._pdf_password:
             base_pdf.save(filepath, encryption=pikepdf.Encryption(
@@ -912,6 +981,14 @@ class DocRender:
 
         return True
 
+    def get_render_workers(self, numpages):
+        # Returns how many worker processes should render pages. There
+        # is no sense in starting more workers than there are pages.
+        workers = self.prefs.render_workers
+        if workers < 1:
+            workers = os.cpu_count() or 1
+        return max(1, min(workers, numpages))
+
     def render_text_as_markdown(self, filepath, prog_cb=lambda x: (),
                                 abort_func=lambda: False):
         # This will dump all the text from a fw3.3+ notebook.
@@ -0,0 +1,205 @@
+'''
+document_renderer_cache.py
+Keeps rendered page payloads on disk between exports.
+
+RCU is a management client for the reMarkable Tablet.
+Copyright (C) 2020-24  Davis Remmel
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import log
+from .document_renderer_pool import PREFS_COLORS, PREFS_VALUES, \
+    pack_annot_paths, unpack_annot_paths
+
+from PySide2.QtCore import QCoreApplication
+from PySide2.QtGui import QColor
+
+from pathlib import Path
+import hashlib
+import pickle
+import os
+
+# Each page's payloads (see DocumentPageLayer.render_payloads()) are
+# stored in a file named after a hash of everything that went into
+# them: the page's .rm and highlight data, its template, the display,
+# the document's transform, and the render prefs. Pages that haven't changed since the last
+# export are spliced from here instead of being painted again.
+#
+# Entries are evicted least-recently-used first, by file mtime, once
+# the cache grows past prefs.render_cache_size.
+
+# Bump this whenever the payload format or pen rendering changes, so
+# stale entries are never reused.
+CACHE_VERSION = 1
+
+
+def get_cache_dir():
+    # The share path is set up by main.py. Without it, there is no
+    # cache.
+    if not hasattr(QCoreApplication, 'sharePath'):
+        return None
+    return Path(QCoreApplication.sharePath / 'render-cache')
+
+
+def clear_render_cache():
+    cache_dir = get_cache_dir()
+    if not cache_dir or not cache_dir.exists():
+        return
+    for entry in cache_dir.iterdir():
+        try:
+            entry.unlink()
+        except Exception as e:
+            log.error('could not remove cache entry', entry)
+            log.error(e)
+
+
+class DocRenderCache:
+    def __init__(self, renderer, cache_dir):
+        self.renderer = renderer
+        self.cache_dir = cache_dir
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = renderer.prefs.render_cache_size * 1024 * 1024
+
+        # Everything page-independent goes in once.
+        prefs = renderer.prefs
+        h = hashlib.sha256()
+        h.update('v{}'.format(CACHE_VERSION).encode('utf-8'))
+        h.update(type(renderer.doc.model.display).__name__.encode('utf-8'))
+        for key in PREFS_COLORS:
+            h.update('{}={};'.format(
+                key, QColor(getattr(prefs, key)).rgba()).encode('utf-8'))
+        for key in PREFS_VALUES:
+            h.update('{}={};'.format(
+                key, getattr(prefs, key)).encode('utf-8'))
+        # The document's zoom/pan transform, from its .content, is
+        # applied while painting.
+        tsfm = renderer.doc.get_tsfm()
+        for key in sorted(tsfm):
+            h.update('{}={};'.format(key, tsfm[key]).encode('utf-8'))
+        self.prefs_hash = h
+
+        # Template names, one per page
+        self.templates = []
+        pagedatapath = Path(
+            renderer.x_path / Path(renderer.doc.uuid + '.pagedata'))
+        if pagedatapath.exists():
+            with open(pagedatapath, 'r') as f:
+                self.templates = f.read().splitlines()
+                f.close()
+
+    @classmethod
+    def for_renderer(cls, renderer):
+        # Returns a cache, or None if caching is disabled.
+        if 0 >= renderer.prefs.render_cache_size:
+            return None
+        cache_dir = get_cache_dir()
+        if not cache_dir:
+            return None
+        try:
+            return cls(renderer, cache_dir)
+        except Exception as e:
+            log.error('could not open render cache')
+            log.error(e)
+            return None
+
+    def key_for_page(self, pagenum):
+        doc = self.renderer.doc
+        x_path = self.renderer.x_path
+        page_uuid = doc.get_uuid_for_page(pagenum)
+
+        h = self.prefs_hash.copy()
+        # Stroke group XObject ids carry the page number.
+        h.update('page={};'.format(pagenum).encode('utf-8'))
+        if self.templates:
+            tmpname = self.templates[-1]
+            if pagenum < len(self.templates):
+                tmpname = self.templates[pagenum]
+            h.update('template={};'.format(tmpname).encode('utf-8'))
+        for path in [
+                Path(x_path / Path(doc.uuid) / Path(page_uuid + '.rm')),
+                Path(x_path / Path(doc.uuid + '.highlights') \
+                     / Path(page_uuid + '.json'))]:
+            if path.exists():
+                with open(path, 'rb') as f:
+                    h.update(f.read())
+                    f.close()
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def has(self, key):
+        return Path(self.cache_dir / key).exists()
+
+    def get(self, key):
+        # Returns the cached payloads, or None.
+        path = Path(self.cache_dir / key)
+        if not path.exists():
+            return None
+        try:
+            with open(path, 'rb') as f:
+                page_payloads = pickle.load(f)
+                f.close()
+            # Mark as recently used
+            os.utime(path)
+        except Exception as e:
+            log.error('discarding bad render cache entry', key)
+            log.error(e)
+            path.unlink()
+            return None
+        for layer_payloads in page_payloads:
+            for i, (xobj_id, pen_i, data, packed) in \
+                    enumerate(layer_payloads):
+                layer_payloads[i] = (xobj_id, pen_i, data,
+                                     unpack_annot_paths(packed))
+        return page_payloads
+
+    def put(self, key, page_payloads):
+        packed = []
+        for layer_payloads in page_payloads:
+            packed.append([(xobj_id, pen_i, data,
+                            pack_annot_paths(annot_paths))
+                           for xobj_id, pen_i, data, annot_paths
+                           in layer_payloads])
+        path = Path(self.cache_dir / key)
+        tmppath = Path(self.cache_dir / (key + '.tmp'))
+        try:
+            with open(tmppath, 'wb') as f:
+                pickle.dump(packed, f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.close()
+            os.replace(tmppath, path)
+        except Exception as e:
+            log.error('could not write render cache entry', key)
+            log.error(e)
+
+    def prune(self):
+        # Drop the least-recently-used entries until the cache fits.
+        entries = []
+        total = 0
+        for entry in self.cache_dir.iterdir():
+            try:
+                st = entry.stat()
+            except Exception:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry))
+            total += st.st_size
+        entries.sort(key=lambda e: e[0])
+        for mtime, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                entry.unlink()
+                total -= size
+            except Exception as e:
+                log.error('could not remove cache entry', entry)
+                log.error(e)
@@ -39,6 +39,7 @@ import tempfile
 import pikepdf
 import os
 import io
+import zlib
 
 DEBUG_MARKS = False
 
@@ -61,7 +62,7 @@ class DocumentPage:
     # From local disk!! When making agnostic later, only keep the
     # document and pagenum args.
     def __init__(self, renderer, pagenum, archivepath, \
-                 pencil_textures=None):
+                 pencil_textures=None, parse=True):
         # Page 0 is the first page!
         self.renderer = renderer
         self.doc = renderer.doc
@@ -82,6 +83,16 @@ class DocumentPage:
             archivepath / \
             Path(self.doc.uuid) / Path(self.uuid + '.rm'))
 
+        # The .rm file is read once, and its highlights, layers, and
+        # text all come from the same parse. Without parse, only what
+        # is needed to place payloads rendered elsewhere is loaded
+        # (see load_layer_stubs()).
+        self.rmpage = None
+        if parse and self.rmpath.exists():
+            with open(self.rmpath, 'rb') as f:
+                self.rmpage = lines.Page(f)
+                f.close()
+
         # Try to load page metadata
         self.metadict = None
         self.metafilepath = Path(
@@ -92,8 +103,13 @@ class DocumentPage:
                 self.metadict = json.load(f)
                 f.close()
 
-        # Try to load highlights
         self.highlights = []
+        self.template = None
+        self.layers = []
+        if not parse:
+            return
+
+        # Try to load highlights
         self.highlightspath = Path(
             archivepath / Path(self.doc.uuid + '.highlights') \
             / Path(self.uuid + '.json'))
@@ -107,17 +123,13 @@ class DocumentPage:
             # If we didn't find highlights, this might be a v6 lines
             # file (or just really old, pre-2.7).
             try:
-                with open(self.rmpath, 'rb') as f:
-                    self.highlights = lines.readHighlights6(
-                        f)['highlights']
-                    f.close()
+                self.highlights = self.rmpage.highlights()['highlights']
             except Exception as e:
                 # log.error('error reading v6 lines')
                 # log.error(e)
                 pass
 
         # Try to load template
-        self.template = None
         tmpnamearray = []
         pagedatapath = Path(
             archivepath / Path(self.doc.uuid + '.pagedata'))
@@ -143,7 +155,6 @@ class DocumentPage:
                     self.doc.model).from_archive(tmparchivepath)
 
         # Load layers
-        self.layers = []
         self.load_layers()
 
     def cleanup(self):
@@ -154,35 +165,48 @@ class DocumentPage:
         # Loads layers from the .rm files
         self.layers = []
         
-        if not self.rmpath.exists():
+        if not self.rmpage:
             # no layers, obv
             return
 
         # Load reMy version of page layers
-        pagever = None
-        pagelayers = None
-        with open(self.rmpath, 'rb') as f:
-            pagever, pagelayers = lines.readLines(
-                f, self.renderer.prefs.res_mod)
-            f.close()
+        pagever, pagelayers = self.rmpage.lines(
+            self.renderer.prefs.res_mod)
 
         # Load layer data
         for i in range(0, len(pagelayers)):
             layerstrokes = pagelayers[i]
-
-            try:
-                name = self.metadict['layers'][i]['name']
-            except:
-                name = 'Layer ' + str(i + 1)
-
             layer = DocumentPageLayer(self,
                                       i,
-                                      name=name,
+                                      name=self.get_layer_name(i),
                                       pencil_textures=self.pencil_textures)
             layer.strokes = layerstrokes
             self.layers.append(layer)
 
-    def render_marks(self):
+    def load_layer_stubs(self, count):
+        # Makes count layers without strokes, for placing payloads that
+        # were rendered by a worker process or taken from the render
+        # cache. Nothing more than the layer names is needed for that.
+        self.layers = []
+        for i in range(0, count):
+            layer = DocumentPageLayer(self,
+                                      i,
+                                      name=self.get_layer_name(i),
+                                      pencil_textures=self.pencil_textures)
+            self.layers.append(layer)
+
+    def get_layer_name(self, i):
+        try:
+            return self.metadict['layers'][i]['name']
+        except:
+            return 'Layer ' + str(i + 1)
+
+    def render_payloads(self):
+        # Returns one list of payloads per layer, for render_marks().
+        # These are always drawn portrait.
+        return [layer.render_payloads() for layer in self.layers]
+
+    def render_marks(self, payloads=None):
         # This will render all layers in this page to a specified
         # base_pdf. That PDF must be a pikepdf object.
 
@@ -230,10 +254,14 @@ class DocumentPage:
             self.base_pdf.Root.OCProperties.OCGs.append(b_ocg_prop)
             self.base_pdf.Root.OCProperties.D.Order[-1].append(b_ocg_prop)
 
-        # Render each layer's strokes.
+        # Render each layer's strokes. Payloads, if given, are one list
+        # per layer from render_payloads().
         rendered_anything = False
-        for layer in self.layers:
-            if -1 != layer.render_marks():
+        for i, layer in enumerate(self.layers):
+            layer_payloads = None
+            if payloads is not None:
+                layer_payloads = payloads[i]
+            if -1 != layer.render_marks(layer_payloads):
                 rendered_anything = True
         if not rendered_anything:
             return -1
@@ -242,9 +270,8 @@ class DocumentPage:
         # This is called 'return', not 'render', because it doesn't
         # apply something to an existing object. It just parses/returns.
         text = ''
-        with open(self.rmpath, 'rb') as f:
-            text = lines.readText6(f)
-            f.close()
+        if self.rmpage:
+            text = self.rmpage.text()
         return text
 
     def return_snaphighlights_as_text(self):
@@ -285,6 +312,12 @@ class DocumentPageLayer:
         CalligraphyPen       # Calligraphy
     ]
 
+    # This feature, while it works, has not been added to user-
+    # configurable preferences. It actually inflates filesize,
+    # and I can't notice an improvement in rendering speed in my
+    # PDF clients on GNU/Linux.
+    as_jpg = False
+
     def __init__(self, page, index, name=None, pencil_textures=None):
         self.page = page
         self.name = name
@@ -481,9 +514,13 @@ class DocumentPageLayer:
             stroke_groups[-1].append(stroke)
         return stroke_groups
     
-    def render_marks(self):
-        # Render all marks directly to the pdf_page/base_pdf as
-        # set in DocumentPage.
+    def render_payloads(self):
+        # Rasterize or vectorize each stroke group without touching the
+        # PDF. This is the expensive part of rendering a layer, and is
+        # kept apart from render_marks() so it can run in a worker
+        # process. Returns a list of (xobj_id, pen_i, data, annot_paths)
+        # where data is the output of render_strokes_as_rgb8() or
+        # render_strokes_as_pdf_stream().
 
         # Separate the strokes into stroke groups, where each group is
         # usually of a specific pen type/rendering style. If the old
@@ -507,15 +544,21 @@ class DocumentPageLayer:
         if len(hlt_strokes):
             stroke_groups = [hlt_strokes] + stroke_groups
 
-        # Render each stroke group.
-        rendered_anything = False
+        payloads = []
         for s_group_i, s_group in enumerate(stroke_groups):
-            # Generate a new XObject.
+            # Avoid creating XObject for blank stroke group.
+            if 0 >= len(s_group):
+                continue
             xobj_id = '/ImPage{}Layer{}Sg{}'.format(
                 self.page.num, self.index, s_group_i)
-            ret = self.strokes_as_pdf_xobj(xobj_id, s_group)
-            if -1 != ret and not rendered_anything:
-                rendered_anything = True
+            if not self.page.renderer.prefs.vector:
+                data = self.render_strokes_as_rgb8(s_group)
+                if self.as_jpg:
+                    data = self.rgb8_to_jpg(data)
+            else:
+                data = self.render_strokes_as_pdf_stream(s_group)
+            payloads.append((xobj_id, s_group[0][0], data,
+                             self.annot_paths))
             # Clear the annot_paths. This is a bit of a hack, since
             # there is some shared state here when there shouldn't
             # be. The HighlighterPen will write into annot_paths, but
@@ -523,36 +566,51 @@ class DocumentPageLayer:
             # it here prevents the first synthesized highlights, from
             # Snap Highlights, from leaking into later stroke groups.
             self.annot_paths = []
+        return payloads
 
-        if not rendered_anything:
-            return -1
+    def render_marks(self, payloads=None):
+        # Render all marks directly to the pdf_page/base_pdf as
+        # set in DocumentPage. If payloads are given, they were made
+        # by render_payloads() in a worker process that did not know
+        # the page orientation, so they are rotated here.
+        if payloads is None:
+            payloads = self.render_payloads()
+        elif self.page.is_landscape:
+            payloads = [(xobj_id, pen_i, self.landscape_payload(data),
+                         annot_paths)
+                        for xobj_id, pen_i, data, annot_paths in payloads]
+
+        # Render each stroke group.
+        rendered_anything = False
+        for xobj_id, pen_i, data, annot_paths in payloads:
+            self.annot_paths = annot_paths
+            self.payload_as_pdf_xobj(xobj_id, pen_i, data)
+            rendered_anything = True
+        self.annot_paths = []
 
-    def strokes_as_pdf_xobj(self, xobj_id, strokes):
-        # Avoid creating XObject for blank stroke group.
-        if 0 >= len(strokes):
+        if not rendered_anything:
             return -1
 
+    def payload_as_pdf_xobj(self, xobj_id, pen_i, data):
         pdf_page = self.page.pdf_page
         base_pdf = self.page.base_pdf
 
-        # This feature, while it works, has not been added to user-
-        # configurable preferences. It actually inflates filesize,
-        # and I can't notice an improvement in rendering speed in my
-        # PDF clients on GNU/Linux.
-        as_jpg = False
-        
         # Assemble the XObject.
         if not self.page.renderer.prefs.vector:
-            if not as_jpg:
-                opaque, alpha, size = self.render_strokes_as_rgb8(strokes)
-            else:
-                opaque, alpha, size = self.rgb8_to_jpg((opaque, alpha, size))
+            opaque, alpha, size = data
 
-            # pikepdf will automatically convert the opaque and alpha
-            # streams to /FlateDecode filter.
+            # The opaque and alpha streams are deflated here, rather
+            # than by pikepdf at save time, so the base_pdf held in
+            # memory stays small until the document is written out.
 
             # Opaque
-            xobj = pikepdf.Stream(self.page.base_pdf, opaque)
+            if self.as_jpg:
+                xobj = pikepdf.Stream(self.page.base_pdf, opaque)
+                xobj.Filter = pikepdf.Name('/DCTDecode')
+            else:
+                xobj = pikepdf.Stream(self.page.base_pdf,
+                                      zlib.compress(opaque))
+                xobj.Filter = pikepdf.Name('/FlateDecode')
             xobj.Type = pikepdf.Name('/XObject')
             xobj.Subtype = pikepdf.Name('/Image')
             xobj.ColorSpace = pikepdf.Name('/DeviceRGB')
@@ -560,11 +618,9 @@ class DocumentPageLayer:
             xobj.Width, xobj.Height = size
             xobj.Interpolate = False
 
-            if as_jpg:
-                xobj.Filter = pikepdf.Name('/DCTDecode')
-
             # Alpha mask
-            smask = pikepdf.Stream(self.page.base_pdf, alpha)
+            smask = pikepdf.Stream(self.page.base_pdf, zlib.compress(alpha))
+            smask.Filter = pikepdf.Name('/FlateDecode')
             smask.Type = pikepdf.Name('/XObject')
             smask.Subtype = pikepdf.Name('/Image')
             smask.ColorSpace = pikepdf.Name('/DeviceGray')
@@ -573,9 +629,10 @@ class DocumentPageLayer:
             smask.Interpolate = False
             xobj.SMask = smask
         else:
-            stream_s, bbox, size = \
-                self.render_strokes_as_pdf_stream(strokes)
-            xobj = pikepdf.Stream(self.page.base_pdf, stream_s.encode('utf-8'))
+            stream_s, bbox, size = data
+            xobj = pikepdf.Stream(self.page.base_pdf,
+                                  zlib.compress(stream_s.encode('utf-8')))
+            xobj.Filter = pikepdf.Name('/FlateDecode')
             xobj.Type = pikepdf.Name('/XObject')
             xobj.Subtype = pikepdf.Name('/Form')
             xobj.BBox = bbox
@@ -618,7 +675,7 @@ class DocumentPageLayer:
         # pen to synthesizee the graphics state (GS) from.
         # !!!
         if self.page.renderer.prefs.layered:
-            pen_class = self.pen_lookup[strokes[0][0]]
+            pen_class = self.pen_lookup[pen_i]
         else:
             pen_class = HighlighterPen
 
@@ -1000,7 +1057,7 @@ class DocumentPageLayer:
             size = (height, width)
         return (opaque, alpha, size)
 
-    def rgb8_to_jpg(self, ):
+    def rgb8_to_jpg(self, tup):
         # accepts output from render_strokes_as_rgb8, then converts
         # (inefficiently). Returns in same format.
         opaque, alpha, size = tup
@@ -1053,23 +1110,48 @@ class DocumentPageLayer:
         f.close()
         tmp_pdf.unlink()
 
-        # Rotate the stream if landscape bpage
-        # ...
+        # The bbox is copied out of the closed PDF so the result can be
+        # handed between processes.
+        bbox = [float(b) for b in bbox]
         size = (width*res_mod, height*res_mod)
-        if self.page.is_landscape:
-            stream2 = 'q\n'
-            # Rotate 90
-            stream2 += '0 -1 1 0 0 0 cm\n'
-            # Resize
-            ratio = p_width / p_height
-            stream2 += '{} 0 0 {} 0 0 cm\n'.format(ratio, ratio)
-            # Translate
-            stream2 += '1 0 0 1 {} 0 cm\n'.format(-p_width)
-            stream2 += stream + 'Q\n'
-            stream = stream2
-            size = (height*res_mod, width*res_mod)
 
-        # Debug test for sample
+        # Rotate the stream if landscape bpage
+        if self.page.is_landscape:
+            return self.landscape_payload((stream, bbox, size))
 
-        
         return (stream, bbox, size)
+
+    def landscape_payload(self, data):
+        # Rotates the output of render_strokes_as_rgb8() or
+        # render_strokes_as_pdf_stream() onto a landscape base page.
+        # Returns in same format.
+        if not self.page.renderer.prefs.vector:
+            opaque, alpha, size = data
+            width, height = size
+            rotate = QTransform().rotate(90)
+            o = QImage(opaque, width, height, width * 3,
+                       QImage.Format_RGB888).transformed(rotate)
+            a = QImage(alpha, width, height, width,
+                       QImage.Format_Alpha8).transformed(rotate)
+            opaque = bytes(o.bits())
+            alpha = bytes(a.bits())
+            del o
+            del a
+            return (opaque, alpha, (height, width))
+
+        stream, bbox, size = data
+        res = self.page.display.dpi
+        width, height = self.page.display.portrait_size
+        ptperpx = 72 / res
+        p_width = width * ptperpx
+        p_height = height * ptperpx
+        stream2 = 'q\n'
+        # Rotate 90
+        stream2 += '0 -1 1 0 0 0 cm\n'
+        # Resize
+        ratio = p_width / p_height
+        stream2 += '{} 0 0 {} 0 0 cm\n'.format(ratio, ratio)
+        # Translate
+        stream2 += '1 0 0 1 {} 0 cm\n'.format(-p_width)
+        stream2 += stream + 'Q\n'
+        return (stream2, bbox, (size[1], size[0]))
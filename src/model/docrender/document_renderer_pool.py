@@ -0,0 +1,216 @@
+'''
+document_renderer_pool.py
+Renders document pages in a pool of worker processes.
+
+RCU is a management client for the reMarkable Tablet.
+Copyright (C) 2020-24  Davis Remmel
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import log
+from model.pens.textures import PencilTextures
+from .document_renderer_page import DocumentPage
+
+from PySide2.QtGui import QGuiApplication, QColor, QPainterPath
+from PySide2.QtCore import QRectF
+
+from pathlib import Path
+import multiprocessing
+import sys
+
+# Page payloads are rasterized/vectorized by worker processes, then
+# spliced into the pikepdf document by the main process in page order.
+# Workers re-read the extracted archive from disk, so only the finished
+# XObject data crosses the process boundary.
+
+# Colors are passed to workers as ARGB integers, since QColor can't be
+# relied upon to pickle.
+PREFS_COLORS = ['black', 'gray', 'white', 'blue', 'red',
+                'highlight_yellow', 'highlight_green', 'highlight_pink',
+                'highlight_gray']
+PREFS_VALUES = ['vector', 'annotated', 'grouped_annots', 'layered',
+                'res_mod', 'width_tolerance']
+
+
+class WorkerPrefs:
+    # Stands in for DocRenderPrefs in a worker, which must not touch
+    # QSettings or the CLI arguments.
+    def __init__(self, prefs_dict):
+        for key in PREFS_COLORS:
+            setattr(self, key, QColor.fromRgba(prefs_dict[key]))
+        for key in PREFS_VALUES:
+            setattr(self, key, prefs_dict[key])
+        self.pencil_textures = PencilTextures()
+
+
+class WorkerModel:
+    # Stands in for the RCU model. Documents only need the display
+    # geometry to render.
+    def __init__(self, display_class):
+        self.documents = set()
+        self.device_info = {}
+        self.display = display_class(self)
+
+
+class WorkerRenderer:
+    # Stands in for DocRender, giving DocumentPage what it reads.
+    def __init__(self, context):
+        from model.document import Document
+        model = WorkerModel(context['display_class'])
+        self.doc = Document(model)
+        self.doc.uuid = context['uuid']
+        self.doc._content_dict = context['content_dict']
+        self.prefs = WorkerPrefs(context['prefs'])
+        self.x_path = Path(context['x_path'])
+
+
+# Per-process state, set by _init_worker().
+_app = None
+_renderer = None
+
+
+def _init_worker(context):
+    global _app, _renderer
+    # Pens use QBitmap textures, which need a GUI application. Workers
+    # never show a window.
+    if not QGuiApplication.instance():
+        _app = QGuiApplication([sys.argv[0], '-platform', 'offscreen'])
+    _renderer = WorkerRenderer(context)
+
+
+def path_to_elements(path):
+    # QPainterPath doesn't pickle, so send its elements instead.
+    elements = []
+    for i in range(0, path.elementCount()):
+        e = path.elementAt(i)
+        elements.append((int(e.type), e.x, e.y))
+    return elements
+
+
+def path_from_elements(elements):
+    path = QPainterPath()
+    i = 0
+    while i < len(elements):
+        etype, x, y = elements[i]
+        if int(QPainterPath.MoveToElement) == etype:
+            path.moveTo(x, y)
+        elif int(QPainterPath.LineToElement) == etype:
+            path.lineTo(x, y)
+        elif int(QPainterPath.CurveToElement) == etype:
+            # Followed by two CurveToDataElements
+            c2 = elements[i + 1]
+            end = elements[i + 2]
+            path.cubicTo(x, y, c2[1], c2[2], end[1], end[2])
+            i += 2
+        i += 1
+    return path
+
+
+def pack_annot_paths(annot_paths):
+    packed = []
+    for atype, offset_path, text, real_path, rects in annot_paths:
+        packed.append((atype,
+                       path_to_elements(offset_path),
+                       text,
+                       path_to_elements(real_path),
+                       [(r.x(), r.y(), r.width(), r.height())
+                        for r in rects]))
+    return packed
+
+
+def unpack_annot_paths(packed):
+    annot_paths = []
+    for atype, offset_path, text, real_path, rects in packed:
+        annot_paths.append((atype,
+                            path_from_elements(offset_path),
+                            text,
+                            path_from_elements(real_path),
+                            [QRectF(*r) for r in rects]))
+    return annot_paths
+
+
+def _render_page(pagenum):
+    # Runs in a worker. The page is rendered portrait; the main process
+    # rotates it if the base page turns out to be landscape.
+    page = DocumentPage(_renderer, pagenum, _renderer.x_path,
+                        pencil_textures=_renderer.prefs.pencil_textures)
+    page_payloads = []
+    for layer in page.layers:
+        layer_payloads = []
+        for xobj_id, pen_i, data, annot_paths in layer.render_payloads():
+            layer_payloads.append((xobj_id, pen_i, data,
+                                   pack_annot_paths(annot_paths)))
+        page_payloads.append(layer_payloads)
+    return page_payloads
+
+
+class DocRenderPool:
+    def __init__(self, renderer, workers):
+        prefs = renderer.prefs
+        prefs_dict = {}
+        for key in PREFS_COLORS:
+            prefs_dict[key] = QColor(getattr(prefs, key)).rgba()
+        for key in PREFS_VALUES:
+            prefs_dict[key] = getattr(prefs, key)
+        context = {
+            'x_path': str(renderer.x_path),
+            'uuid': renderer.doc.uuid,
+            'content_dict': renderer.doc._content_dict,
+            'display_class': type(renderer.doc.model.display),
+            'prefs': prefs_dict
+        }
+
+        # Never fork: the parent already has Qt running.
+        ctx = multiprocessing.get_context('spawn')
+        self.workers = workers
+        self.pool = ctx.Pool(workers, initializer=_init_worker,
+                             initargs=(context,))
+        self.pending = []
+        self.results = {}
+        log.info('rendering with {} worker processes'.format(workers))
+
+    def submit(self, pagenums):
+        # Queue pages in the order they will be collected. Only a few
+        # are kept in flight, so finished payloads don't pile up in RAM
+        # faster than the main process can splice them.
+        self.pending += list(pagenums)
+        self._fill()
+
+    def _fill(self):
+        while self.pending and len(self.results) < self.workers * 2:
+            pagenum = self.pending.pop(0)
+            self.results[pagenum] = self.pool.apply_async(
+                _render_page, (pagenum,))
+
+    def get(self, pagenum):
+        # Blocks until the page's payloads are ready. Returns one list
+        # per layer, ready for DocumentPage.render_marks().
+        if pagenum not in self.results:
+            if pagenum in self.pending:
+                self.pending.remove(pagenum)
+            self.results[pagenum] = self.pool.apply_async(
+                _render_page, (pagenum,))
+        page_payloads = self.results.pop(pagenum).get()
+        self._fill()
+        for layer_payloads in page_payloads:
+            for i, (xobj_id, pen_i, data, packed) in \
+                    enumerate(layer_payloads):
+                layer_payloads[i] = (xobj_id, pen_i, data,
+                                     unpack_annot_paths(packed))
+        return page_payloads
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
@@ -26,8 +26,10 @@ from pathlib import Path
 import json
 import time
 import os
+import posixpath
 
 import svgtools
+from PySide2.QtCore import QCoreApplication
 from model.template import Template
 from .docrender import DocRender
 from .generic_notebook_type import GenericNotebookType
@@ -47,9 +49,55 @@ def rmdir(path):
         pass
 
 
+def is_safe_mirror_name(name):
+    # Names come from the device, and are used as paths under the
+    # mirror directory. Refuse anything that would land outside it.
+    norm = posixpath.normpath(name)
+    return not posixpath.isabs(norm) \
+        and norm != '..' \
+        and not norm.startswith('../') \
+        and norm == name
+
+
+def prune_mirrors(mirror_root, max_bytes, keep=None):
+    # Removes the least-recently-synced document mirrors under
+    # mirror_root until they fit in max_bytes. A mirror's last use is
+    # the mtime of its manifest, which is rewritten on every sync.
+    if not mirror_root.exists():
+        return
+    mirrors = []
+    total = 0
+    for path in mirror_root.iterdir():
+        if not path.is_dir():
+            continue
+        manifestpath = Path(path / '.manifest.json')
+        try:
+            mtime = manifestpath.stat().st_mtime
+            with open(manifestpath, 'r') as f:
+                size = sum(v[0] for v in json.load(f).values())
+                f.close()
+        except Exception:
+            # Never finished a sync; nothing worth keeping.
+            mtime, size = 0, 0
+        mirrors.append((mtime, size, path))
+        total += size
+    mirrors.sort(key=lambda m: m[0])
+    for mtime, size, path in mirrors:
+        if total <= max_bytes:
+            break
+        if keep and path == keep:
+            continue
+        rmdir(path)
+        total -= size
+
+
 class Document(GenericNotebookType):
     rm_type = 'DocumentType'
 
+    # Local mirrors of downloaded documents (see sync_mirror()), per
+    # tablet, are kept under this size.
+    mirror_max_bytes = 1024 * 1024 * 1024
+
     # Pass the model just so documents can handle their own PDF
     # conversion.
     def __init__(self, model):
@@ -279,43 +327,27 @@ class Document(GenericNotebookType):
         self.version += 1
         
         js = json.dumps(self.as_dict(), sort_keys=True, indent=4)
-        cmd = 'cat > "{}/{}.metadata"'.format(type(self).pathpfx,
-                                              self.uuid)
-        out, err, stdin = self.model.run_cmd(cmd, raw_noread=True,
-                                             with_stdin=True)
-        stdin.write(js)
-        stdin.close()
+        path = '{}/{}.metadata'.format(type(self).pathpfx, self.uuid)
+        self.model.transfer.put(js.encode('utf-8'), path)
 
     def write_content_out(self):
         jsons = json.dumps(self._content_dict, sort_keys=True,
                            indent=4)
-        cmd = 'cat > "{}/{}.content"'.format(type(self).pathpfx,
-                                             self.uuid)
-        out, err, stdin = self.model.run_cmd(cmd, raw_noread=True,
-                                             with_stdin=True)
-        stdin.write(jsons)
-        stdin.close()
+        path = '{}/{}.content'.format(type(self).pathpfx, self.uuid)
+        self.model.transfer.put(jsons.encode('utf-8'), path)
 
     def write_pagedata_out(self):
         pds = '\n'.join(self.pagedata)
-        cmd = 'cat > "{}/{}.pagedata"'.format(type(self).pathpfx,
-                                              self.uuid)
-        out, err, stdin = self.model.run_cmd(cmd, raw_noread=True,
-                                             with_stdin=True)
-        stdin.write(pds)
-        stdin.close()
+        path = '{}/{}.pagedata'.format(type(self).pathpfx, self.uuid)
+        self.model.transfer.put(pds.encode('utf-8'), path)
 
     def write_ddvk_bookmarks_out(self):
         if not self.ddvk_bookmarks:
             return False
         jsons = json.dumps(self.ddvk_bookmarks, sort_keys=True,
                            indent=4)
-        cmd = 'cat > "{}/{}.bookm"'.format(type(self).pathpfx,
-                                           self.uuid)
-        out, err, stdin = self.model.run_cmd(cmd, raw_noread=True,
-                                             with_stdin=True)
-        stdin.write(jsons)
-        stdin.close()
+        path = '{}/{}.bookm'.format(type(self).pathpfx, self.uuid)
+        self.model.transfer.put(jsons.encode('utf-8'), path)
 
     def get_manifest_strings(self):
         # Document Files
@@ -380,25 +412,13 @@ class Document(GenericNotebookType):
         log.info('uploading document', self.uuid)
         r_destfile = '{}/{}.{}'.format(
             type(self).pathpfx, self.uuid, _filetype)
-        cmd = 'cat > "{}"'.format(r_destfile)
-        out, err, stdin = self.model.run_cmd(
-            cmd, raw_noread=True, with_stdin=True)
-        f = open(filepath, 'rb')
-        while True:
-            if abort_func():
-                self.model.run_cmd('killall cat')
-                break
-            chunk = f.read(4096)
-            if chunk:
-                stdin.write(chunk)
-                txbytes += len(chunk)
-                bytes_cb(txbytes)
-            else:
-                break
-        f.close()
-        stdin.close()
+        sent = self.model.transfer.put(
+            filepath, r_destfile, bytes_cb=bytes_cb,
+            abort_func=abort_func)
+        if sent is not False:
+            txbytes = sent
 
-        if abort_func():
+        if sent is False or abort_func():
             self.delete(force=True)
             return txbytes
 
@@ -484,57 +504,38 @@ class Document(GenericNotebookType):
         # Write the primary files out
         log.info('uploading archive', self.uuid)
         txbytes = 0
+        def put_member(m, remotepath):
+            # Streams one archive member to the device, counting it
+            # towards the running total.
+            nonlocal txbytes
+            f = tf.extractfile(m)
+            sent = self.model.transfer.put(
+                f, remotepath,
+                bytes_cb=lambda x: bytes_cb(txbytes + x),
+                abort_func=abort_func)
+            f.close()
+            if sent:
+                txbytes += sent
+
         for m in primfile_members:
             ext = Path(m.name).suffix
-            cmd = 'cat > "{}/{}{}"'.format(
+            put_member(m, '{}/{}{}'.format(
                 type(self).pathpfx,
                 self.uuid,
-                ext)
-            out, err, stdin = self.model.run_cmd(cmd, raw_noread=True,
-                                                 with_stdin=True)
-            f = tf.extractfile(m)
-            while True:
-                if abort_func():
-                    # Force reconnect to terminate tar
-                    self.model.run_cmd('killall cat')
-                    break
-                chunk = f.read(4096)
-                if chunk:
-                    stdin.write(chunk)
-                    txbytes += len(chunk)
-                    bytes_cb(txbytes)
-                else:
-                    break
-            stdin.close()
-            f.close()
+                ext))
 
         # Write .rm files (and associated) out
         cmd = 'mkdir -p "{}/{}"'.format(type(self).pathpfx,
                                         self.uuid)
         self.model.run_cmd(cmd)
         for m in rmfile_members:
+            if abort_func():
+                break
             fname = Path(m.name).name
-            cmd = 'cat > "{}/{}/{}"'.format(
+            put_member(m, '{}/{}/{}'.format(
                 type(self).pathpfx,
                 self.uuid,
-                fname)
-            out, err, stdin = self.model.run_cmd(cmd, raw_noread=True,
-                                                 with_stdin=True)
-            f = tf.extractfile(m)
-            while True:
-                if abort_func():
-                    # Force reconnect to terminate tar
-                    self.model.run_cmd('killall cat')
-                    break
-                chunk = f.read(4096)
-                if chunk:
-                    stdin.write(chunk)
-                    txbytes += len(chunk)
-                    bytes_cb(txbytes)
-                else:
-                    break
-            stdin.close()
-            f.close()
+                fname))
 
         if abort_func():
             tf.close()
@@ -584,25 +585,29 @@ class Document(GenericNotebookType):
         taritemstring = r[1]
         btransferred = 0
 
-        cmd = 'tar cf - -C {} {}'.format(
-            pathpfx, taritemstring)
-        out, err = self.model.run_cmd(cmd, raw_noread=True)
-        with open(filepath, 'wb+') as destfile:
-            while True:
-                if abort_func():
-                    # Force reconnect to terminate tar
-                    # self.model.reconnect()
-                    self.model.run_cmd('killall tar')
-                    break
-                chunk = out.read(4096)
-                if chunk:
-                    destfile.write(chunk)
-                    btransferred += len(chunk)
-                    bytes_cb(btransferred)
-                else:
-                    break
-            destfile.close()
-            # Delete partially-transmitted file
+        # If this document was downloaded before, only fetch the files
+        # which changed since then, and build the archive from the
+        # local mirror. Otherwise, fall back to taking everything.
+        mirror_files = None
+        mirror_path = self.get_mirror_path()
+        if mirror_path:
+            mirror_files = self.sync_mirror(mirror_path,
+                                            bytes_cb=bytes_cb,
+                                            abort_func=abort_func)
+            if abort_func():
+                return 0
+        if mirror_files is not None:
+            with tarfile.open(filepath, 'w') as outtar:
+                for name in sorted(mirror_files):
+                    outtar.add(Path(mirror_path / name), arcname=name)
+                    btransferred += mirror_files[name][0]
+                outtar.close()
+        else:
+            cmd = 'tar cf - -C {} {}'.format(
+                pathpfx, taritemstring)
+            btransferred = self.download_tar(cmd, filepath,
+                                             bytes_cb=bytes_cb,
+                                             abort_func=abort_func)
         if abort_func():
             filepath.unlink()
 
@@ -635,6 +640,170 @@ class Document(GenericNotebookType):
         # size as to not mess up the progress meter?
         return btransferred
 
+    def download_tar(self, cmd, filepath, bytes_cb=lambda x=None: (),
+                     abort_func=lambda x=None: ()):
+        # Runs a tar command on the device, saving its output to
+        # filepath. Returns the bytes transferred. The stream is
+        # compressed on the wire when the link is slow.
+        btransferred = self.model.transfer.pull(
+            cmd, filepath, bytes_cb=bytes_cb, abort_func=abort_func,
+            compress='auto')
+        return btransferred or 0
+
+    def get_mirror_path(self):
+        # Local copy of this document's files, kept between downloads
+        # so unchanged files aren't transferred again.
+        serial = self.model.device_info.get('serial')
+        if not serial or not hasattr(QCoreApplication, 'sharePath'):
+            return None
+        return Path(QCoreApplication.sharePath / 'mirror' / serial \
+                    / self.uuid)
+
+    def delete(self, force=False):
+        super().delete(force=force)
+        if self not in self.model.documents:
+            self.remove_mirror()
+
+    def remove_mirror(self):
+        mirror_path = self.get_mirror_path()
+        if mirror_path and mirror_path.exists():
+            rmdir(mirror_path)
+
+    def list_remote_files(self):
+        # Returns {name: (size, mtime)} for every file in the document,
+        # relative to the xochitl directory, or None on error.
+        pathpfx, taritemstring = self.get_manifest_strings()
+        cmd = '(cd {} && find {} -type f 2>/dev/null | xargs -r stat -c "%s %Y %n")'.format(
+            pathpfx, taritemstring)
+        out, err = self.model.run_cmd(cmd, timeout=60)
+        if len(err):
+            log.error('error listing document files')
+            log.error(err)
+            return None
+        files = {}
+        for line in out.splitlines():
+            size, mtime, name = line.split(' ', 2)
+            if not is_safe_mirror_name(name):
+                log.error('ignoring unsafe file name', name)
+                continue
+            files[name] = (int(size), int(mtime))
+        return files
+
+    def sync_mirror(self, mirror_path, bytes_cb=lambda x=None: (),
+                    abort_func=lambda x=None: ()):
+        # Brings the local mirror up to date with the device, fetching
+        # only new or changed files (by size and mtime). Returns the
+        # remote listing, or None if the mirror could not be used.
+        remote = self.list_remote_files()
+        if remote is None:
+            return None
+
+        manifestpath = Path(mirror_path / '.manifest.json')
+        local = {}
+        if manifestpath.exists():
+            try:
+                with open(manifestpath, 'r') as f:
+                    local = json.load(f)
+                    f.close()
+            except Exception as e:
+                log.error('could not read mirror manifest; refetching')
+                log.error(e)
+                local = {}
+
+        changed = []
+        bunchanged = 0
+        for name, (size, mtime) in remote.items():
+            localfile = Path(mirror_path / name)
+            if local.get(name) == [size, mtime] \
+               and localfile.exists() \
+               and localfile.stat().st_size == size:
+                bunchanged += size
+            else:
+                changed.append(name)
+        bytes_cb(bunchanged)
+
+        # Drop files which were removed from the device.
+        for name in local:
+            if name not in remote and is_safe_mirror_name(name):
+                stale = Path(mirror_path / name)
+                if stale.exists():
+                    stale.unlink()
+
+        mirror_path.mkdir(parents=True, exist_ok=True)
+        if len(changed):
+            log.info('fetching {} of {} files for {}'.format(
+                len(changed), len(remote), self.uuid))
+            th, tmp = tempfile.mkstemp()
+            os.close(th)
+            tmparchive = Path(tmp)
+            pathpfx = self.get_manifest_strings()[0]
+            # The names are sent as a file, since a large document can
+            # have more than fit on one command line.
+            listpath = '/tmp/rcu-mirror-{}'.format(self.uuid)
+            listing = '\n'.join(sorted(changed)).encode('utf-8') + b'\n'
+            if self.model.transfer.put(listing, listpath) is False:
+                log.error('could not send mirror file list')
+                tmparchive.unlink()
+                return None
+            cmd = 'tar cf - -C {} -T {}'.format(pathpfx, listpath)
+            self.download_tar(cmd, tmparchive,
+                              bytes_cb=lambda x: bytes_cb(bunchanged + x),
+                              abort_func=abort_func)
+            self.model.run_cmd('rm -f {}'.format(listpath))
+            if abort_func():
+                tmparchive.unlink()
+                return None
+            try:
+                with tarfile.open(tmparchive, 'r') as tar:
+                    # Only extract the regular files asked for.
+                    wanted = set(changed)
+                    members = []
+                    for member in tar.getmembers():
+                        if member.isdir():
+                            continue
+                        if not member.isfile() \
+                           or posixpath.normpath(member.name) not in wanted:
+                            log.error('skipping unexpected mirror entry',
+                                      member.name)
+                            continue
+                        members.append(member)
+                    if hasattr(tarfile, 'data_filter'):
+                        tar.extractall(path=mirror_path, members=members,
+                                       filter='data')
+                    else:
+                        tar.extractall(path=mirror_path, members=members)
+                    tar.close()
+            except Exception as e:
+                log.error('could not update mirror')
+                log.error(e)
+                return None
+            finally:
+                tmparchive.unlink()
+
+            # Files can change or disappear on the device between the
+            # listing and tar, so record what actually arrived.
+            extracted = {}
+            for member in members:
+                extracted[posixpath.normpath(member.name)] = \
+                    (member.size, int(member.mtime))
+            for name in changed:
+                if name in extracted:
+                    remote[name] = extracted[name]
+                    continue
+                log.info('mirror file went missing', name)
+                del remote[name]
+                stale = Path(mirror_path / name)
+                if stale.exists():
+                    stale.unlink()
+
+        # Only record the new state once the files have arrived.
+        with open(manifestpath, 'w') as f:
+            json.dump({name: list(remote[name]) for name in remote}, f)
+            f.close()
+        prune_mirrors(mirror_path.parent, type(self).mirror_max_bytes,
+                      keep=mirror_path)
+        return remote
+
     def save_rmwebui_file(self, filepath, filetype='pdf',
                           prog_cb=lambda x: (),
                           abort_func=lambda: False):
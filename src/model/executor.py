@@ -0,0 +1,61 @@
+'''
+executor.py
+Runs device commands concurrently over one SSH connection.
+
+RCU is a management client for the reMarkable Tablet.
+Copyright (C) 2020-24  Davis Remmel
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from concurrent.futures import ThreadPoolExecutor, Future
+import threading
+
+
+class CommandExecutor:
+    # Each command gets its own channel on the model's SSH transport,
+    # so several can be in flight at once instead of waiting on each
+    # other's round trips. The number of worker threads caps how many
+    # channels are open at a time, which keeps the tablet's sshd from
+    # refusing sessions.
+    def __init__(self, run_func, max_channels=4):
+        # run_func(cmd, raw, timeout) runs one command synchronously
+        # and returns (out, err).
+        self.run_func = run_func
+        self.pool = ThreadPoolExecutor(max_workers=max_channels)
+        self.local = threading.local()
+
+    def in_worker(self):
+        return getattr(self.local, 'is_worker', False)
+
+    def _run(self, cmd, raw, timeout):
+        self.local.is_worker = True
+        return self.run_func(cmd, raw, timeout)
+
+    def submit(self, cmd, raw=False, timeout=10):
+        # Returns a Future of (out, err).
+        if self.in_worker():
+            # A command issued from within another command's thread
+            # (like during a reconnect) runs right away. Queueing it
+            # behind its own caller could deadlock the pool.
+            future = Future()
+            try:
+                future.set_result(self.run_func(cmd, raw, timeout))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        return self.pool.submit(self._run, cmd, raw, timeout)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
@@ -170,6 +170,7 @@ class GenericNotebookType:
             self.version += 1
             self.write_metadata_out()
             self.model.documents.discard(self)
+            self.model.invalidate_index()
         else:
             # Purge files immediately
             if not self.uuid or not len(self.uuid):
@@ -183,6 +184,7 @@ class GenericNotebookType:
                 log.error(err)
                 return
             self.model.documents.discard(self)
+            self.model.invalidate_index()
 
     def pin(self):
         self.pinned = True
@@ -213,6 +215,7 @@ class GenericNotebookType:
             return False
 
         self.parent = parent_id
+        self.model.invalidate_index()
         self.version += 1
         self.write_metadata_out()
         return True
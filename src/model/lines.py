@@ -44,6 +44,8 @@ import log
 from collections import namedtuple
 import struct
 import json
+import io
+import math
 
 from .rmscene import scene_items as si
 from .rmscene import read_tree, SceneTree, CrdtId
@@ -77,13 +79,6 @@ def readStruct(fmt, source):
     buff = source.read(fmt.size)
     return fmt.unpack(buff)
 
-def readStroke3(source):
-    pen, color, unk1, width, n_segments = readStruct(S_STROKE_V3, source)
-    return (pen, color, unk1, width, 0, n_segments)
-
-def readStroke5(source):
-    return readStruct(S_STROKE_V5, source)
-
 # source is a filedescriptor from which we can .read(N)
 def readLines(source, res_mod):
     try:
@@ -92,28 +87,52 @@ def readLines(source, res_mod):
             raise InvalidFormat("Header is invalid")
         ver = int(ver)
         if ver == 3:
-            readStroke = readStroke3
+            s_stroke = S_STROKE_V3
         elif ver == 5:
-            readStroke = readStroke5
+            s_stroke = S_STROKE_V5
         elif ver == 6:
             return readLines6(source, res_mod)
         else:
             raise UnsupportedVersion("RCU supports notebooks in the version 3, 5, and 6 format only")
-        n_layers, _, _ = readStruct(S_PAGE, source)
+
+        # The rest of the page is decoded from a single buffer. Each
+        # stroke's segments are contiguous, so they are unpacked
+        # together instead of with one read() per point.
+        buff = memoryview(source.read())
+        offset = 0
+        n_layers, _, _ = S_PAGE.unpack_from(buff, offset)
+        offset += S_PAGE.size
         layers = []
         for l in range(n_layers):
-            n_strokes, = readStruct(S_LAYER, source)
+            n_strokes, = S_LAYER.unpack_from(buff, offset)
+            offset += S_LAYER.size
             strokes = []
             for s in range(n_strokes):
-                pen, color, unk1, width, unk2, n_segments = readStroke(source)
+                if ver == 3:
+                    pen, color, unk1, width, n_segments = \
+                        s_stroke.unpack_from(buff, offset)
+                    unk2 = 0
+                else:
+                    pen, color, unk1, width, unk2, n_segments = \
+                        s_stroke.unpack_from(buff, offset)
+                offset += s_stroke.size
                 width *= res_mod
-                segments = []
-                for i in range(n_segments):
-                    x, y, speed, direction, width, pressure = readStruct(S_SEGMENT, source)
-                    x *= res_mod
-                    y *= res_mod
-                    width *= res_mod
-                    segments.append(Segment(x, y, speed, direction, width, pressure))
+                end = offset + n_segments * S_SEGMENT.size
+                if end > len(buff):
+                    raise InvalidFormat("Error while reading page")
+                points = S_SEGMENT.iter_unpack(buff[offset:end])
+                offset = end
+                if 1 == res_mod:
+                    segments = list(map(Segment._make, points))
+                else:
+                    segments = [Segment(x * res_mod, y * res_mod, speed,
+                                        direction, w * res_mod, pressure)
+                                for x, y, speed, direction, w, pressure
+                                in points]
+                # The stroke has always carried the width of its last
+                # segment, when it has one.
+                if segments:
+                    width = segments[-1].width
                 strokes.append(Stroke(pen, color, unk1, width, unk2, segments))
             layers.append(strokes)
 
@@ -122,9 +141,61 @@ def readLines(source, res_mod):
     except struct.error:
         raise InvalidFormat("Error while reading page")
 
+class SegmentArray:
+    # The Segments of a v6 stroke, read straight from the PointArray's
+    # serialized points. Only the 14 (v2) or 24 (v1) bytes per point
+    # from the file are kept; each Segment is made as the pens ask for
+    # it, and dropped once drawn.
+    def __init__(self, points, res_mod):
+        self.data = points.data
+        self.version = points.version
+        self._struct = points._struct
+        self.res_mod = res_mod
+
+    def _segment(self, values):
+        res_mod = self.res_mod
+        if 1 == self.version:
+            x, y, speed, direction, width, pressure = values
+            return Segment((x + (1404/2)) * res_mod,
+                           y * res_mod,
+                           speed * 4,
+                           255 * direction / (math.pi * 2),
+                           int(round(width * 4)) / 4 * res_mod,
+                           pressure * 255 * 0.005)
+        x, y, speed, width, direction, pressure = values
+        return Segment((x + (1404/2)) * res_mod,
+                       y * res_mod,
+                       speed,
+                       direction,
+                       width / 4 * res_mod,
+                       pressure * 0.005) # guessed
+
+    def __len__(self):
+        return len(self.data) // self._struct.size
+
+    def __iter__(self):
+        return map(self._segment, self._struct.iter_unpack(self.data))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError('segment index out of range')
+        return self._segment(
+            self._struct.unpack_from(self.data, i * self._struct.size))
+
+    def __repr__(self):
+        return repr(list(self))
+
 def readLines6(source, res_mod):
     source.seek(0)
     tree = read_tree(source)
+    return _v6_lines(tree, res_mod)
+
+def _v6_lines(tree, res_mod):
     s = _v6_do_group(tree.root)
     layers = []
     for layer_id, strokes in enumerate(s):
@@ -134,21 +205,25 @@ def readLines6(source, res_mod):
             tool = line.tool
             points = line.points
 
+            if isinstance(points, si.PointArray):
+                segments = SegmentArray(points, res_mod)
+            else:
+                segments = []
+                for i, p in enumerate(points):
+                    seg = Segment(x = (p.x + (1404/2)) * res_mod,
+                                  y = p.y * res_mod,
+                                  speed = p.speed,
+                                  direction = p.direction,
+                                  width = p.width / 4 * res_mod,
+                                  pressure = p.pressure * 0.005) # guessed
+                    segments.append(seg)
+
             stroke = Stroke(pen = int(tool),
                             color = color,
                             unk1 = None,
                             width = 30 * res_mod,
                             unk2 = None,
-                            segments = [])
-
-            for i, p in enumerate(line.points):
-                seg = Segment(x = (p.x + (1404/2)) * res_mod,
-                              y = p.y * res_mod,
-                              speed = p.speed,
-                              direction = p.direction,
-                              width = p.width / 4 * res_mod,
-                              pressure = p.pressure * 0.005) # guessed
-                stroke.segments.append(seg)
+                            segments = segments)
 
             layers[layer_id].append(stroke)
     return (6, layers)
@@ -186,6 +261,9 @@ def readHighlights6(source):
     # files.
     source.seek(0)
     tree = read_tree(source)
+    return _v6_highlights(tree)
+
+def _v6_highlights(tree):
     s = _v6_do_snaphighlights(tree.root)
     hlt_dict = {'highlights': s}
     return hlt_dict
@@ -227,6 +305,9 @@ def readText6(source):
     # files.
     source.seek(0)
     tree = read_tree(source)
+    return _v6_text(tree)
+
+def _v6_text(tree):
     testdoc = TextDocument.from_scene_item(tree.root_text)
 
     out_text = ''
@@ -276,3 +357,30 @@ def readText6(source):
             out_text = give_space(out_text)
 
     return out_text
+
+class Page:
+    # A single .rm file, read from disk once. The v6 scene tree is
+    # parsed only the first time it is needed, then shared by the
+    # lines, snap highlights, and text readers.
+    def __init__(self, source):
+        self.data = source.read()
+        self._tree = None
+
+    def is_v6(self):
+        return self.data[:len(HEADER_START) + 1] == HEADER_START + b'6'
+
+    def tree(self):
+        if self._tree is None:
+            self._tree = read_tree(io.BytesIO(self.data))
+        return self._tree
+
+    def lines(self, res_mod):
+        if self.is_v6():
+            return _v6_lines(self.tree(), res_mod)
+        return readLines(io.BytesIO(self.data), res_mod)
+
+    def highlights(self):
+        return _v6_highlights(self.tree())
+
+    def text(self):
+        return _v6_text(self.tree())
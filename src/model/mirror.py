@@ -0,0 +1,184 @@
+'''
+mirror.py
+Continuously captures the display for live mirroring. Each frame is
+compared with the last in tiles, so only the changed parts need to be
+repainted (or recorded).
+
+RCU is a management client for the reMarkable Tablet.
+Copyright (C) 2020-24  Davis Remmel
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import log
+import threading
+import time
+
+
+def diff_tiles(old, new, tile_size=64):
+    # Compares two Frames (see display.py) in square tiles. Returns the
+    # changed area as a list of (x, y, width, height) rects, with
+    # neighbouring changed tiles in a row joined together.
+    width = new.width
+    height = new.height
+    bpl = new.bytes_per_line
+    if old is None or (old.width, old.height, old.bytes_per_line) \
+       != (width, height, bpl) or len(old.data) != len(new.data):
+        return [(0, 0, width, height)]
+    a = old.data
+    b = new.data
+    row_bytes = width * new.pixel_bytes
+    tile_bytes = tile_size * new.pixel_bytes
+    ncols = (width + tile_size - 1) // tile_size
+    rects = []
+    for y0 in range(0, height, tile_size):
+        rows = min(tile_size, height - y0)
+        # Most of the screen doesn't change, so whole bands are
+        # compared first.
+        start = y0 * bpl
+        end = start + rows * bpl
+        if a[start:end] == b[start:end]:
+            continue
+        changed = [False] * ncols
+        for y in range(y0, y0 + rows):
+            r = y * bpl
+            if a[r:r+row_bytes] == b[r:r+row_bytes]:
+                continue
+            for col in range(ncols):
+                if changed[col]:
+                    continue
+                s = r + col * tile_bytes
+                e = min(s + tile_bytes, r + row_bytes)
+                if a[s:e] != b[s:e]:
+                    changed[col] = True
+        col = 0
+        while col < ncols:
+            if not changed[col]:
+                col += 1
+                continue
+            first = col
+            while col < ncols and changed[col]:
+                col += 1
+            x = first * tile_size
+            rects.append((x, y0, min(col * tile_size, width) - x, rows))
+    return rects
+
+
+class ScreenMirror:
+    # Grabs frames from the display at up to fps, in a worker thread
+    # (see run()). The consumer is told when there is something new and
+    # takes it with take(). Only the latest frame is ever held: if the
+    # consumer hasn't taken the last one yet, it is replaced and the
+    # changed areas are merged, so a slow link or a busy UI drops
+    # frames rather than queueing them.
+    default_fps = 2
+    tile_size = 64
+
+    def __init__(self, display, fps=None):
+        self.display = display
+        self.fps = fps or type(self).default_fps
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.running = False
+        # The last frame grabbed, which the next is compared with
+        self.prev = None
+        # Not yet taken by the consumer
+        self.frame = None
+        self.dirty = []
+        self.pending = False
+        self.grabbed = 0
+        self.dropped = 0
+        # Callables given (frame, rects) for every frame which changed,
+        # from the worker thread. These must keep up, or they slow
+        # the mirror down. New sinks are first given the whole of the
+        # next frame, changed or not.
+        self.sinks = []
+        self.new_sinks = []
+
+    def add_sink(self, sink):
+        with self.lock:
+            self.new_sinks.append(sink)
+
+    def remove_sink(self, sink):
+        with self.lock:
+            for sinks in (self.sinks, self.new_sinks):
+                if sink in sinks:
+                    sinks.remove(sink)
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self, frame_cb, progress_callback=None):
+        # Grabs frames until stop(). frame_cb is called (from this
+        # thread) when a new frame is waiting to be taken.
+        self.stop_event.clear()
+        self.running = True
+        self.prev = None
+        log.info('starting screen mirror at {} fps'.format(self.fps))
+        try:
+            while not self.stop_event.is_set():
+                started = time.monotonic()
+                frame = self.display.get_frame()
+                if not frame:
+                    log.error('could not grab frame; stopping mirror')
+                    break
+                self.grabbed += 1
+                rects = diff_tiles(self.prev, frame, type(self).tile_size)
+                self.prev = frame
+                if rects or self.new_sinks:
+                    self._publish(frame, rects, frame_cb)
+                # A slow grab has already used up its interval, so the
+                # next one starts straight away rather than catching up.
+                wait = 1 / self.fps - (time.monotonic() - started)
+                if wait > 0:
+                    self.stop_event.wait(wait)
+        finally:
+            self.running = False
+            log.info('stopped screen mirror: {} frames, {} dropped'.format(
+                self.grabbed, self.dropped))
+
+    def _publish(self, frame, rects, frame_cb):
+        with self.lock:
+            calls = [(sink, rects) for sink in self.sinks if rects]
+            whole = [(0, 0, frame.width, frame.height)]
+            calls += [(sink, whole) for sink in self.new_sinks]
+            self.sinks += self.new_sinks
+            self.new_sinks = []
+            notify = False
+            if rects:
+                if self.pending:
+                    self.dropped += 1
+                self.frame = frame
+                self.dirty += rects
+                notify = not self.pending
+                self.pending = True
+        for sink, sink_rects in calls:
+            try:
+                sink(frame, sink_rects)
+            except Exception as e:
+                log.error('screen mirror sink failed; removing it')
+                log.error(e)
+                self.remove_sink(sink)
+        if notify:
+            frame_cb()
+
+    def take(self):
+        # Returns the newest (frame, rects) and clears them, where rects
+        # covers everything changed since the last take().
+        with self.lock:
+            frame, rects = self.frame, self.dirty
+            self.frame = None
+            self.dirty = []
+            self.pending = False
+        return (frame, rects)
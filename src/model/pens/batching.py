@@ -0,0 +1,68 @@
+'''
+batching.py
+Draws a stroke as a few paths instead of one line per segment.
+
+RCU is a management client for the reMarkable Tablet.
+Copyright (C) 2020-24  Davis Remmel
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from PySide2.QtGui import QPainterPath
+
+
+def width_tolerance(kwargs):
+    # Returns the width tolerance from the render prefs of the layer a
+    # pen was made for (see DocRenderPrefs), or 0.
+    layer = kwargs.get('layer')
+    try:
+        return layer.page.renderer.prefs.width_tolerance or 0
+    except AttributeError:
+        return 0
+
+
+def quantize_width(width, tolerance):
+    # Widths never round down to 0, which Qt would draw as a hairline.
+    if tolerance > 0 and width > 0:
+        return max(1, round(width / tolerance)) * tolerance
+    return width
+
+
+def paint_segment_runs(pen, painter, segments, width_func, tolerance=0):
+    # Paints the line through segments with pen. Each segment starts at
+    # its point with width_func(segment). Neighbouring segments whose
+    # widths round to the same multiple of tolerance become one
+    # QPainterPath, so a stroke costs one pen change and draw call per
+    # width rather than per segment. With a tolerance of 0, only equal
+    # widths are joined.
+    if len(segments) < 2:
+        return
+    path = None
+    run_width = None
+    for i in range(len(segments) - 1):
+        segment = segments[i]
+        width = quantize_width(width_func(segment), tolerance)
+        if width != run_width:
+            if path:
+                pen.setWidthF(run_width)
+                painter.setPen(pen)
+                painter.drawPath(path)
+            path = QPainterPath()
+            path.moveTo(segment.x, segment.y)
+            run_width = width
+        nextsegment = segments[i+1]
+        path.lineTo(nextsegment.x, nextsegment.y)
+    pen.setWidthF(run_width)
+    painter.setPen(pen)
+    painter.drawPath(path)
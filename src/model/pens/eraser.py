@@ -19,8 +19,9 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
-from PySide2.QtCore import Qt, QLineF
+from PySide2.QtCore import Qt
 from PySide2.QtGui import QPen, QPainter
+from .batching import paint_segment_runs, width_tolerance
 
 class EraserPen(QPen):
     # A PDF graphics state to be used during renders.
@@ -29,6 +30,7 @@ class EraserPen(QPen):
     def __init__(self, *args, **kwargs):
         super(type(self), self).__init__(*args, **kwargs)
         self.vector = kwargs.get('vector', False)
+        self.width_tolerance = width_tolerance(kwargs)
         self.setCapStyle(Qt.RoundCap)
         self.setJoinStyle(Qt.RoundJoin)
         self.setStyle(Qt.SolidLine)
@@ -46,19 +48,11 @@ class EraserPen(QPen):
         return
     
     def paint_stroke(self, painter, stroke):
-        for i, segment in enumerate(stroke.segments):
-            if i+1 >= len(stroke.segments):
-                # no next segment, last 'to' point
-                continue
-            
-            nextsegment = stroke.segments[i+1]
-
-            # Set the width
-            self.setWidthF(segment.width)
-
-            oldcomp = painter.compositionMode()
-            painter.setCompositionMode(QPainter.CompositionMode_Source)
-            painter.setPen(self)
-            painter.drawLine(QLineF(segment.x, segment.y,
-                                    nextsegment.x, nextsegment.y))
-            painter.setCompositionMode(oldcomp)
+        # Runs of segments of (nearly) the same width are drawn as one
+        # path; see batching.py.
+        oldcomp = painter.compositionMode()
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        paint_segment_runs(self, painter, stroke.segments,
+                           lambda segment: segment.width,
+                           self.width_tolerance)
+        painter.setCompositionMode(oldcomp)
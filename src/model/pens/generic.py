@@ -19,27 +19,22 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
-from PySide2.QtCore import Qt, QLineF
+from PySide2.QtCore import Qt
 from PySide2.QtGui import QPen
+from .batching import paint_segment_runs, width_tolerance
 
 class GenericPen(QPen):
     def __init__(self, *args, **kwargs):
         super(type(self), self).__init__(*args, **kwargs)
+        self.width_tolerance = width_tolerance(kwargs)
         self.setCapStyle(Qt.RoundCap)
-        self.setJoinStyle(Qt.MiterJoin)
+        # Segments used to be drawn one by one, each with round caps
+        self.setJoinStyle(Qt.RoundJoin)
         self.setStyle(Qt.SolidLine)
     
     def paint_stroke(self, painter, stroke):
-        for i, segment in enumerate(stroke.segments):
-            if i+1 >= len(stroke.segments):
-                # no next segment, last 'to' point
-                continue
-            
-            nextsegment = stroke.segments[i+1]
-
-            # Set the width
-            self.setWidthF(segment.width)
-
-            painter.setPen(self)
-            painter.drawLine(QLineF(segment.x, segment.y,
-                                    nextsegment.x, nextsegment.y))
+        # Runs of segments of (nearly) the same width are drawn as one
+        # path; see batching.py.
+        paint_segment_runs(self, painter, stroke.segments,
+                           lambda segment: segment.width,
+                           self.width_tolerance)
@@ -20,6 +20,9 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
 from .config import Config
+from .executor import CommandExecutor
+from .transfer import FileTransfer
+from .transport import apply_bulk_profile
 import log
 import urllib.request
 
@@ -27,6 +30,7 @@ from PySide2.QtCore import QThreadPool, QSettings, QTimer
 from PySide2.QtGui import QImage
 from worker import Worker
 import select
+import threading
 import base64
 from .template import Template
 from .display import DisplayRMGeneric
@@ -49,6 +53,10 @@ import sys
 class RCU:
     default_name = 'reMarkable'
     xochitlconf_path = '$HOME/.config/remarkable/xochitl.conf'
+    # Most SSH channels to have open at once
+    max_channels = 4
+    # Seconds a command waits for another thread's reconnect
+    reconnect_wait = 30
 
     @classmethod
     def modelnum_to_hwtype(cls, model):
@@ -63,6 +71,18 @@ class RCU:
         self.settings = QSettings()
         self.threadpool = QThreadPool()
 
+        # Commands are multiplexed over the SSH connection; see
+        # run_cmd() and submit_cmd().
+        self.executor = CommandExecutor(
+            lambda cmd, raw, timeout: self._exec_cmd(
+                cmd, raw=raw, timeout=timeout),
+            max_channels=type(self).max_channels)
+        self.reconnect_lock = threading.RLock()
+        self.reconnect_attempts = 0
+
+        # Bulk file data goes over one reused SFTP session.
+        self.transfer = FileTransfer(self)
+
         self.is_in_recovery = False
         self.has_webui = False
 
@@ -82,9 +102,14 @@ class RCU:
 
         self.notebooks_pane = None
         self.last_notebooks_checksum = None
+        # {filename: 'mtime size'} of each .content and .metadata file
+        # as of the last load, for incremental reloads.
+        self.notebooks_listing = {}
+        self.notebooks_listing_serial = None
         self.collections = set()
         self.documents = set()
         self.deleted_items = set()
+        self._index = None  # See get_index()
 
     def is_connected(self):
         return self.config.is_connected()
@@ -144,6 +169,23 @@ class RCU:
 
     def run_cmd(self, cmd, raw=False, raw_noread=False,
                 with_stdin=False, timeout=10):
+        # Runs a command on the device and waits for its output.
+        # Commands that are read to completion go through the executor,
+        # so they share its limit on open channels. Streams (raw_noread)
+        # are handed straight to the caller.
+        if raw_noread:
+            return self._exec_cmd(cmd, raw_noread=True,
+                                  with_stdin=with_stdin, timeout=timeout)
+        return self.submit_cmd(cmd, raw=raw, timeout=timeout).result()
+
+    def submit_cmd(self, cmd, raw=False, timeout=10):
+        # Starts a command on the device without waiting for it, on its
+        # own channel. Returns a Future of the (out, err) that run_cmd()
+        # would have returned.
+        return self.executor.submit(cmd, raw=raw, timeout=timeout)
+
+    def _exec_cmd(self, cmd, raw=False, raw_noread=False,
+                  with_stdin=False, timeout=10):
         # Runs a command on the device
         if self.is_connected():
             try:
@@ -164,26 +206,50 @@ class RCU:
                     return (out, err, stdin)
                 return (out, err)
         else:
-            # Session not active...what do?
-            if self.reconnect():
-                return self.run_cmd(cmd, raw)
+            # Session not active...what do? Only one thread reconnects;
+            # the others wait for it, then run their commands on the
+            # new session. If that reconnect failed, they fail too
+            # rather than each trying again in turn.
+            attempts = self.reconnect_attempts
+            if not self.reconnect_lock.acquire(
+                    timeout=type(self).reconnect_wait):
+                return ([], 'session is no longer active')
+            try:
+                if self.is_connected():
+                    reconnected = True
+                elif attempts != self.reconnect_attempts:
+                    reconnected = False
+                else:
+                    self.reconnect_attempts += 1
+                    reconnected = self.reconnect()
+            finally:
+                self.reconnect_lock.release()
+            if reconnected and self.is_connected():
+                return self._exec_cmd(cmd, raw=raw,
+                                      raw_noread=raw_noread,
+                                      with_stdin=with_stdin,
+                                      timeout=timeout)
             return ([], 'session is no longer active')
 
-    def put_file(self, localfilepath, remotefilepath):
+    def use_bulk_profile(self):
+        # Call before a large transfer. Switches the connection to the
+        # fastest cipher and MAC the tablet supports (see
+        # transport.apply_bulk_profile()), once per connection.
+        if not self.is_connected():
+            return False
+        return apply_bulk_profile(self.config.connection.get_transport())
+
+    def put_file(self, localfilepath, remotefilepath,
+                 bytes_cb=lambda x: ()):
         # Puts a file to the device
-        try:
-            sftp = self.config.connection.open_sftp()
-            sftp.put(localfilepath, remotefilepath)
-        except Exception as e:
-            log.error('sftp put error; ' + e.__str__())
+        return self.transfer.put(localfilepath, remotefilepath,
+                                 bytes_cb=bytes_cb)
 
-    def get_file(self, remotefilepath, localfilepath, callback):
+    def get_file(self, remotefilepath, localfilepath,
+                 bytes_cb=lambda x: ()):
         # Gets a file from the device
-        try:
-            sftp = self.config.connection.open_sftp()
-            sftp.get(remotefilepath, localfilepath, callback)
-        except Exception as e:
-            log.error('sftp get error; ' + e.__str__())
+        return self.transfer.get(remotefilepath, localfilepath,
+                                 bytes_cb=bytes_cb)
 
     def restart_xochitl(self):
         if self.display:
@@ -308,18 +374,60 @@ class RCU:
     def register_device_info_pane(self, do_pane):
         self.device_info_pane = do_pane
         log.info('device_info registered')
+    # Everything load_device_info() needs, gathered by one script in a
+    # single round trip. Each field is printed after a marker line, so
+    # values may span multiple lines.
+    probe_marker = '@@rcu-probe:'
+    probe_script = '''
+m() { echo; echo "@@rcu-probe:$1"; }
+BD=$(grep -v '^#' /etc/fstab | grep '/home' | head -n 1 \
+     | awk '{print $1}' | cut -d'p' -f1)
+m boot_disk; echo "$BD"
+[ ${#BD} -gt 2 ] || BD=/dev/mmcblk1
+[ "$BD" = /dev/mmcblk0 ] && BD=/dev/mmcblk1
+m serial; dd if=${BD}boot1 bs=1 skip=4 count=15 2>/dev/null
+m osver; grep REMARKABLE_RELEASE_VERSION /usr/share/remarkable/update.conf \
+         | head -n 1 | cut -d'=' -f2
+m osname; (source /etc/os-release && echo $NAME) 2>/dev/null
+m cpu; grep Hardware /proc/cpuinfo | cut -d' ' -f2- \
+       | sed 's/ (Device Tree)//g'
+m ram; free | grep Mem | awk '{print $2}'
+m storage; df | grep '/home$' | head -n 1 | awk '{print $2 " " $3}'
+m kernel; uname -a
+m kernel_bootargs; dmesg | grep "Kernel command line" | cut -d: -f2 \
+                   | tail -c +2
+m partition_table; /sbin/fdisk -l 2>/dev/null
+m cloud_user; grep "usertoken" {xochitlconf} 2>/dev/null
+m rcuname; cat "$HOME/.rcu-name" 2>/dev/null
+m rm2fb; test -e /dev/shm/swtfb.01; echo $?
+'''
+
+    def run_device_probe(self):
+        # Returns {field: output} from probe_script, or None.
+        cmd = type(self).probe_script.replace(
+            '{xochitlconf}', type(self).xochitlconf_path)
+        out, err = self.run_cmd(cmd, timeout=30)
+        if not len(out):
+            log.error('device probe failed. ' + str(err))
+            return None
+        probe = {}
+        for section in out.split('\n' + type(self).probe_marker)[1:]:
+            key, _, value = section.partition('\n')
+            # Drop the newline that separates the next marker
+            probe[key] = value[:-1] if value.endswith('\n') else value
+        return probe
+
     def load_device_info(self):
         # Loads device information. This is done here, rather than in
         # the Device Info pane, because this is very useful for other
         # panes to use in decisions.
+        self.probe = self.run_device_probe() or {}
+        probe = self.probe
 
         # Find the eMMC boot disk (needs to be done explicitly for RM2
         # compatibility).
-        out, err = self.run_cmd('''cat /etc/fstab \
-                                       | grep -v '^#' | grep '/home' \
-                                       | head -n 1 | awk '{print $1}' \
-                                       | cut -d'p' -f1''')
-        if len(err):
+        out = probe.get('boot_disk', '')
+        if not len(out):
             log.error('could not find boot disk--using default')
         elif len(out) > 2:
             self.boot_disk = out.strip()
@@ -331,31 +439,25 @@ class RCU:
         log.info('boot disk is {}'.format(self.boot_disk))
 
         # Get serial and model numbers
-        out, err = self.run_cmd('''dd if={}boot1 bs=1 skip=4 \
-                                   count=15'''.format(self.boot_disk))
+        out = probe.get('serial', '')
         if len(out) != 15:
-            log.error('Unable to get serial number. ' + err)
+            log.error('Unable to get serial number.')
             self.device_info['serial'] = None
             self.device_info['model'] = None
         else:
             self.device_info['serial'] = out
             self.device_info['model'] = out[0:5]
 
-        out, err = self.run_cmd(
-            '''cat /usr/share/remarkable/update.conf \
-               | grep REMARKABLE_RELEASE_VERSION \
-               | head -n 1 | cut -d'=' -f2''')
-        out = out.strip('\n')
+        out = probe.get('osver', '').strip('\n')
         if len(out) >= 3 and len(out) <= 11:
             self.device_info['osver'] = out
         else:
             log.info('os version not found--trying /etc/os-release')
-            out, err = self.run_cmd('(source /etc/os-release && echo $NAME)')
-            out = out.strip('\n')
+            out = probe.get('osname', '').strip('\n')
             if len(out) >= 3 and len(out) <= 50:
                 self.device_info['osver'] = out
             else:
-                log.error('Unable to get OS version. ' + err)
+                log.error('Unable to get OS version.')
                 self.device_info['osver'] = None
 
         # Once we know the model and osver, we can set the
@@ -364,64 +466,52 @@ class RCU:
         self.battery = BatteryRMGeneric.from_model(self)
 
         # Continue...
-        out, err = self.run_cmd('''cat /proc/cpuinfo \
-                                   | grep Hardware \
-                                   | cut -d' ' -f2- \
-                                   | sed 's/ (Device Tree)//g' ''')
-        out = out.strip('\n')
+        out = probe.get('cpu', '').strip('\n')
         if len(out) < 5 or len(out) > 100:
-            log.error('Unable to get CPU type. ' + err)
+            log.error('Unable to get CPU type.')
             self.device_info['cpu'] = None
         else:
             self.device_info['cpu'] = out
 
-        out, err = self.run_cmd('''free \
-                                   | grep Mem \
-                                   | awk '{print $2}' ''')
-        out = out.strip('\n')
+        out = probe.get('ram', '').strip('\n')
         if len(out) < 4 or len(out) > 8:
-            log.error('Unable to get RAM. ' + err)
+            log.error('Unable to get RAM.')
             self.device_info['ram'] = None
         else:
             self.device_info['ram'] = int(int(out) / 1000)
 
-        self.load_device_storage()
+        self.parse_device_storage(probe.get('storage', ''))
 
-        out, err = self.run_cmd('uname -a')
-        out = out.strip('\n')
+        out = probe.get('kernel', '').strip('\n')
         if len(out) < 15 or len(out) > 150:
-            log.error('Unable to get kernel id. ' + err)
+            log.error('Unable to get kernel id.')
             self.device_info['kernel'] = None
         else:
             self.device_info['kernel'] = out
 
-        out, err = self.run_cmd(
-            'dmesg | grep "Kernel command line" | cut -d: -f2 \
-            | tail -c +2')
-        out = out.strip('\n')
+        out = probe.get('kernel_bootargs', '').strip('\n')
         if len(out) < 15 or len(out) > 300:
-            log.error('Unable to get kernel bootargs. ' + err)
+            log.error('Unable to get kernel bootargs.')
             self.device_info['kernel_bootargs'] = None
         else:
             self.device_info['kernel_bootargs'] = out
 
-        out, err = self.run_cmd('/sbin/fdisk -l')
+        out = probe.get('partition_table', '')
         if len(out) < 500 or len(out) > 5000:
-            log.error('Unable to get partition table. ' + err)
+            log.error('Unable to get partition table.')
             self.device_info['partition_table'] = None
         else:
             self.device_info['partition_table'] = base64.b64encode(
                 bytes(out, 'utf-8')).decode('utf-8')
 
         # Check if this is a reMarkable Cloud user.
-        out, err = self.run_cmd('grep "usertoken" {}'.format(self.xochitlconf_path))
-        out = out.strip('\n')
+        out = probe.get('cloud_user', '').strip('\n')
         if len(out):
             self.device_info['cloud_user'] = True
         else:
             self.device_info['cloud_user'] = False
 
-        self.load_device_name()
+        self.parse_device_name(probe.get('rcuname', ''))
         
         if hasattr(self, 'device_info_pane'):
             self.device_info_pane.update_view(loadinfo=False)
@@ -429,10 +519,15 @@ class RCU:
     def load_device_storage(self):
         out, err = self.run_cmd('''df | grep '/home$' | head -n 1 \
                                    | awk '{print $2 " " $3}' ''')
+        if len(err):
+            log.error('Unable to get storage use. ' + err)
+        self.parse_device_storage(out)
+
+    def parse_device_storage(self, out):
         out = out.strip('\n')
         storparts = out.split(' ')
         if len(storparts) != 2:
-            log.error('Unable to get storage use. ' + err)
+            log.error('Unable to get storage use.')
             self.device_info['storage_min'] = None
             self.device_info['storage_used'] = None
             self.device_info['storage_pct'] = None
@@ -455,9 +550,14 @@ class RCU:
         if len(err):
             log.info('device does not have a name ({})'.format(
                 err.strip()))
+            out = ''
+        self.parse_device_name(out)
+
+    def parse_device_name(self, out):
+        realname = out.strip('\n').strip()
+        if not len(realname):
             self.device_info['rcuname'] = type(self).default_name
             return
-        realname = out.strip('\n').strip()
         self.device_info['rcuname'] = realname
 
     def set_device_name(self, name):
@@ -633,7 +733,8 @@ class RCU:
         # Determine if there are changed notebooks to load based on the
         # checksum of the directory listing (fast method to prevent
         # excessive data transmission).
-        cmd = '''cd $HOME/.local/share/remarkable/xochitl && ls -lha *.content *.metadata | md5sum | cut -d' ' -f1'''
+        listcmd = '''cd $HOME/.local/share/remarkable/xochitl && stat -c "%Y %s %n" *.content *.metadata'''
+        cmd = listcmd + ''' | md5sum | cut -d' ' -f1'''
         out, err = self.run_cmd(cmd)
         if len(err):
             log.error('problem getting documents list')
@@ -644,19 +745,53 @@ class RCU:
         if self.last_notebooks_checksum == new_checksum and not force:
             #log.info('notebooks are already up-to-date')
             return False
-        self.last_notebooks_checksum = new_checksum
         log.info('loading notebooks')
 
+        # Something changed. Get the per-file listing and compare it
+        # with the last one, so only the items which changed need to be
+        # fetched and parsed again.
+        out, err = self.run_cmd(listcmd, timeout=30)
+        if len(err):
+            log.error('problem getting documents listing')
+            log.error(err)
+            return False
+        listing = {}
+        for line in out.splitlines():
+            mtime, size, name = line.split(' ', 2)
+            listing[name] = mtime + ' ' + size
+
+        old_ids = set(n.split('.')[0] for n in self.notebooks_listing)
+        new_ids = set(n.split('.')[0] for n in listing)
+        changed_ids = set()
+        for name in listing:
+            if self.notebooks_listing.get(name) != listing[name]:
+                changed_ids.add(name.split('.')[0])
+        stale_ids = changed_ids | (old_ids - new_ids)
+
+        # Fetch everything on the first load, or if so much changed
+        # that the file names won't fit on a command line.
+        incremental = not force \
+            and len(self.notebooks_listing) \
+            and self.notebooks_listing_serial == self.device_info['serial'] \
+            and len(changed_ids) <= 500
+
         ## Todo: relocate this into the Notebook() class, like it is
         ## for the templates.
         # Read the notebook metadata
-        cmd = '''find $HOME/.local/share/remarkable/xochitl \
-                      -maxdepth 1 \
-                      -name "*.content" -o -name "*.metadata" \
-                      | sed "s!.*/!!" \
-                      | tar -T /dev/stdin -cf - \
-                      -C $HOME/.local/share/remarkable/xochitl'''
-        out, err = self.run_cmd(cmd, raw=True)
+        if incremental:
+            # If only deletions happened there is nothing to fetch, but
+            # tar needs an explicit (empty) file list.
+            names = [n for n in listing if n.split('.')[0] in changed_ids]
+            cmd = 'tar -cf - -C $HOME/.local/share/remarkable/xochitl {}'.format(
+                ' '.join(sorted(names)) or '-T /dev/null')
+        else:
+            cmd = '''find $HOME/.local/share/remarkable/xochitl \
+                          -maxdepth 1 \
+                          -name "*.content" -o -name "*.metadata" \
+                          | sed "s!.*/!!" \
+                          | tar -T /dev/stdin -cf - \
+                          -C $HOME/.local/share/remarkable/xochitl'''
+        out, err = self.run_cmd(cmd, raw=True, timeout=60)
         if len(err.decode('utf-8')):
             log.error('problem getting metadata/content archive')
             log.error(err)
@@ -674,6 +809,18 @@ class RCU:
         new_collections = set()
         new_documents = set()
         new_deleted_items = set()
+
+        # Items which didn't change are carried over as-is.
+        if incremental:
+            for item in self.collections:
+                if item.uuid not in stale_ids:
+                    new_collections.add(item)
+            for item in self.documents:
+                if item.uuid not in stale_ids:
+                    new_documents.add(item)
+            for item in self.deleted_items:
+                if item.uuid not in stale_ids:
+                    new_deleted_items.add(item)
         
         i = 0
         for uuid in gathered_ids:
@@ -685,6 +832,9 @@ class RCU:
             except Exception as e:
                 log.error('unable to parse content/metadata')
                 log.error(e)
+                # Try this one again next time.
+                for ext in ('.content', '.metadata'):
+                    listing.pop(uuid + ext, None)
                 continue
 
             if 'fileType' not in content:
@@ -716,6 +866,10 @@ class RCU:
         self.collections = new_collections
         self.documents = new_documents
         self.deleted_items = new_deleted_items
+        self.invalidate_index()
+        self.last_notebooks_checksum = new_checksum
+        self.notebooks_listing = listing
+        self.notebooks_listing_serial = self.device_info['serial']
 
         if self.notebooks_pane and trigger_ui:
             self.notebooks_pane.load_items()
@@ -725,32 +879,60 @@ class RCU:
 
         return True
 
+    def invalidate_index(self):
+        # Call after adding or removing items, or changing their parent.
+        self._index = None
+
+    def get_index(self):
+        # Returns lookups over the current collections and documents:
+        # by UUID, and by parent UUID. These are rebuilt on first use
+        # after invalidate_index().
+        if not self._index:
+            index = {
+                'collections': {},
+                'documents': {},
+                'child_collections': {},
+                'child_documents': {}
+            }
+            for collection in self.collections:
+                index['collections'][collection.uuid] = collection
+                index['child_collections'].setdefault(
+                    collection.parent, []).append(collection)
+            for document in self.documents:
+                index['documents'][document.uuid] = document
+                index['child_documents'].setdefault(
+                    document.parent, []).append(document)
+            self._index = index
+        return self._index
+
     def document_exists(self, did):
-        for document in self.documents:
-            if document.uuid == did:
-                return True
-        return False
+        return did in self.get_index()['documents']
 
     def collection_exists(self, cid):
-        for collection in self.collections:
-            if collection.uuid == cid:
-                return True
-        return False
+        return cid in self.get_index()['collections']
 
     def get_collection(self, cid):
         # Returns the existing collection, or returns a new one if it
         # didn't exist.
-        for collection in self.collections:
-            if collection.uuid == cid:
-                return collection
+        collection = self.get_index()['collections'].get(cid)
+        if collection:
+            return collection
         collection = Collection(self)
         return collection
 
     def get_document(self, did):
         # Returns the existing document, or returns a new one if it
         # didn't exist.
-        for document in self.documents:
-            if document.uuid == did:
-                return document
+        document = self.get_index()['documents'].get(did)
+        if document:
+            return document
         return Document(self)
 
+    def get_child_collections(self, cid):
+        # Collections directly inside the collection with UUID cid
+        return self.get_index()['child_collections'].get(cid, [])
+
+    def get_child_documents(self, cid):
+        # Documents directly inside the collection with UUID cid
+        return self.get_index()['child_documents'].get(cid, [])
+
@@ -0,0 +1,186 @@
+'''
+recording.py
+Records the display to an animated PNG. Frames come from a
+ScreenMirror (see mirror.py), and only the changed part of each is
+written.
+
+RCU is a management client for the reMarkable Tablet.
+Copyright (C) 2020-24  Davis Remmel
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from PySide2.QtCore import QRect
+from PySide2.QtGui import QImage
+import log
+import struct
+import threading
+import time
+import zlib
+
+
+def png_chunk(ctype, data):
+    return struct.pack('>I', len(data)) + ctype + data \
+        + struct.pack('>I', zlib.crc32(ctype + data) & 0xffffffff)
+
+
+class ApngRecorder:
+    # Use as a ScreenMirror sink. Each changed frame becomes one APNG
+    # frame covering the bounding box of what changed, drawn over the
+    # last. A frame is only written once the next one arrives, when its
+    # delay is known, so a screen that doesn't change costs nothing
+    # while it sits there. Memory use is one compressed frame, however
+    # long the recording runs.
+    #
+    # The file is finished after every frame written, so it stays a
+    # valid APNG even if RCU quits without calling close().
+    #
+    # speed > 1 plays back faster than real time, for timelapses.
+    compress_level = 9
+
+    def __init__(self, path, display, rotation=0, speed=1):
+        self.path = path
+        self.display = display
+        self.rotation = rotation
+        self.speed = speed or 1
+        self.lock = threading.Lock()
+        self.file = None
+        self.size = None
+        self.transform = None
+        # Shared by fcTL and fdAT chunks
+        self.seq = 0
+        self.frames = 0
+        self.actl_pos = None
+        # Where the next frame goes, over the IEND
+        self.end_pos = None
+        # The frame waiting for its delay: (time, region, data)
+        self.held = None
+        self.closed = False
+
+    def _frame_image(self, frame, rect):
+        # Returns rect of frame as an 8-bit gray QImage, turned to the
+        # recording's orientation.
+        image = QImage(frame.data, frame.width, frame.height,
+                       frame.bytes_per_line, frame.pixformat)
+        image = image.copy(rect).convertToFormat(QImage.Format_Grayscale8)
+        if self.transform.isIdentity():
+            return image
+        return image.transformed(self.transform)
+
+    def _encode(self, image):
+        # Returns the zlib stream of image's scanlines, as PNG wants
+        # them (no filter).
+        width = image.width()
+        bpl = image.bytesPerLine()
+        bits = bytes(image.constBits())[:bpl * image.height()]
+        comp = zlib.compressobj(type(self).compress_level)
+        out = []
+        for y in range(image.height()):
+            out.append(comp.compress(b'\0'))
+            out.append(comp.compress(bits[y*bpl:y*bpl+width]))
+        out.append(comp.flush())
+        return b''.join(out)
+
+    def _start(self, frame):
+        # Opens the file and writes the header; the frame count is
+        # filled in as frames are written.
+        self.transform = self.display.get_transform(self.rotation)
+        rect = self.transform.mapRect(
+            QRect(0, 0, frame.width, frame.height))
+        self.size = (rect.width(), rect.height())
+        self.file = open(self.path, 'wb')
+        self.file.write(b'\x89PNG\r\n\x1a\n')
+        self.file.write(png_chunk(b'IHDR', struct.pack(
+            '>IIBBBBB', self.size[0], self.size[1], 8, 0, 0, 0, 0)))
+        self.actl_pos = self.file.tell()
+        self.file.write(png_chunk(b'acTL', struct.pack('>II', 0, 0)))
+        self.end_pos = self.file.tell()
+
+    def _delay(self, seconds):
+        # Returns the (numerator, denominator) of a frame delay, as
+        # fine as the 16 bit fields allow.
+        seconds = max(0, seconds / self.speed)
+        for den in (1000, 100, 10, 1):
+            num = round(seconds * den)
+            if num <= 0xffff:
+                return (num, den)
+        return (0xffff, 1)
+
+    def _write_held(self, until):
+        t, region, data = self.held
+        self.held = None
+        x, y, w, h = region
+        num, den = self._delay(until - t)
+        self.file.seek(self.end_pos)
+        self.file.write(png_chunk(b'fcTL', struct.pack(
+            '>IIIIIHHBB', self.seq, w, h, x, y, num, den, 0, 0)))
+        self.seq += 1
+        if 0 == self.frames:
+            # The first frame is also the default image
+            self.file.write(png_chunk(b'IDAT', data))
+        else:
+            self.file.write(png_chunk(
+                b'fdAT', struct.pack('>I', self.seq) + data))
+            self.seq += 1
+        self.frames += 1
+        # Close off the file as it stands
+        self.end_pos = self.file.tell()
+        self.file.write(png_chunk(b'IEND', b''))
+        self.file.seek(self.actl_pos)
+        self.file.write(png_chunk(
+            b'acTL', struct.pack('>II', self.frames, 0)))
+        self.file.flush()
+
+    def add_frame(self, frame, rects):
+        # ScreenMirror sink
+        now = time.monotonic()
+        with self.lock:
+            if self.closed:
+                return
+            if not self.file:
+                self._start(frame)
+                rect = QRect(0, 0, frame.width, frame.height)
+            else:
+                rect = QRect()
+                for x, y, w, h in rects:
+                    rect = rect.united(QRect(x, y, w, h))
+                if rect.isEmpty():
+                    return
+            image = self._frame_image(frame, rect)
+            out = self.transform.mapRect(rect)
+            data = self._encode(image)
+            if self.held:
+                self._write_held(now)
+            self.held = (now, (out.x(), out.y(), out.width(),
+                               out.height()), data)
+
+    def close(self):
+        # Finishes the file. Returns the number of frames written.
+        with self.lock:
+            if self.closed:
+                return self.frames
+            self.closed = True
+            if not self.file:
+                return 0
+            try:
+                if self.held:
+                    self._write_held(time.monotonic())
+            except Exception as e:
+                log.error('could not finish recording', self.path)
+                log.error(e)
+            finally:
+                self.file.close()
+            log.info('recorded {} frames to {}'.format(
+                self.frames, self.path))
+            return self.frames
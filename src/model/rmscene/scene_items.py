@@ -25,6 +25,8 @@ SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import enum
 import logging
+import math
+import struct
 import typing as tp
 from .tagged_block_common import CrdtId, LwwValue
 from .crdt_sequence import CrdtSequence
@@ -138,6 +140,58 @@ class Point:
             return NotImplemented
         return (self.x, self.y, self.speed, self.direction, self.width, self.pressure) == (other.x, other.y, other.speed, other.direction, other.width, other.pressure)
 
+class PointArray:
+    """Points of a Line, kept in their serialized form.
+
+    Points are decoded when accessed, so a Line costs only the 14 (v2)
+    or 24 (v1) bytes per point that were read from the file.
+    """
+    _structs = {1: struct.Struct('<ffffff'), 2: struct.Struct('<ffHHBB')}
+
+    def __init__(self, data , version =2)  :
+        if version not in self._structs:
+            raise ValueError('Unknown version %s' % version)
+        self.data = bytes(data)
+        self.version = version
+        self._struct = self._structs[version]
+        if len(self.data) % self._struct.size != 0:
+            raise ValueError('Point data size mismatch: %d is not multiple of point_size' % len(self.data))
+
+    def _point(self, values )  :
+        if self.version == 1:
+            x, y, speed, direction, width, pressure = values
+            return Point(x, y, speed * 4, 255 * direction / (math.pi * 2), int(round(width * 4)), pressure * 255)
+        x, y, speed, width, direction, pressure = values
+        return Point(x, y, speed, direction, width, pressure)
+
+    def __len__(self)  :
+        return len(self.data) // self._struct.size
+
+    def __iter__(self)  :
+        return map(self._point, self._struct.iter_unpack(self.data))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError('point index out of range')
+        return self._point(self._struct.unpack_from(self.data, i * self._struct.size))
+
+    def __repr__(self):
+        cls = type(self).__name__
+        return f'{cls}({list(self)!r})'
+
+    def __eq__(self, other):
+        if isinstance(other, PointArray):
+            if self.version == other.version:
+                return self.data == other.data
+        elif not isinstance(other, list):
+            return NotImplemented
+        return list(self) == list(other)
+
 class Line(SceneItem):
     __match_args__ = ('color', 'tool', 'points', 'thickness_scale', 'starting_length')
 
@@ -389,8 +389,9 @@ def line_from_stream(stream , version =2)  :
         point_size = point_serialized_size(version)
         if data_length % point_size != 0:
             raise ValueError('Point data size mismatch: %d is not multiple of point_size' % data_length)
-        num_points = data_length // point_size
-        points = [point_from_stream(stream, version=version) for _ in range(num_points)]
+        # Points are decoded lazily by PointArray; see point_from_stream()
+        # for the per-point layout.
+        points = si.PointArray(stream.data.read_bytes(data_length), version=version)
     timestamp = stream.read_id(6)
     return si.Line(color, tool, points, thickness_scale, starting_length)
 
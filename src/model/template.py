@@ -178,44 +178,22 @@ class Template:
         # PNG ##
         datab = svgtools.svg_to_png(
             self.svg,
-            type(self.model.display).portrait_size)
+            type(self.model.display).portrait_size).data()
         uploadpath = '{}/{}.png'.format(
             type(self).userpathpfx,
             self.filename)
-        cmd = 'cat > "{}"'.format(uploadpath)
-        out, err, stdin = self.model.run_cmd(cmd,
-                                             raw_noread=True,
-                                             with_stdin=True)
-        z = len(datab)
-        i = 0
-        chunksize = 4096
-        while i < z:
-            chunk = datab[i:i+chunksize-1]
-            stdin.write(chunk)
-            i += len(chunk)
-        stdin.close()
+        self.model.transfer.put(datab, uploadpath)
         linkpath = '{}/{}.png'.format(type(self).syspathpfx,
                                       self.filename)
         cmd = 'ln -s "{}" "{}"'.format(uploadpath, linkpath)
         self.model.run_cmd(cmd)
 
         # SVG ##
-        datab = self.svg
+        datab = self.svg.data()
         uploadpath = '{}/{}.svg'.format(
             type(self).userpathpfx,
             self.filename)
-        cmd = 'cat > "{}"'.format(uploadpath)
-        out, err, stdin = self.model.run_cmd(cmd,
-                                             raw_noread=True,
-                                             with_stdin=True)
-        z = len(datab)
-        i = 0
-        chunksize = 4096
-        while i < z:
-            chunk = datab[i:i+chunksize-1]
-            stdin.write(chunk)
-            i += len(chunk)
-        stdin.close()
+        self.model.transfer.put(datab, uploadpath)
         linkpath = '{}/{}.svg'.format(type(self).syspathpfx,
                                       self.filename)
         cmd = 'ln -s "{}" "{}"'.format(uploadpath, linkpath)
@@ -228,17 +206,7 @@ class Template:
         uploadpath = '{}/{}.json'.format(
             type(self).userpathpfx,
             self.filename)
-        cmd = 'cat > "{}"'.format(uploadpath)
-        out, err, stdin = self.model.run_cmd(cmd, raw_noread=True,
-                                             with_stdin=True)
-        z = len(datab)
-        i = 0
-        chunksize = 4096
-        while i < z:
-            chunk = datab[i:i+chunksize-1]
-            stdin.write(chunk)
-            i += len(chunk)
-        stdin.close()
+        self.model.transfer.put(datab, uploadpath)
 
         # set_device_templates_dict
         templates_dict = self.get_device_templates_dict()
@@ -270,17 +238,8 @@ class Template:
     def set_device_templates_dict(self, tdict):
         data = json.dumps(tdict, sort_keys=True, indent=4).encode(
             'utf-8')
-        cmd = 'cat > "{}/templates.json"'.format(type(self).syspathpfx)
-        out, err, stdin = self.model.run_cmd(cmd, raw_noread=True,
-                                             with_stdin=True)
-        z = len(data)
-        i = 0
-        chunksize = 4096
-        while i < z:
-            chunk = data[i:i+chunksize-1]
-            stdin.write(chunk)
-            i += len(chunk)
-        stdin.close()
+        self.model.transfer.put(
+            data, '{}/templates.json'.format(type(self).syspathpfx))
     
     def delete_from_device(self):
         # Removes this template from the device
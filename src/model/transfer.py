@@ -0,0 +1,426 @@
+'''
+transfer.py
+Moves bulk data to and from the device over one reused SFTP session.
+
+RCU is a management client for the reMarkable Tablet.
+Copyright (C) 2020-24  Davis Remmel
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import log
+import io
+import os
+import threading
+import time
+import zlib
+
+
+class FileTransfer:
+    # Sending a file through 'cat > file' costs a channel per file and
+    # a round of flow control per small stdin.write(). Instead, one SFTP
+    # session is opened per connection and reused, with pipelined
+    # writes (requests go out without waiting on each ack) and
+    # prefetched reads.
+    #
+    # Not every environment has an SFTP server (like the recovery OS),
+    # so each call falls back to streaming through a command's stdin
+    # or stdout, still in large blocks.
+
+    # Bytes read from the local side per write()
+    default_block_size = 1048576
+    # Uploads at least this big switch the connection to the bulk
+    # transport profile first (see RCU.use_bulk_profile()).
+    bulk_threshold = 8 * 1048576
+
+    # Downloads from commands (tar, dd) can be compressed on the wire;
+    # see pick_compression(). Links measured slower than this many
+    # MB/s get compressed streams.
+    compress_below_mbps = 8
+    # Only transfers at least this big are timed.
+    measure_min_bytes = 1048576
+    # Written to stderr by checked() commands which fail
+    failed_marker = 'rcu: command failed with status'
+
+    @classmethod
+    def checked(cls, cmd):
+        # Wraps cmd so its failure is reported on stderr. Use this for a
+        # command piped into another, whose exit status would hide it.
+        return '{{ {} || echo "{} $?" >&2; }}'.format(
+            cmd, cls.failed_marker)
+
+    @classmethod
+    def inflate(cls, decomp, data, block_size):
+        # Yields what decomp makes of data, at most block_size bytes at
+        # a time. A mostly-zero stream can inflate hundreds of times
+        # over, so it must never be decompressed in one go.
+        while True:
+            piece = decomp.decompress(data, block_size)
+            data = decomp.unconsumed_tail
+            if piece:
+                yield piece
+            # A full piece may have more waiting behind it
+            if not data and len(piece) < block_size:
+                return
+
+    def __init__(self, model, block_size=None):
+        self.model = model
+        self.block_size = block_size or type(self).default_block_size
+        self.lock = threading.Lock()
+        self.sftp = None
+        # The connection the state below belongs to. When the model
+        # reconnects, all of it starts over.
+        self.connection = None
+        self.sftp_unavailable = False
+        self.link_mbps = None
+        self.has_gzip = None
+        self.transport_zlib = False
+
+    def _check_connection(self, connection):
+        # Must hold self.lock
+        if connection is not self.connection:
+            self._close_sftp()
+            self.connection = connection
+            self.sftp_unavailable = False
+            self.link_mbps = None
+            self.has_gzip = None
+            self.transport_zlib = False
+
+    def get_sftp(self):
+        # Returns the shared SFTP client, or None if there is none.
+        connection = self.model.config.connection
+        if not connection:
+            return None
+        with self.lock:
+            self._check_connection(connection)
+            if self.sftp_unavailable:
+                return None
+            if self.sftp and self.sftp.get_channel().closed:
+                self._close_sftp()
+            if not self.sftp:
+                try:
+                    self.sftp = connection.open_sftp()
+                except Exception as e:
+                    log.info('sftp is unavailable; streaming instead')
+                    log.info(e)
+                    self.sftp_unavailable = True
+                    return None
+            return self.sftp
+
+    def _close_sftp(self):
+        if self.sftp:
+            try:
+                self.sftp.close()
+            except Exception:
+                pass
+        self.sftp = None
+
+    def close(self):
+        with self.lock:
+            self._close_sftp()
+            self.connection = None
+
+    def _measure(self, nbytes, started):
+        # Keeps a running estimate of the link speed from uncompressed
+        # transfers.
+        elapsed = time.monotonic() - started
+        if nbytes < type(self).measure_min_bytes or elapsed <= 0:
+            return
+        mbps = nbytes / elapsed / 1000000
+        with self.lock:
+            if self.connection is not self.model.config.connection:
+                return
+            if self.link_mbps is None:
+                self.link_mbps = mbps
+            else:
+                self.link_mbps = 0.7 * self.link_mbps + 0.3 * mbps
+        log.info('link throughput {:.1f} MB/s'.format(self.link_mbps))
+
+    def pick_compression(self):
+        # Returns 'gzip' to compress on the device, 'zlib' if SSH
+        # compresses the whole connection, or None for raw. Compressing
+        # costs the tablet's CPU, which is a bad trade on USB, but on
+        # WiFi the link is usually the bottleneck. Measured throughput
+        # overrides the connection type either way.
+        connection = self.model.config.connection
+        if not connection:
+            return None
+        with self.lock:
+            self._check_connection(connection)
+            mbps = self.link_mbps
+            if self.transport_zlib:
+                return 'zlib'
+        threshold = type(self).compress_below_mbps
+        if mbps is None:
+            if self.model.is_using_usb():
+                return None
+        elif mbps >= threshold:
+            return None
+        if self.has_gzip is None:
+            out, err = self.model.run_cmd(
+                'command -v gzip >/dev/null; echo $?')
+            self.has_gzip = '0' == out.strip()
+        if self.has_gzip:
+            return 'gzip'
+        if self._enable_transport_zlib(connection):
+            return 'zlib'
+        return None
+
+    def _enable_transport_zlib(self, connection):
+        # Turns on SSH compression, which takes a key renegotiation.
+        # This stays on for the rest of the connection.
+        try:
+            transport = connection.get_transport()
+            transport.use_compression(True)
+            transport.renegotiate_keys()
+        except Exception as e:
+            log.error('could not enable ssh compression')
+            log.error(e)
+            return False
+        if 'none' == getattr(transport, 'local_compression', 'none') \
+           and 'none' == getattr(transport, 'remote_compression', 'none'):
+            log.info('device does not support ssh compression')
+            return False
+        with self.lock:
+            self.transport_zlib = True
+        return True
+
+    def _open_source(self, src):
+        # Accepts bytes, an open binary file, or a local path. Returns
+        # (file, should_close).
+        if isinstance(src, (bytes, bytearray)):
+            return (io.BytesIO(src), True)
+        if hasattr(src, 'read'):
+            return (src, False)
+        return (open(src, 'rb'), True)
+
+    def _use_bulk_for(self, src, length):
+        if length is None:
+            if isinstance(src, (bytes, bytearray)):
+                length = len(src)
+            elif not hasattr(src, 'read'):
+                length = os.path.getsize(src)
+        if length and length >= type(self).bulk_threshold:
+            self.model.use_bulk_profile()
+
+    def _sftp_path(self, path):
+        # SFTP does no shell expansion, but its working directory is
+        # already $HOME. Returns None for paths it can't resolve.
+        path = str(path)
+        if path.startswith('$HOME/'):
+            path = path[len('$HOME/'):]
+        if '$' in path or path.startswith('~'):
+            return None
+        return path
+
+    def _chunks(self, f, offset, length, block_size):
+        # Yields blocks of f from offset, up to length bytes.
+        if offset:
+            f.seek(offset)
+        left = length
+        while left is None or left > 0:
+            size = block_size if left is None else min(block_size, left)
+            chunk = f.read(size)
+            if not chunk:
+                break
+            if left is not None:
+                left -= len(chunk)
+            yield chunk
+
+    def put(self, src, remotepath, offset=0, length=None,
+            bytes_cb=lambda x: (), abort_func=lambda x=None: (),
+            hasher=None, block_size=None):
+        # Writes src (see _open_source()) to remotepath on the device,
+        # starting at byte offset of src and sending at most length
+        # bytes. bytes_cb is called with the running total, and each
+        # block is fed to hasher.update() if given. Returns the number
+        # of bytes sent, or False if it failed or was aborted.
+        self._use_bulk_for(src, length)
+        sftp = self.get_sftp()
+        sftp_path = self._sftp_path(remotepath)
+        if not sftp or not sftp_path:
+            return self.pipe(src, 'cat > "{}"'.format(remotepath),
+                             offset=offset, length=length,
+                             bytes_cb=bytes_cb, abort_func=abort_func,
+                             hasher=hasher, block_size=block_size)
+        block_size = block_size or self.block_size
+        f, should_close = self._open_source(src)
+        txbytes = 0
+        started = time.monotonic()
+        try:
+            with sftp.open(sftp_path, 'wb', bufsize=block_size) as rf:
+                rf.set_pipelined(True)
+                for chunk in self._chunks(f, offset, length, block_size):
+                    if abort_func():
+                        return False
+                    rf.write(chunk)
+                    if hasher:
+                        hasher.update(chunk)
+                    txbytes += len(chunk)
+                    bytes_cb(txbytes)
+        except Exception as e:
+            log.error('sftp put error', remotepath)
+            log.error(e)
+            return False
+        finally:
+            if should_close:
+                f.close()
+        self._measure(txbytes, started)
+        return txbytes
+
+    def pipe(self, src, cmd, offset=0, length=None,
+             bytes_cb=lambda x: (), abort_func=lambda x=None: (),
+             hasher=None, block_size=None):
+        # Streams src into the stdin of cmd on the device, like put().
+        # Anything written to stderr counts as a failure.
+        self._use_bulk_for(src, length)
+        block_size = block_size or self.block_size
+        out, err, stdin = self.model.run_cmd(
+            cmd, raw_noread=True, with_stdin=True)
+        if not hasattr(stdin, 'write'):
+            log.error('could not start transfer command', cmd)
+            return False
+        f, should_close = self._open_source(src)
+        txbytes = 0
+        started = time.monotonic()
+        try:
+            for chunk in self._chunks(f, offset, length, block_size):
+                if abort_func():
+                    # Cut the command off from the rest of the data
+                    stdin.channel.close()
+                    return False
+                stdin.write(chunk)
+                if hasher:
+                    hasher.update(chunk)
+                txbytes += len(chunk)
+                bytes_cb(txbytes)
+            stdin.close()
+            err = err.read().decode('utf-8')
+        except Exception as e:
+            log.error('transfer error', cmd)
+            log.error(e)
+            return False
+        finally:
+            if should_close:
+                f.close()
+        if len(err):
+            log.error('transfer error', cmd)
+            log.error(err)
+            return False
+        self._measure(txbytes, started)
+        return txbytes
+
+    def get(self, remotepath, dest, bytes_cb=lambda x: (),
+            abort_func=lambda x=None: (), hasher=None, block_size=None):
+        # Reads remotepath from the device into dest, which is a local
+        # path or an open binary file. Returns the number of bytes
+        # read, or False if it failed or was aborted.
+        sftp = self.get_sftp()
+        sftp_path = self._sftp_path(remotepath)
+        if not sftp or not sftp_path:
+            return self.pull('cat "{}"'.format(remotepath), dest,
+                             bytes_cb=bytes_cb, abort_func=abort_func,
+                             hasher=hasher, block_size=block_size)
+        block_size = block_size or self.block_size
+        should_close = not hasattr(dest, 'write')
+        f = open(dest, 'wb') if should_close else dest
+        rxbytes = 0
+        started = time.monotonic()
+        try:
+            with sftp.open(sftp_path, 'rb', bufsize=block_size) as rf:
+                # Queue up reads for the whole file so they stream back
+                # without a round trip each.
+                rf.prefetch()
+                for chunk in iter(lambda: rf.read(block_size), b''):
+                    if abort_func():
+                        return False
+                    f.write(chunk)
+                    if hasher:
+                        hasher.update(chunk)
+                    rxbytes += len(chunk)
+                    bytes_cb(rxbytes)
+        except Exception as e:
+            log.error('sftp get error', remotepath)
+            log.error(e)
+            return False
+        finally:
+            if should_close:
+                f.close()
+        self._measure(rxbytes, started)
+        return rxbytes
+
+    def pull(self, cmd, dest, bytes_cb=lambda x: (),
+             abort_func=lambda x=None: (), hasher=None, block_size=None,
+             compress=None):
+        # Streams the stdout of cmd on the device into dest, like get().
+        # With compress='auto', the stream may be gzipped on the
+        # device (see pick_compression()). Counts, callbacks and hashes
+        # always cover the uncompressed data. The transfer fails if cmd
+        # exits non-zero or reports a checked() failure; other stderr
+        # output (like dd's statistics) is allowed.
+        block_size = block_size or self.block_size
+        if 'auto' == compress:
+            compress = self.pick_compression()
+        decomp = None
+        if 'gzip' == compress:
+            cmd = '{} | gzip -1'.format(self.checked(cmd))
+            decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        out, err = self.model.run_cmd(cmd, raw_noread=True)
+        if not hasattr(out, 'read'):
+            log.error('could not start transfer command', cmd)
+            return False
+        should_close = not hasattr(dest, 'write')
+        f = open(dest, 'wb') if should_close else dest
+        rxbytes = 0
+        started = time.monotonic()
+        try:
+            for chunk in iter(lambda: out.read(block_size), b''):
+                if abort_func():
+                    out.channel.close()
+                    return False
+                pieces = [chunk]
+                if decomp:
+                    pieces = self.inflate(decomp, chunk, block_size)
+                for piece in pieces:
+                    f.write(piece)
+                    if hasher:
+                        hasher.update(piece)
+                    rxbytes += len(piece)
+                    bytes_cb(rxbytes)
+            if decomp:
+                chunk = decomp.flush()
+                if not decomp.eof:
+                    log.error('compressed stream was cut short', cmd)
+                    return False
+                f.write(chunk)
+                if hasher:
+                    hasher.update(chunk)
+                rxbytes += len(chunk)
+                bytes_cb(rxbytes)
+            err = err.read().decode('utf-8', errors='replace')
+            status = out.channel.recv_exit_status()
+        except Exception as e:
+            log.error('transfer error', cmd)
+            log.error(e)
+            return False
+        finally:
+            if should_close:
+                f.close()
+        if 0 != status or type(self).failed_marker in err:
+            log.error('transfer command failed', cmd)
+            log.error(err)
+            return False
+        if not compress:
+            self._measure(rxbytes, started)
+        return rxbytes
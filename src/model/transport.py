@@ -47,6 +47,7 @@ import sys
 import threading
 import time
 import weakref
+import log
 from hashlib import md5, sha1, sha256, sha512
 
 from cryptography.hazmat.backends import default_backend
@@ -3014,3 +3015,63 @@ class ChannelMap(object):
             return len(self._map)
         finally:
             self._lock.release()
+
+
+# Bulk transfer profile
+#
+# Multi-gigabyte backups and restores are bound by the tablet's CPU,
+# which has no crypto extensions, so the cipher and MAC matter more
+# than anything else. SSH uses the client's first choice that the
+# server also supports, so listing the cheapest algorithms first picks
+# the fastest pair the tablet offers. Only algorithms that are still
+# sound are listed: speed is no reason to fall back to 3DES or MD5.
+# AES-128 does the fewest rounds of the AES ciphers, and of the MACs,
+# encrypt-then-MAC SHA-256 is preferred; SHA-512 is slow on the
+# tablet's 32 bit CPU, and SHA-1 is only kept for old servers. Channels
+# also get a larger window and packet size, so fewer window
+# adjustments are sent back and forth mid-stream.
+BULK_WINDOW_SIZE = 2 ** 24
+BULK_MAX_PACKET_SIZE = 2 ** 17
+BULK_CIPHERS = (
+    "aes128-ctr",
+    "aes192-ctr",
+    "aes256-ctr",
+    "aes128-cbc",
+    "aes192-cbc",
+    "aes256-cbc",
+)
+BULK_MACS = (
+    "hmac-sha2-256-etm@openssh.com",
+    "hmac-sha2-256",
+    "hmac-sha2-512-etm@openssh.com",
+    "hmac-sha2-512",
+    "hmac-sha1",
+)
+
+def apply_bulk_profile(transport, renegotiate=True):
+    # Works on this Transport and on paramiko's own (which is what
+    # SSHClient.connect() makes). Before the transport is started,
+    # the preferences simply take part in the first key exchange.
+    # Once it is active, keys are renegotiated (at most once) unless
+    # the bulk choices are already in use. Returns True if the
+    # profile is in effect.
+    if getattr(transport, "bulk_profile_applied", False):
+        return True
+    transport.default_window_size = BULK_WINDOW_SIZE
+    transport.default_max_packet_size = BULK_MAX_PACKET_SIZE
+    opts = transport.get_security_options()
+    opts.ciphers = [c for c in BULK_CIPHERS if c in transport._cipher_info]
+    opts.digests = [m for m in BULK_MACS if m in transport._mac_info]
+    if transport.is_active():
+        if not renegotiate:
+            return False
+        if (transport.local_cipher, transport.local_mac) \
+           != (opts.ciphers[0], opts.digests[0]):
+            try:
+                transport.renegotiate_keys()
+            except Exception as e:
+                log.error("could not renegotiate for bulk transfer")
+                log.error(e)
+                return False
+    transport.bulk_profile_applied = True
+    return True
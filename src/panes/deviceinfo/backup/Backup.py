@@ -532,19 +532,23 @@ class Backup:
             pct = self.bytes_transferred / self.total_bytes * 100
             progress_callback.emit(pct)
         
-        for file in self.files:
-            destname = Path(
-                self.parent_dir / self.bid \
-                / 'files' / file.get_filename())
-            status = file.dump_data_from_device(
-                destname, abort, add_bytes)
-            if not status:
-                log.error('backup failed for {}'.format(destname))
-                # Should we just mark this as a dirty backup and
-                # continue?
-                continue
-            # The file was dumnped successfully, so save the json
-            self.save_json()
+        # Keep other backups' deletions from pruning the chunks this
+        # one has written so far.
+        store = self.controller.chunk_store
+        store.hold()
+        try:
+            for file in self.files:
+                status = file.dump_data_from_device(abort, add_bytes)
+                if not status:
+                    log.error('backup failed for {}'.format(
+                        file.get_filename()))
+                    # Should we just mark this as a dirty backup and
+                    # continue?
+                    continue
+                # The file was dumnped successfully, so save the json
+                self.save_json()
+        finally:
+            store.release()
         # save_json will set self.complete
         if self.complete:
             return True
@@ -554,5 +558,6 @@ class Backup:
         True
 
     def delete_data(self):
-        # Delete the backup
+        # Delete the backup, and any chunks only it was using
         rmdir(self.get_dir())
+        self.controller.chunk_store.prune(self.parent_dir)
@@ -30,6 +30,8 @@ from datetime import datetime
 import platform
 
 from .Backup import BackupFile
+from .ChunkStore import ChunkStore
+from . import IncrementalTar
 
 from PySide2.QtWidgets import QTreeWidgetItem, QHeaderView, \
     QMenu, QTreeWidget, QFrame, QAbstractItemView, QMessageBox, \
@@ -165,8 +167,27 @@ class BackupQTreeWidget(QTreeWidget):
         ret = mb.exec()
         if int(QMessageBox.Yes) != ret:
             return
+        # Incremental backups need the ones they build on, so those
+        # can only go together with everything that depends on them.
+        bids = set(item.userData().bid for item in items)
+        kept = []
         for item in items:
-            item.delete()
+            for dep in self.controller.get_dependents(item.userData()):
+                if dep.bid not in bids:
+                    kept.append(item)
+                    break
+        if kept:
+            mb = QMessageBox(self.controller.window)
+            mb.setWindowTitle('Snapshot In Use')
+            mb.setText('Some snapshots were not deleted, because newer incremental snapshots depend on them. Delete those first.')
+            mb.setDetailedText('\n'.join(
+                prettydate(item.userData().timestamp, abs=True)
+                for item in kept))
+            mb.setStandardButtons(QMessageBox.Ok)
+            mb.exec()
+        for item in items:
+            if item not in kept:
+                item.delete()
         
 
 class BackupQTreeWidgetItem(QTreeWidgetItem):
@@ -198,6 +219,8 @@ class BackupController():
         self.window = pane.window
         self.backups = []
         self.backup_dir = pane.backup_dir
+        # Backup data shared by all backups (see ChunkStore.py)
+        self.chunk_store = ChunkStore(self.backup_dir / 'chunks')
         self.abort = False # Flag; when set to True, abort!
 
         # Overlay a new TreeWidget (the GUI designer one is just a
@@ -254,6 +277,38 @@ class BackupController():
             with open(path, 'r', encoding='utf-8') as f:
                 d = json.load(f)
                 self.load_backup(d)
+    def get_backups(self):
+        # Returns every complete Backup on disk, for any device.
+        backups = []
+        for path in self.backup_dir.glob('*/backup.json'):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    backup = Backup(self, json.load(f))
+            except Exception as e:
+                log.error('could not load backup', path)
+                log.error(e)
+                continue
+            if backup.complete:
+                backups.append(backup)
+        return backups
+
+    def get_dependents(self, backup):
+        # Returns the backups whose incremental data builds on backup.
+        dependents = []
+        for other in self.get_backups():
+            for f in other.files:
+                if 'inctar' != f.btype:
+                    continue
+                try:
+                    base = IncrementalTar.load_filelist(
+                        f.get_filelist_filepath()).get('base')
+                except Exception:
+                    continue
+                if base == backup.bid:
+                    dependents.append(other)
+                    break
+        return dependents
+
     def load_backup(self, obj):
         # Pass in a decoded json object, get a Backup
         if type(obj) is Backup:
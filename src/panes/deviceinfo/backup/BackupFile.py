@@ -24,7 +24,9 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import hashlib
 from pathlib import Path
 import log
-import os
+
+from .ChunkStore import ChunkStore
+from . import IncrementalTar
 
 class BackupFile:
     # This is a single file contined inside of a backup.
@@ -33,7 +35,7 @@ class BackupFile:
         self.backup = backup
         self.model = self.backup.model
         self.name = name
-        # Acceptable btypes: 'bin', 'softbin', 'tar'
+        # Acceptable btypes: 'bin', 'softbin', 'tar', 'inctar'
         self.btype = btype
         self.mountpoint = mountpoint
         self.size = size
@@ -54,16 +56,8 @@ class BackupFile:
                     log.error(err)
                     return False
                 self.size = int(out)
-            if not self.checksum:
-                log.info('getting checksum of {}'.format(self.mountpoint))
-                cmd = 'md5sum {} | cut -d" " -f1'.format(
-                    self.mountpoint)
-                out, err = self.model.run_cmd(cmd, timeout=300)
-                if err and len(err):
-                    log.error(str(err))
-                else:
-                    self.checksum = out.strip('\n')
-                    log.info('checksum was', self.checksum)
+            # The checksum is taken during the backup itself (see
+            # backup_bin()).
 
         elif 'softbin' == self.btype:
             # This is only applicable to RM2. It should be obsolesced
@@ -81,17 +75,7 @@ class BackupFile:
                     return False
                 self.size = int(out)
                 log.info('got size of {} as {}'.format(self.mountpoint, self.size))
-            if not self.checksum:
-                log.info('getting checksum of {}'.format(self.mountpoint))
-                cmd = 'md5sum {} | cut -d" " -f1'.format(
-                    self.mountpoint)
-                out, err = self.model.run_cmd(cmd, timeout=300)
-                if err and len(err):
-                    log.error(str(err))
-                else:
-                    self.checksum = out.strip('\n')
-                    log.info('checksum was', self.checksum)
-        elif 'tar' == self.btype:
+        elif 'tar' == self.btype or 'inctar' == self.btype:
             if not self.size:
                 cmd = 'du -sk "{}" | cut -f1'.format(self.mountpoint)
                 out, err = self.model.run_cmd(cmd, timeout=300)
@@ -116,46 +100,164 @@ class BackupFile:
     def get_disk_filepath(self):
         return Path(self.backup.get_dir() / 'files' / self.get_filename())
 
+    def get_manifest_filepath(self):
+        # Backups taken from the device are stored as a list of chunks
+        # in the shared store (see ChunkStore.py). Others, like imported
+        # firmware, are plain files at get_disk_filepath().
+        return Path(self.backup.get_dir() / 'files' \
+                    / (self.get_filename() + '.chunks'))
+
+    def get_filelist_filepath(self):
+        # For 'inctar', the list of every file on the device at backup
+        # time (see IncrementalTar.py).
+        return Path(self.backup.get_dir() / 'files' \
+                    / (self.get_filename() + '.files'))
+
+    def get_chunk_store(self):
+        return self.backup.controller.chunk_store
+
+    def find_incremental_base(self):
+        # Returns the newest complete BackupFile from this device that
+        # an incremental backup of this file can build on, or None.
+        serial = self.model.device_info['serial']
+        backups = {b.bid: b for b in
+                   self.backup.controller.get_backups()}
+        candidates = sorted(backups.values(),
+                            key=lambda b: b.timestamp, reverse=True)
+        for backup in candidates:
+            if backup.bid == self.backup.bid \
+               or backup.device_info.get('serial') != serial:
+                continue
+            for f in backup.files:
+                if f.name == self.name and 'inctar' == f.btype \
+                   and f.get_filelist_filepath().exists() \
+                   and f.get_incremental_chain(backups):
+                    return f
+        return None
+
+    def get_incremental_chain(self, backups=None):
+        # Returns this file and every backup it builds on, newest
+        # first, or None if one of them is missing. backups maps bid
+        # to Backup; pass it in to avoid reloading them from disk.
+        chain = [self]
+        filelist = IncrementalTar.load_filelist(
+            self.get_filelist_filepath())
+        while filelist.get('base'):
+            if backups is None:
+                backups = {b.bid: b for b in
+                           self.backup.controller.get_backups()}
+            backup = backups.get(filelist['base'])
+            found = None
+            if backup:
+                for f in backup.files:
+                    if f.name == self.name and 'inctar' == f.btype:
+                        found = f
+            if not found or found in chain:
+                log.error('incremental backup {} is missing its base {}'
+                          .format(self.backup.bid, filelist['base']))
+                return None
+            chain.append(found)
+            filelist = IncrementalTar.load_filelist(
+                found.get_filelist_filepath())
+        return chain
+
+    def open_data(self):
+        # Returns a readable, seekable file object of this file's data.
+        if 'inctar' == self.btype:
+            chain = self.get_incremental_chain()
+            if not chain:
+                raise IOError('incremental backup chain is broken')
+            final_files = IncrementalTar.load_filelist(
+                self.get_filelist_filepath())['files']
+            store = self.get_chunk_store()
+            return IncrementalTar.merge_chain(
+                [store.reader(ChunkStore.load_manifest(
+                    f.get_manifest_filepath())) for f in chain],
+                final_files)
+        mpath = self.get_manifest_filepath()
+        if mpath.exists():
+            return self.get_chunk_store().reader(
+                ChunkStore.load_manifest(mpath))
+        return open(self.get_disk_filepath(), 'rb')
+
     def verify_checksum_against_disk_copy(self):
         md5 = hashlib.md5()
-        with open(self.get_disk_filepath(), 'rb') as f:
-            # checksum
-            for chunk in iter(lambda: f.read(4096), b''):
-                md5.update(chunk)
-            f.close()
+        f = self.open_data()
+        # checksum
+        for chunk in iter(lambda: f.read(1048576), b''):
+            md5.update(chunk)
+        f.close()
         oldchecksum = md5.hexdigest()
         if oldchecksum != self.checksum:
             log.error('Checksums do not match! Aborting!')
             return False
         return True
-            
+
+    # The device hashes a stream while it is transferred, by teeing it
+    # into md5sum through this FIFO, so the data is only read once.
+    md5_fifo = '/tmp/rcu-md5.fifo'
+
+    def _device_md5_cmd(self, cmd):
+        # Wraps a command so its stdout is also hashed on the device.
+        # cmd may be '' to hash stdin. Collect the result with
+        # _device_md5_result().
+        # tee's exit status hides cmd's, so cmd reports its own
+        # failure (see FileTransfer.checked()).
+        fifo = type(self).md5_fifo
+        return 'rm -f {0} {0}.sum && mkfifo {0} && ' \
+            '{{ md5sum < {0} > {0}.sum & {1}tee {0}; wait; }}'.format(
+                fifo,
+                self.model.transfer.checked(cmd) + ' | ' if cmd else '')
+
+    def _device_md5_result(self):
+        # Returns the checksum left by a _device_md5_cmd(), or None.
+        fifo = type(self).md5_fifo
+        out, err = self.model.run_cmd(
+            'cat {0}.sum; rm -f {0} {0}.sum'.format(fifo))
+        if err or not out or not out.split():
+            log.error('could not get checksum from device')
+            log.error(err)
+            return None
+        return out.split()[0]
+
+    def _delta_cb(self, bytes_cb):
+        # The backup progress callbacks take the size of each chunk,
+        # where transfers report a running total.
+        last = [0]
+        def cb(total):
+            bytes_cb(total - last[0])
+            last[0] = total
+        return cb
+
     # This was the original, but is outperformed by the dumper
     def backup_bin(self, device, destname, abort, bytes_cb):
         if abort(): return False
         size = self.size
         log.info('size is {}, starting backup'.format(size))
-        with open(destname, 'ab+') as outfile:
-            cmd = 'dd if={} bs=4M'.format(device)
-            chunksize = 4096
-            out, err = self.model.run_cmd(cmd, raw_noread=True)
-            for chunk in iter(lambda: out.read(chunksize), b''):
-                if abort(): return False
-                outfile.write(chunk)
-                bytes_cb(len(chunk))
-        outfile.close()
-        # Verify the outfile
+        self.model.use_bulk_profile()
+        # The partition is read once: the device hashes what dd sends
+        # while the host hashes what arrives.
+        cmd = self._device_md5_cmd('dd if={} bs=4M'.format(device))
+        writer = self.get_chunk_store().writer(self.btype)
         md5 = hashlib.md5()
-        with open(destname, 'rb') as outfile:
-            for chunk in iter(lambda: outfile.read(4096), b''):
-                md5.update(chunk)
-        outfile.close()
+        # Mostly-empty partitions compress well on slow links.
+        done = self.model.transfer.pull(
+            cmd, writer, bytes_cb=self._delta_cb(bytes_cb),
+            abort_func=abort, hasher=md5, compress='auto')
+        device_checksum = self._device_md5_result()
+        if done is False:
+            return False
+        # Verify what was stored
         checksum = md5.hexdigest()
-        if self.checksum != checksum:
+        if device_checksum != checksum:
             log.error('backup file does not match!')
-            log.error('wanted {}'.format(checksum))
-            log.error('got {}'.format(out))
+            log.error('wanted {}'.format(device_checksum))
+            log.error('got {}'.format(checksum))
             # Should we do anything about this?
             return False
+        ChunkStore.save_manifest(destname, writer.close())
+        self.checksum = checksum
+        log.info('checksum was', self.checksum)
         log.info('backup file matches--finished')
         self.dirty = False
         return True
@@ -168,31 +270,95 @@ class BackupFile:
         # nothing to do with it (like /usr/share or the like).
         if not self.model.remount_home_as_readonly():
             return False
-        with open(destname, 'ab+') as outfile:
-            cmd = 'tar cf - -C "{}" .'.format(localpath)
-            chunksize = 4000000
-            out, err = self.model.run_cmd(cmd, raw_noread=True)
-            for chunk in iter(lambda: out.read(chunksize), b''):
-                if abort(): return False
-                if 0 != len(chunk):
-                    outfile.write(chunk)
-                    bytes_cb(len(chunk))
-            err = err.read()
-            # if err and len(err):
-            #     # Something went wrong with tar
-            #     log.debug('something went wrong', cmd)
-            #     log.error(err)
-            #     return False
-            # log.debug('figure out how to ignore the tar leading member err line')
-        outfile.close()
+        self.model.use_bulk_profile()
+        cmd = 'tar cf - -C "{}" .'.format(localpath)
+        writer = self.get_chunk_store().writer(self.btype)
+        done = self.model.transfer.pull(
+            cmd, writer, bytes_cb=self._delta_cb(bytes_cb),
+            abort_func=abort, compress='auto')
+        if done is False:
+            return False
+        ChunkStore.save_manifest(destname, writer.close())
         self.model.remount_home_reset()
         self.model.start_xochitl()
         self.dirty = False
         return True
 
-    def dump_data_from_device(self, destname, abort, bytes_cb):
+    def backup_inctar(self, localpath, destname, abort, bytes_cb):
+        # Like backup_tar(), but only takes the files which changed
+        # since the last incremental backup of this file.
+        if abort(): return False
+        self.model.stop_xochitl()
+        if not self.model.remount_home_as_readonly():
+            return False
+        ret = self._backup_inctar(localpath, destname, abort, bytes_cb)
+        self.model.remount_home_reset()
+        self.model.start_xochitl()
+        if ret:
+            self.dirty = False
+        return ret
+
+    def _backup_inctar(self, localpath, destname, abort, bytes_cb):
+        cmd = 'cd "{}" && {}'.format(localpath, IncrementalTar.LIST_CMD)
+        out, err = self.model.run_cmd(cmd, timeout=300)
+        files = IncrementalTar.parse_listing(out)
+        if not files:
+            log.error('could not list files for incremental backup')
+            log.error(err)
+            return False
+
+        base = self.find_incremental_base()
+        if base:
+            base_files = IncrementalTar.load_filelist(
+                base.get_filelist_filepath())['files']
+            changed, deleted = IncrementalTar.diff(base_files, files)
+            log.info('incremental backup on {}: {} changed, {} deleted'
+                     .format(base.backup.bid, len(changed), len(deleted)))
+        else:
+            changed, deleted = None, []
+            log.info('no base for incremental backup; taking all files')
+
+        writer = self.get_chunk_store().writer('tar')
+        listpath = '/tmp/rcu-incremental-list'
+        if changed is None:
+            cmd = 'tar cf - -C "{}" .'.format(localpath)
+        elif changed:
+            listing = '\n'.join(changed).encode('utf-8') + b'\n'
+            if self.model.transfer.put(listing, listpath) is False:
+                return False
+            cmd = 'tar cf - -C "{}" -T {}'.format(localpath, listpath)
+        else:
+            # Nothing changed; tar won't make an empty archive.
+            cmd = None
+        done = 0
+        if cmd:
+            self.model.use_bulk_profile()
+            done = self.model.transfer.pull(
+                cmd, writer, bytes_cb=self._delta_cb(bytes_cb),
+                abort_func=abort, compress='auto')
+            if changed:
+                self.model.run_cmd('rm -f {}'.format(listpath))
+            if done is False:
+                return False
+        # Unchanged data still counts towards the progress bar.
+        if self.size and self.size > done:
+            bytes_cb(self.size - done)
+
+        ChunkStore.save_manifest(destname, writer.close())
+        IncrementalTar.save_filelist(self.get_filelist_filepath(), {
+            'version': IncrementalTar.FILELIST_VERSION,
+            'base': base.backup.bid if base else None,
+            'files': files,
+            'changed': changed if changed is not None else sorted(files),
+            'deleted': deleted
+        })
+        return True
+
+    def dump_data_from_device(self, abort, bytes_cb):
         # Will dump the data from the device depending on self.btype,
-        # to the backup's directory path.
+        # into the chunk store, with its manifest in the backup's
+        # directory.
+        destname = self.get_manifest_filepath()
         if Path(destname).is_file():
             log.error('refusing to overwrite backup data from device')
             return
@@ -205,8 +371,12 @@ class BackupFile:
         elif 'tar' == self.btype:
             return self.backup_tar(
                 self.mountpoint, destname, abort, bytes_cb)
+        elif 'inctar' == self.btype:
+            return self.backup_inctar(
+                self.mountpoint, destname, abort, bytes_cb)
     
-    def restore_bin_to_device(self, mountpoint, bstart, blength, prog_cb):
+    def restore_bin_to_device(self, mountpoint, bstart, blength, prog_cb,
+                              diff=True):
         # This requires the tablet to already be in the restore mode.
         # This assumes the checksums have already been verified through
         # verify_checksum_against_disk_copy().
@@ -214,11 +384,14 @@ class BackupFile:
         # prog_cb should be called with the percentage complete, on a
         # scale of 0-1.
 
+        # With diff, only the blocks which differ from what is already
+        # on the device are written (see _restore_bin_diff()).
+
         log.info('restoring {} -> {}, start={}, length={}'.format(
             self.name, mountpoint, bstart, blength))
         
-        # Upload to the device
-        filepath = self.get_disk_filepath()
+        # Upload to the device, reassembling the data on the fly
+        data = self.open_data()
 
         # If this is a bootloader, we have to unlock it first.
         if '/dev/mmcblk1boot0' == mountpoint:
@@ -227,33 +400,19 @@ class BackupFile:
             if (err):
                 log.error('problem unlocking bootloader to rw')
                 log.error(err)
+                data.close()
                 return False
 
-        cmd = 'cat > "{}"'.format(mountpoint)
-        out, err, stdin = self.model.run_cmd(cmd, raw_noread=True,
-                                             with_stdin=True)
-        bytes_left = blength
-        chunksize = 4096
-        ondisk_md5 = hashlib.md5()
-        with open(filepath, 'rb') as f:
-            f.seek(bstart)
-            if bytes_left < chunksize:
-                chunksize = bytes_left
-            while bytes_left > 0:
-                chunk = f.read(chunksize)
-                stdin.write(chunk)
-                ondisk_md5.update(chunk)
-                bytes_left -= chunksize
-                prog_cb((blength - bytes_left) / blength)
-            f.close()
-            stdin.close()
-        ondisk_checksum = ondisk_md5.hexdigest()
-
-        err = err.read().decode('utf-8')
-        if (err):
-            log.error('error during restore')
-            log.error(err)
-            return False
+        ret = None
+        if diff:
+            ret = self._restore_bin_diff(
+                data, mountpoint, bstart, blength, prog_cb)
+            if ret is None:
+                log.info('could not compare blocks; writing everything')
+        if ret is None:
+            ret = self._restore_bin_full(
+                data, mountpoint, bstart, blength, prog_cb)
+        data.close()
 
         # If this is a bootloader, we have to lock it back up.
         if '/dev/mmcblk1boot0' == mountpoint:
@@ -264,21 +423,198 @@ class BackupFile:
                 log.error(err)
                 # don't return--might not be a problem after reboot
 
-        # Verify the new data against the old checksum. Since we may
-        # have done a partial restore from mmcblk1, we need to compute
-        # the checksum now. The entire file should have passed a check
-        # against its stored checksum in the beginning, so we could
-        # trust it.
-        cmd = 'md5sum {} | cut -d" " -f1'.format(mountpoint)
-        out, err = self.model.run_cmd(cmd, timeout=300)
-        newchecksum = out.strip('\n')
+        return ret
 
+    def _restore_bin_full(self, data, mountpoint, bstart, blength,
+                          prog_cb):
+        # The device hashes the stream as it writes it out, rather
+        # than reading the partition back afterwards.
+        ondisk_md5 = hashlib.md5()
+        cmd = self._device_md5_cmd('') + ' > "{}"'.format(mountpoint)
+        data.seek(bstart)
+        sent = self.model.transfer.pipe(
+            data, cmd, length=blength,
+            bytes_cb=lambda x: prog_cb(x / blength),
+            hasher=ondisk_md5)
+        ondisk_checksum = ondisk_md5.hexdigest()
+        newchecksum = self._device_md5_result()
+        if sent is False:
+            log.error('error during restore')
+            return False
+
+        # Verify what the device received against what was sent. Since
+        # we may have done a partial restore from mmcblk1, this covers
+        # only the sent range. The entire file should have passed a
+        # check against its stored checksum in the beginning, so we
+        # could trust it.
         if newchecksum != ondisk_checksum:
             log.error('checksums do not match!')
             return False
 
         return True
 
+    # Block size for diff restores, the same as the chunks of partition
+    # images in the store.
+    diff_block_size = 4194304
+
+    def _device_block_md5_cmd(self, mountpoint, blocks, blength):
+        # Returns a command printing the md5 of each block of
+        # mountpoint in blocks, one per line. The last block is cut
+        # short at blength.
+        bs = type(self).diff_block_size
+        nblocks = (blength + bs - 1) // bs
+        last_len = blength - (nblocks - 1) * bs
+        full = [i for i in blocks if i < nblocks - 1 or last_len == bs]
+        cmds = []
+        if full:
+            cmds.append(
+                'for i in {}; do dd if="{}" bs={} skip=$i count=1 '
+                '2>/dev/null | md5sum; done'.format(
+                    ' '.join(str(i) for i in full), mountpoint, bs))
+        if len(full) < len(blocks):
+            cmds.append(
+                'dd if="{}" bs={} skip={} count=1 2>/dev/null '
+                '| head -c {} | md5sum'.format(
+                    mountpoint, bs, nblocks - 1, last_len))
+        return '; '.join(cmds)
+
+    def _start_device_md5s(self, mountpoint, blocks, blength):
+        # Starts hashing blocks on the device, for _read_device_md5s().
+        cmd = self._device_block_md5_cmd(mountpoint, blocks, blength)
+        return self.model.run_cmd(cmd, raw_noread=True, timeout=300)
+
+    def _read_device_md5s(self, started, count, line_cb=lambda: ()):
+        # Reads the checksums from a _start_device_md5s(), or returns
+        # None if it didn't give one per block.
+        out, err = started
+        if not hasattr(out, 'readline'):
+            log.error('could not start block checksums', err)
+            return None
+        md5s = []
+        try:
+            for line in iter(out.readline, b''):
+                parts = line.split()
+                if not parts:
+                    continue
+                md5s.append(parts[0].decode('utf-8'))
+                line_cb()
+        except Exception as e:
+            log.error('error reading block checksums')
+            log.error(e)
+            return None
+        if len(md5s) != count:
+            log.error('got {} block checksums, wanted {}'.format(
+                len(md5s), count))
+            log.error(err.read().decode('utf-8'))
+            return None
+        return md5s
+
+    def _restore_bin_diff(self, data, mountpoint, bstart, blength,
+                          prog_cb):
+        # Hashes every block already on the device in one pass,
+        # compares them against the same blocks of the backup, then
+        # seek-writes only the runs of blocks which differ. Returns
+        # None if the device's blocks couldn't be hashed, so the caller
+        # can fall back to writing everything.
+        bs = type(self).diff_block_size
+        nblocks = (blength + bs - 1) // bs
+        if not nblocks:
+            return True
+
+        # Progress covers hashing every block, then writing and
+        # re-hashing the changed ones.
+        work = [0, blength]
+        def progress(n):
+            work[0] += n
+            prog_cb(min(1, work[0] / work[1]))
+
+        # Start the device on its hashes, and hash the local blocks
+        # while it works. Its output is small enough to wait in the
+        # channel until it is read.
+        started = self._start_device_md5s(
+            mountpoint, range(nblocks), blength)
+        # Empty space in the backup is known without reading it.
+        is_zero = getattr(data, 'is_zero', lambda o, l: False)
+        zero_md5s = {}
+        local_md5s = []
+        local_zero = []
+        for i in range(nblocks):
+            length = min(bs, blength - i * bs)
+            local_zero.append(is_zero(bstart + i * bs, length))
+            if local_zero[-1]:
+                if length not in zero_md5s:
+                    zero_md5s[length] = \
+                        hashlib.md5(bytes(length)).hexdigest()
+                local_md5s.append(zero_md5s[length])
+                continue
+            data.seek(bstart + i * bs)
+            local_md5s.append(hashlib.md5(data.read(length)).hexdigest())
+        device_md5s = self._read_device_md5s(
+            started, nblocks, lambda: progress(bs))
+        if device_md5s is None:
+            return None
+        work[0] = blength
+
+        changed = [i for i in range(nblocks)
+                   if local_md5s[i] != device_md5s[i]]
+        log.info('{} of {} blocks differ on {}'.format(
+            len(changed), nblocks, mountpoint))
+        if not changed:
+            prog_cb(1)
+            return True
+
+        # Group consecutive blocks into runs, each sent with one dd.
+        # Runs of zeros are filled on the device instead of sent.
+        runs = []
+        for i in changed:
+            if runs and runs[-1][1] == i and runs[-1][2] == local_zero[i]:
+                runs[-1][1] = i + 1
+            else:
+                runs.append([i, i + 1, local_zero[i]])
+        changed_len = sum(min(bs, blength - i * bs) for i in changed)
+        work[1] += 2 * changed_len
+
+        for first, last, zero in runs:
+            start = first * bs
+            length = min(last * bs, blength) - start
+            # dd writes its transfer summary to stderr, which would
+            # count as a failure, so it only comes out if dd fails.
+            cmd = 'dd of="{0}" bs={1} seek={2} conv=notrunc ' \
+                '2>/tmp/rcu-dd.err || cat /tmp/rcu-dd.err >&2'.format(
+                    mountpoint, bs, first)
+            if zero:
+                cmd = 'head -c {} /dev/zero | {}'.format(length, cmd)
+                out, err = self.model.run_cmd(cmd, timeout=300)
+                if err:
+                    log.error('error during restore')
+                    log.error(err)
+                    return False
+                progress(length)
+                continue
+            data.seek(bstart + start)
+            sent = [0]
+            def bytes_cb(total):
+                progress(total - sent[0])
+                sent[0] = total
+            if self.model.transfer.pipe(
+                    data, cmd, length=length, bytes_cb=bytes_cb) is False:
+                log.error('error during restore')
+                return False
+
+        # Verify by hashing the rewritten blocks again
+        new_md5s = self._read_device_md5s(
+            self._start_device_md5s(mountpoint, changed, blength),
+            len(changed),
+            lambda: progress(bs))
+        if new_md5s is None:
+            return False
+        for i, md5 in zip(changed, new_md5s):
+            if md5 != local_md5s[i]:
+                log.error('checksums do not match for block {}!'.format(i))
+                return False
+        prog_cb(1)
+        return True
+
     def restore_tar_to_device(self, paths, prog_cb):
         # paths should be a list of paths to extract from the tar and
         # put onto the tablet.
@@ -288,26 +624,18 @@ class BackupFile:
         for i, p in enumerate(paths):
             pstring += '"./{}" '.format(p)
 
-        filepath = self.get_disk_filepath()
-        filesize = os.stat(filepath).st_size
-        bytes_written = 0
+        data = self.open_data()
+        filesize = data.seek(0, 2)
+        data.seek(0)
 
         cmd = 'tar xf - -C "{}" {}'.format(self.mountpoint, pstring)
-        out, err, stdin = self.model.run_cmd(cmd, raw_noread=True,
-                                             with_stdin=True)
         log.info('restoring tar to device', self.mountpoint, pstring)
-        with open(filepath, 'rb') as f:
-            for chunk in iter(lambda: f.read(4000000), b''):
-                stdin.write(chunk)
-                bytes_written += len(chunk)
-                prog_cb(bytes_written / filesize)
-            stdin.close()
-            f.close()
-
-        err = err.read().decode('utf-8')
-        if (err):
+        sent = self.model.transfer.pipe(
+            data, cmd,
+            bytes_cb=lambda x: prog_cb(x / filesize))
+        data.close()
+        if sent is False:
             log.error('error during restore')
-            log.error(err)
             return False
 
         return True
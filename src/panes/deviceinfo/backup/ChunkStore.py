@@ -0,0 +1,373 @@
+'''
+ChunkStore.py
+Backup data is split into chunks which are stored once, by hash, and
+shared between all backups. Each BackupFile records the list of
+chunks it is made of.
+
+RCU is a management client for the reMarkable Tablet.
+Copyright (C) 2020-24  Davis Remmel
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from pathlib import Path
+import hashlib
+import json
+import log
+import os
+import threading
+import zlib
+
+
+class FixedSplitter:
+    # Partition images are cut every chunk_size bytes. Blocks that
+    # didn't change between backups stay at the same offsets, so they
+    # hash the same.
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.buf = bytearray()
+
+    def feed(self, data):
+        self.buf += data
+        size = self.chunk_size
+        chunks = []
+        while len(self.buf) >= size:
+            chunks.append(bytes(self.buf[:size]))
+            del self.buf[:size]
+        return chunks
+
+    def flush(self):
+        chunks = [bytes(self.buf)] if self.buf else []
+        self.buf = bytearray()
+        return chunks
+
+
+class TarSplitter:
+    # A tar stream shifts whenever a file before it grows or shrinks,
+    # so fixed offsets would never line up between backups. Instead,
+    # chunks are cut just before a member header, once the chunk is at
+    # least min_size and the header's hash picks it as a cut point.
+    # Since the choice depends only on the header (name, size, mtime),
+    # unchanged files end up in the same chunks again, shortly after
+    # any change. Large members are still cut every max_size bytes.
+    min_size = 65536
+    max_size = 4194304
+    cut_mask = 0x7
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.header = bytearray()
+        # Bytes left in the current member's data (with padding)
+        self.body_left = 0
+        # After the end-of-archive marker, or anything that doesn't
+        # parse as tar, just cut at max_size.
+        self.done = False
+
+    def _member_length(self, header):
+        # Returns the padded length of the data following header, or
+        # None at the end of the archive.
+        if not any(header):
+            return None
+        field = header[124:136]
+        if field[0] & 0x80:
+            # GNU base-256 for large sizes
+            size = int.from_bytes(bytes([field[0] & 0x7f]) + field[1:],
+                                  'big')
+        else:
+            size = int(field.strip(b'\0 ') or b'0', 8)
+        return (size + 511) // 512 * 512
+
+    def _take(self, chunks, data):
+        self.buf += data
+        while len(self.buf) >= self.max_size:
+            chunks.append(bytes(self.buf[:self.max_size]))
+            del self.buf[:self.max_size]
+
+    def feed(self, data):
+        chunks = []
+        mv = memoryview(data)
+        i = 0
+        while i < len(mv):
+            if self.done:
+                self._take(chunks, mv[i:])
+                break
+            if self.body_left:
+                n = min(self.body_left, len(mv) - i)
+                self._take(chunks, mv[i:i+n])
+                self.body_left -= n
+                i += n
+                continue
+            # At a header
+            n = min(512 - len(self.header), len(mv) - i)
+            self.header += mv[i:i+n]
+            i += n
+            if len(self.header) < 512:
+                break
+            header = bytes(self.header)
+            self.header = bytearray()
+            try:
+                length = self._member_length(header)
+            except ValueError:
+                length = None
+            if length is None:
+                self.done = True
+            elif len(self.buf) >= self.min_size \
+                 and 0 == zlib.crc32(header) & self.cut_mask:
+                chunks.append(bytes(self.buf))
+                self.buf = bytearray()
+            self._take(chunks, header)
+            self.body_left = length or 0
+        return chunks
+
+    def flush(self):
+        self.buf += self.header
+        self.header = bytearray()
+        chunks = [bytes(self.buf)] if self.buf else []
+        self.buf = bytearray()
+        return chunks
+
+
+class ChunkWriter:
+    # A write-only file object. Whatever is written is split, and the
+    # chunks are put in the store. close() returns the manifest.
+    def __init__(self, store, splitter):
+        self.store = store
+        self.splitter = splitter
+        self.chunks = []
+        self.size = 0
+        self.closed = False
+
+    def write(self, data):
+        for chunk in self.splitter.feed(data):
+            self._put(chunk)
+        return len(data)
+
+    def _put(self, chunk):
+        # Runs of zeros (empty space in partition images) aren't
+        # stored at all; they are kept as a null digest.
+        if chunk.count(0) == len(chunk):
+            digest = None
+        else:
+            digest = self.store.put(chunk)
+        self.chunks.append([digest, len(chunk)])
+        self.size += len(chunk)
+
+    def close(self):
+        if not self.closed:
+            for chunk in self.splitter.flush():
+                self._put(chunk)
+            self.closed = True
+        return {
+            'version': ChunkStore.MANIFEST_VERSION,
+            'size': self.size,
+            'chunks': self.chunks
+        }
+
+
+class ChunkReader:
+    # A read-only, seekable file object over a manifest. Chunks are
+    # loaded from the store as they are reached.
+    def __init__(self, store, manifest):
+        self.store = store
+        self.chunks = manifest['chunks']
+        self.size = manifest['size']
+        # Start offset of each chunk
+        self.starts = []
+        pos = 0
+        for digest, length in self.chunks:
+            self.starts.append(pos)
+            pos += length
+        self.pos = 0
+        self.cur_index = None
+        self.cur_data = b''
+
+    def seek(self, offset, whence=0):
+        if 1 == whence:
+            offset += self.pos
+        elif 2 == whence:
+            offset += self.size
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def _load(self, index):
+        if index != self.cur_index:
+            digest, length = self.chunks[index]
+            if digest is None:
+                self.cur_data = bytes(length)
+            else:
+                self.cur_data = self.store.get(digest)
+            self.cur_index = index
+        return self.cur_data
+
+    def is_zero(self, offset, length):
+        # Returns True if length bytes from offset are all zero
+        # chunks, without loading anything.
+        if length <= 0 or offset + length > self.size:
+            return False
+        index = self._index_for(offset)
+        while index < len(self.chunks) \
+              and self.starts[index] < offset + length:
+            if self.chunks[index][0] is not None:
+                return False
+            index += 1
+        return True
+
+    def _index_for(self, pos):
+        # Binary search for the chunk holding pos
+        lo, hi = 0, len(self.starts) - 1
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.starts[mid] <= pos:
+                lo = mid
+            else:
+                hi = mid - 1
+        return lo
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self.size - self.pos
+        out = bytearray()
+        while n > 0 and self.pos < self.size:
+            index = self._index_for(self.pos)
+            data = self._load(index)
+            start = self.pos - self.starts[index]
+            piece = data[start:start+n]
+            out += piece
+            self.pos += len(piece)
+            n -= len(piece)
+        return bytes(out)
+
+    def close(self):
+        self.cur_data = b''
+        self.cur_index = None
+
+
+class ChunkStore:
+    # Chunks are kept zlib-compressed under chunks/ab/abcdef..., named
+    # by the sha256 of their uncompressed data. Manifest version 2
+    # added zero chunks, which have a null digest.
+    MANIFEST_VERSION = 2
+    # Chunk size for partition images
+    bin_chunk_size = 4194304
+
+    def __init__(self, path):
+        self.path = Path(path)
+        # A backup's chunks aren't referred to by a saved manifest
+        # until it finishes, so pruning waits while any backup holds
+        # the store (see hold()).
+        self.lock = threading.Lock()
+        self.holds = 0
+        self.prune_pending = None
+
+    def hold(self):
+        # Call before writing a backup, and release() once its
+        # manifests are saved.
+        with self.lock:
+            self.holds += 1
+
+    def release(self):
+        with self.lock:
+            self.holds -= 1
+            backup_dir = None
+            if 0 == self.holds:
+                backup_dir = self.prune_pending
+                self.prune_pending = None
+        if backup_dir:
+            self.prune(backup_dir)
+
+    def chunk_path(self, digest):
+        return Path(self.path / digest[:2] / digest)
+
+    def put(self, data):
+        # Stores data if it isn't already, and returns its digest.
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.chunk_path(digest)
+        if path.exists():
+            return digest
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmppath = path.with_name(path.name + '.tmp')
+        with open(tmppath, 'wb') as f:
+            f.write(zlib.compress(data, 1))
+            f.close()
+        os.replace(tmppath, path)
+        return digest
+
+    def get(self, digest):
+        with open(self.chunk_path(digest), 'rb') as f:
+            data = zlib.decompress(f.read())
+            f.close()
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise IOError('backup chunk {} is corrupt'.format(digest))
+        return data
+
+    def writer(self, btype):
+        # Returns a ChunkWriter suited to the backup type.
+        if 'tar' == btype:
+            return ChunkWriter(self, TarSplitter())
+        return ChunkWriter(self, FixedSplitter(type(self).bin_chunk_size))
+
+    def reader(self, manifest):
+        return ChunkReader(self, manifest)
+
+    @classmethod
+    def save_manifest(cls, path, manifest):
+        with open(path, 'w') as f:
+            json.dump(manifest, f)
+            f.close()
+
+    @classmethod
+    def load_manifest(cls, path):
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+            f.close()
+        return manifest
+
+    def prune(self, backup_dir):
+        # Removes chunks which no backup in backup_dir refers to. While
+        # a backup is being written, this is put off until it is done.
+        with self.lock:
+            if self.holds:
+                log.info('backup in progress; pruning chunks after it')
+                self.prune_pending = backup_dir
+                return
+            self._prune(backup_dir)
+
+    def _prune(self, backup_dir):
+        if not self.path.exists():
+            return
+        live = set()
+        for mpath in Path(backup_dir).glob('*/files/*.chunks'):
+            try:
+                for digest, length in self.load_manifest(mpath)['chunks']:
+                    if digest is not None:
+                        live.add(digest)
+            except Exception as e:
+                # Without knowing what this one refers to, nothing is
+                # safe to remove.
+                log.error('could not read backup manifest', mpath)
+                log.error(e)
+                return
+        removed = 0
+        for path in self.path.glob('*/*'):
+            if path.name not in live:
+                try:
+                    path.unlink()
+                    removed += 1
+                except Exception as e:
+                    log.error('could not remove backup chunk', path)
+                    log.error(e)
+        log.info('pruned {} unused backup chunks'.format(removed))
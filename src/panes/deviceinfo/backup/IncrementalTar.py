@@ -0,0 +1,180 @@
+'''
+IncrementalTar.py
+Helpers for incremental tar backups, which only transfer the files that
+changed since the previous backup. Each one keeps a list of every file
+on the device at the time, and restores merge the chain of backups back
+into a single tar stream.
+
+RCU is a management client for the reMarkable Tablet.
+Copyright (C) 2020-24  Davis Remmel
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import json
+import log
+import stat
+import tarfile
+
+FILELIST_VERSION = 1
+
+# Lists every path under the current directory as
+# 'size mtime rawmode(hex) ./path'.
+LIST_CMD = 'find . -xdev -print0 | xargs -0 -r stat -c "%s %Y %f %n"'
+
+
+def norm_path(name):
+    # Paths are kept as './a/b', the way 'tar -C dir .' names them.
+    name = name.lstrip('/')
+    while name.startswith('./'):
+        name = name[2:]
+    name = name.rstrip('/')
+    if not name or '.' == name:
+        return '.'
+    return './' + name
+
+
+def parse_listing(text):
+    # Returns {path: [size, mtime, mode]} from LIST_CMD output.
+    files = {}
+    for line in text.splitlines():
+        parts = line.split(' ', 3)
+        if 4 != len(parts):
+            continue
+        try:
+            entry = [int(parts[0]), int(parts[1]), int(parts[2], 16)]
+        except ValueError:
+            log.error('skipping unreadable listing line', line)
+            continue
+        files[norm_path(parts[3])] = entry
+    return files
+
+
+def is_dir(entry):
+    return stat.S_ISDIR(entry[2])
+
+
+def diff(base_files, files):
+    # Returns (changed, deleted) paths between two listings. Changed
+    # paths are the new or modified non-directories; tar recreates
+    # their parent directories.
+    changed = []
+    for path, entry in files.items():
+        if is_dir(entry):
+            continue
+        if base_files.get(path) != entry:
+            changed.append(path)
+    deleted = [path for path in base_files if path not in files]
+    return (sorted(changed), sorted(deleted))
+
+
+def save_filelist(path, filelist):
+    with open(path, 'w') as f:
+        json.dump(filelist, f)
+        f.close()
+
+
+def load_filelist(path):
+    with open(path, 'r') as f:
+        filelist = json.load(f)
+        f.close()
+    return filelist
+
+
+class SegmentReader:
+    # A read-only file object made of byte ranges of other seekable
+    # file objects, followed by trailer.
+    def __init__(self, segments, trailer=b''):
+        # segments: [(fileobj, start, length)]
+        self.segments = segments
+        self.trailer = trailer
+        self.size = sum(s[2] for s in segments) + len(trailer)
+        self.index = 0
+        self.seg_pos = 0
+        self.pos = 0
+
+    def seek(self, offset, whence=0):
+        # Only rewinding and finding the size are supported.
+        if 2 == whence and 0 == offset:
+            return self.size
+        if 0 == whence and 0 == offset:
+            self.index = 0
+            self.seg_pos = 0
+            self.pos = 0
+            return 0
+        raise IOError('SegmentReader can only seek to the start')
+
+    def tell(self):
+        return self.pos
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self.size - self.pos
+        out = bytearray()
+        while n > 0 and self.index < len(self.segments):
+            f, start, length = self.segments[self.index]
+            left = length - self.seg_pos
+            if left <= 0:
+                self.index += 1
+                self.seg_pos = 0
+                continue
+            f.seek(start + self.seg_pos)
+            piece = f.read(min(n, left))
+            if not piece:
+                raise IOError('backup data ended early')
+            out += piece
+            self.seg_pos += len(piece)
+            n -= len(piece)
+        if n > 0 and self.index >= len(self.segments):
+            tpos = self.pos + len(out) - (self.size - len(self.trailer))
+            out += self.trailer[tpos:tpos+n]
+        self.pos += len(out)
+        return bytes(out)
+
+    def close(self):
+        for f, start, length in self.segments:
+            f.close()
+
+
+def merge_chain(tar_readers, final_files):
+    # tar_readers are the tar streams of a chain of backups, newest
+    # first. Every path in final_files is taken from the newest tar
+    # which has it, and the raw members are stitched together, oldest
+    # backup first so directories come before their contents. Returns
+    # a SegmentReader of the merged tar.
+    winners = {}
+    for age, reader in enumerate(tar_readers):
+        if 0 == reader.seek(0, 2):
+            continue
+        reader.seek(0)
+        tf = tarfile.open(fileobj=reader, mode='r:')
+        for m in tf:
+            path = norm_path(m.name)
+            if path in winners or path not in final_files:
+                continue
+            # m.offset includes any long name or pax headers
+            end = m.offset_data + (m.size + 511) // 512 * 512
+            winners[path] = (age, m.offset, end - m.offset)
+    missing = [p for p, e in final_files.items()
+               if p not in winners and not is_dir(e) and '.' != p]
+    if missing:
+        log.error('{} files could not be found in the backup chain'
+                  .format(len(missing)))
+        for p in missing[:10]:
+            log.error(p)
+    spans = sorted(winners.values(), key=lambda w: (-w[0], w[1]))
+    segments = [(tar_readers[age], start, length)
+                for age, start, length in spans]
+    # End-of-archive marker
+    return SegmentReader(segments, trailer=bytes(1024))
@@ -20,11 +20,16 @@ rm1_backup_types = {
         ['mmcblk1p7', 'bin', '/dev/mmcblk1p7']],
     'Only Data (high)': [
         ['mmcblk1p7-user', 'tar', '$HOME'],
-        ['mmcblk1-share', 'tar', '/usr/share/remarkable']]}
+        ['mmcblk1-share', 'tar', '/usr/share/remarkable']],
+    'Only Data (incremental)': [
+        # Only the files changed since the last one of these
+        ['mmcblk1p7-user', 'inctar', '$HOME']]}
 
 rm2_backup_types = {
     'Only Data (high)': [
         ['mmcblk2p4-user', 'tar', '$HOME'],
         ['mmcblk2-share', 'tar', '/usr/share/remarkable']],
     'Only Data (low)': [
-        ['mmcblk2p4', 'softbin', '/dev/mmcblk2p4']]}
+        ['mmcblk2p4', 'softbin', '/dev/mmcblk2p4']],
+    'Only Data (incremental)': [
+        ['mmcblk2p4-user', 'inctar', '$HOME']]}
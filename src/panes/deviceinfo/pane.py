@@ -332,6 +332,7 @@ class DeviceInfoPane(controllers.UIController):
             binfile = Path(tmp)
             tmp_filepaths.append(binfile)
             log.info('cloning {} to {}'.format(device, binfile))
+            self.model.use_bulk_profile()
             bytes_read = 0
             with open(binfile, 'ab+') as f:
                 cmd = 'dd if={} bs=4M'.format(device)
@@ -349,17 +350,9 @@ class DeviceInfoPane(controllers.UIController):
                                     progcb=lambda x: ()):
             # Copy the firmware data over the target partition.
             log.info('writing out to device')
-            cmd = 'cat > "{}"'.format(device)
-            out, err, stdin = self.model.run_cmd(
-                cmd, raw_noread=True, with_stdin=True)
-            bytes_written = 0
-            with open(binfile, 'rb') as f:
-                for chunk in iter(lambda: f.read(1048576), b''):
-                    stdin.write(chunk)
-                    bytes_written += len(chunk)
-                    progcb(bytes_written / progsize)
-                f.close()
-                stdin.close()
+            self.model.transfer.put(
+                binfile, device,
+                bytes_cb=lambda x: progcb(x / progsize))
             log.info('wrote firmware')
             if get_checksum_from_device(device) != get_local_checksum(binfile):
                 log.error('checksum did not match what was written!')
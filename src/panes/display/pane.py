@@ -20,17 +20,18 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
 from PySide2.QtCore import Qt, QSize, QObject, QEvent, QSettings, \
-    QCoreApplication
-from PySide2.QtGui import QImage, QPixmap, QColor, QIcon
+    QCoreApplication, QPoint, QRect, Signal
+from PySide2.QtGui import QImage, QPixmap, QColor, QIcon, QPainter
 from PySide2.QtWidgets import QFileDialog, QWidget, QApplication, \
     QShortcut
 from pathlib import Path
 from datetime import datetime
 from controllers import UIController
 from worker import Worker
+from model.mirror import ScreenMirror
+from model.recording import ApngRecorder
 import log
 import gc
-import ctypes
 
 
 def load_label_pixmap(container_widget, label):
@@ -64,6 +65,11 @@ class ResizeEventFilter(QObject):
             return QObject.eventFilter(self, obj, event)
     
 
+class MirrorSignals(QObject):
+    # Raised from the mirror's thread when a frame is waiting
+    frame = Signal()
+
+
 class DisplayPane(UIController):
     identity = 'me.davisr.rcu.display'
     name = 'Display'
@@ -102,6 +108,18 @@ class DisplayPane(UIController):
 
         self.pane_controller = pane_controller
         self.orientation = 0
+        self.mirror = None
+        self.recorder = None
+        # Whether the mirror was only started for the recording
+        self.mirror_for_recorder = False
+        self.mirror_signals = MirrorSignals()
+        self.mirror_signals.frame.connect(self.update_mirror)
+
+        # The mirror's thread runs until it is stopped, and the thread
+        # pool waits for it at exit, so it must be stopped on the way
+        # out or the main process will never terminate. A recording
+        # gets its last frame written.
+        self.model._app.aboutToQuit.connect(self.handle_quit)
     
         if not QCoreApplication.args.cli:
             # Load initial orientation
@@ -123,6 +141,10 @@ class DisplayPane(UIController):
                 self.copy_image_to_clipboard)
             self.window.refresh_pushButton.clicked.connect(
                 self.hard_load_screen_async)
+            self.window.mirror_pushButton.toggled.connect(
+                self.toggle_mirror)
+            self.window.record_pushButton.toggled.connect(
+                self.toggle_recording)
             self.window.portrait_radioButton.clicked.connect(
                 lambda: self.change_orientation(angle=0))
             self.window.landscape_radioButton.clicked.connect(
@@ -141,8 +163,12 @@ class DisplayPane(UIController):
             refresh.activated.connect(self.hard_load_screen_async)
             refresh2 = QShortcut('F5', self.window)
             refresh2.activated.connect(self.hard_load_screen_async)
+            mirror = QShortcut('Ctrl+M', self.window)
+            mirror.activated.connect(self.window.mirror_pushButton.toggle)
 
     def update_view(self):
+        if self.mirror:
+            return
         self.hard_load_screen_async()
 
     def change_orientation(self, angle):
@@ -154,9 +180,16 @@ class DisplayPane(UIController):
             QSettings().setValue(
                 'pane/display/orientation',
                 int(self.orientation))
+            if self.mirror:
+                # Repaint the whole last frame the new way up
+                self.paint_mirror_frame(self.mirror.prev, None)
+                return
             self.soft_load_screen_async()
 
     def hard_load_screen_async(self, prog_cb=lambda x: ()):
+        # The mirror is already grabbing the screen
+        if self.mirror:
+            return
         self.model.display.invalidate_pixel_cache()
         self.soft_load_screen_async(prog_cb=prog_cb)
 
@@ -173,6 +206,8 @@ class DisplayPane(UIController):
         self.window.screenshot_pushButton.setEnabled(False)
         self.window.clipboard_pushButton.setEnabled(False)
         self.window.refresh_pushButton.setEnabled(False)
+        self.window.mirror_pushButton.setEnabled(False)
+        self.window.record_pushButton.setEnabled(False)
         self.window.portrait_radioButton.setEnabled(False)
         self.window.landscape_radioButton.setEnabled(False)
         self.window.typefolio_radioButton.setEnabled(False)
@@ -184,7 +219,9 @@ class DisplayPane(UIController):
     def enable_buttons(self):
         self.window.screenshot_pushButton.setEnabled(True)
         self.window.clipboard_pushButton.setEnabled(True)
-        self.window.refresh_pushButton.setEnabled(True)
+        self.window.refresh_pushButton.setEnabled(not self.mirror)
+        self.window.mirror_pushButton.setEnabled(True)
+        self.window.record_pushButton.setEnabled(True)
         self.window.portrait_radioButton.setEnabled(True)
         self.window.landscape_radioButton.setEnabled(True)
         self.window.typefolio_radioButton.setEnabled(True)
@@ -231,8 +268,17 @@ class DisplayPane(UIController):
         # # If landscape, rotate it. (only used for cli, todo: use in gui)
         # if landscape:
         #     self.window.testlabel.pixmap_copy
-        self.window.testlabel.pixmap_copy.save(str(outfile), 'PNG')
+        # The PNG is only encoded now, from the captured image when
+        # there is one (the mirror only keeps its pixmap).
+        label = self.window.testlabel
+        image = getattr(label, 'image_copy', None) \
+            or label.pixmap_copy.toImage()
+        if not image.convertToFormat(QImage.Format_Grayscale8).save(
+                str(outfile), 'PNG'):
+            log.error('could not save screenshot', outfile)
+            return False
         log.info('saved screenshot')
+        return True
         # # Save the last path directory for convenience
         # QSettings().setValue(
         #     'pane/display/last_export_path',
@@ -242,21 +288,19 @@ class DisplayPane(UIController):
         # Captures the screen from the device and loads it into a
         # QPixmap.
         
-        pngdata, size = self.model.display.get_png_data(
-            rotation=self.orientation)
+        got = self.model.display.get_image(rotation=self.orientation)
+        if not got:
+            log.error('could not capture the screen')
+            return
+        image, size = got
 
         # if progress_callback:
         #     progress_callback.emit(50)
 
         label = self.window.testlabel
-        pxmap = QPixmap()
-        pxmap.loadFromData(pngdata, 'PNG')
-
-        label.pixmap_copy = pxmap.copy()
+        label.image_copy = image
+        label.pixmap_copy = QPixmap.fromImage(image)
         label.pixmap_size = size
-
-        ctypes.c_long.from_address(id(pxmap)).value=1
-        del pxmap
         gc.collect()
 
         load_label_pixmap(
@@ -265,6 +309,131 @@ class DisplayPane(UIController):
         # if progress_callback:
         #     progress_callback.emit(100)
 
+    def toggle_mirror(self, checked):
+        if checked:
+            self.start_mirror()
+        else:
+            self.stop_mirror()
+
+    def start_mirror(self):
+        if self.mirror:
+            return
+        fps = float(QSettings().value('pane/display/mirror_fps') or 0)
+        self.mirror = ScreenMirror(self.model.display, fps=fps or None)
+        # The mirror keeps the screen current; a refresh would only
+        # compete with it for the link.
+        self.window.refresh_pushButton.setEnabled(False)
+        worker = Worker(fn=self.mirror.run,
+                        frame_cb=self.mirror_signals.frame.emit)
+        worker.signals.finished.connect(self.mirror_stopped)
+        self.threadpool.start(worker)
+
+    def stop_mirror(self):
+        if self.recorder:
+            self.window.record_pushButton.setChecked(False)
+        if self.mirror:
+            self.mirror.stop()
+
+    def handle_quit(self):
+        self.stop_recording()
+        if self.mirror:
+            self.mirror.stop()
+
+    def mirror_stopped(self):
+        # The mirror's thread finished, by request or because the
+        # device went away.
+        if self.recorder:
+            self.window.record_pushButton.setChecked(False)
+        self.mirror = None
+        self.window.refresh_pushButton.setEnabled(True)
+        if self.window.mirror_pushButton.isChecked():
+            self.window.mirror_pushButton.setChecked(False)
+
+    def toggle_recording(self, checked):
+        if checked:
+            if not self.start_recording():
+                self.window.record_pushButton.setChecked(False)
+        else:
+            self.stop_recording()
+
+    def start_recording(self):
+        # Records the mirrored screen to an animated PNG, starting the
+        # mirror if it isn't running.
+        if self.recorder:
+            return True
+        default_savepath = QSettings().value(
+            'pane/display/last_export_path') or Path.home()
+        pfile = datetime.now().strftime(
+            'rM Recording %Y-%m-%d %H_%M_%S.png')
+        filename = QFileDialog.getSaveFileName(
+            self.window,
+            'Save Recording',
+            Path(Path(default_savepath) / pfile).__str__(),
+            'Animated PNG (*.png *.PNG *.apng)')
+        if not filename[0]:
+            return False
+        speed = float(QSettings().value('pane/display/record_speed') or 1)
+        self.recorder = ApngRecorder(
+            Path(filename[0]), self.model.display,
+            rotation=self.orientation, speed=speed)
+        if not self.mirror:
+            self.mirror_for_recorder = True
+            self.window.mirror_pushButton.setChecked(True)
+        if not self.mirror:
+            self.recorder = None
+            return False
+        self.mirror.add_sink(self.recorder.add_frame)
+        log.info('recording screen to', filename[0])
+        return True
+
+    def stop_recording(self):
+        if not self.recorder:
+            return
+        recorder = self.recorder
+        self.recorder = None
+        if self.mirror:
+            self.mirror.remove_sink(recorder.add_frame)
+        recorder.close()
+        if self.mirror_for_recorder:
+            self.mirror_for_recorder = False
+            if self.mirror:
+                self.window.mirror_pushButton.setChecked(False)
+
+    def update_mirror(self):
+        # Takes the newest frame from the mirror and paints what changed
+        if not self.mirror:
+            return
+        frame, rects = self.mirror.take()
+        if frame:
+            self.paint_mirror_frame(frame, rects)
+
+    def paint_mirror_frame(self, frame, rects):
+        # Paints the changed rects of frame onto the label's pixmap,
+        # turned to the current orientation. rects of None repaints
+        # all of it.
+        if not frame:
+            return
+        label = self.window.testlabel
+        image = QImage(frame.data, frame.width, frame.height,
+                       frame.bytes_per_line, frame.pixformat)
+        transform = self.model.display.get_transform(self.orientation)
+        size = transform.mapRect(QRect(0, 0, frame.width, frame.height))
+        size = (size.width(), size.height())
+        pixmap = getattr(label, 'pixmap_copy', None)
+        if rects is None or not pixmap \
+           or (pixmap.width(), pixmap.height()) != size:
+            pixmap = QPixmap.fromImage(image.transformed(transform))
+        else:
+            painter = QPainter(pixmap)
+            painter.setTransform(transform)
+            for x, y, w, h in rects:
+                painter.drawImage(QPoint(x, y), image, QRect(x, y, w, h))
+            painter.end()
+        label.image_copy = None
+        label.pixmap_copy = pixmap
+        label.pixmap_size = size
+        load_label_pixmap(self.window.screen_widget, label)
+
     def evaluate_cli(self, args):
         outfile = None
         if args.screenshot_0:
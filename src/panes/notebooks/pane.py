@@ -701,6 +701,7 @@ class NotebooksPane(UIController):
             QLineEdit.Normal, prename)
         if ok:
             self.model.collections.add(c)
+            self.model.invalidate_index()
             c.rename(text)
             self.model.restart_xochitl()
             # return collection.rename(text)
@@ -747,95 +748,98 @@ class NotebookController:
             self.treewidget.rename_selected_item()
             
     def load_all_items(self):
+        # Reconcile the tree with the model in a few passes over UUID-
+        # keyed lookups. Only items that were added, removed, or moved
+        # are detached/attached in the tree.
+        index = self.model.get_index()
+
         # If there are any treewidget items that don't exist in the new
         # collections or documents, remove them.
         to_remove = set()
         
         for item in self.allitems:
             data = item.userData()
-            og_parent = item.og_parent
-            exists = False
-            parent_changed = False
+            current = None
             if type(item) is CollectionTreeWidgetItem:
-                for c in self.model.collections:
-                    if c.uuid == data.uuid:
-                        exists = True
-                        if c.parent != og_parent:
-                            parent_changed = True
-                        break
+                current = index['collections'].get(data.uuid)
             elif type(item) is DocumentTreeWidgetItem:
-                for d in self.model.documents:
-                    if d.uuid == data.uuid:
-                        exists = True
-                        if d.parent != og_parent:
-                            parent_changed = True
-                        break
+                current = index['documents'].get(data.uuid)
+            exists = current is not None
             if not exists:
                 # item will remove self from treewidget
                 item.remove()
                 # blacklist to not spawn again
                 to_remove.add(item)
-            if parent_changed:
-                if 'trash' == og_parent:
-                    # Can't remove from anywhere, do nothing. This might
-                    # change if I implement a Trash collection.
-                    pass
-                else:
-                    item.remove()
+            # Items that moved are put in their new place below, along
+            # with their children.
             # Reload treewidgetitem view contents
             item.update_from_data()
 
+        # remove blacklisted
+        for item in to_remove:
+            self.allitems.remove(item)
+
+        shown = set(id(item.userData()) for item in self.allitems)
         for collection in self.model.collections:
-            exists = False
-            for item in self.allitems:
-                if item.userData() is collection:
-                    exists = True
-                    break
-            if not exists:
+            if id(collection) not in shown:
                 citem = CollectionTreeWidgetItem(self)
                 citem.setUserData(collection)
                 self.allitems.add(citem)
 
         for document in self.model.documents:
-            exists = False
-            for item in self.allitems:
-                if item.userData() is document:
-                    exists = True
-                    break
-            if not exists:
+            if id(document) not in shown:
                 ditem = DocumentTreeWidgetItem(self)
                 ditem.setUserData(document)
                 self.allitems.add(ditem)
 
-        # remove blacklisted
-        for item in to_remove:
-            self.allitems.remove(item)
-            
         # make heirarchy
+        items_by_uuid = {}
         for item in self.allitems:
-            if not item.userData().parent:
-                self.treewidget.addTopLevelItem(item)
-                continue
-            # skip trash items
-            if 'trash' == item.userData().parent:
+            # A collection wins if a document claims the same UUID
+            if type(item) is CollectionTreeWidgetItem \
+               or item.userData().uuid not in items_by_uuid:
+                items_by_uuid[item.userData().uuid] = item
+        def detach(item):
+            # Takes item (with its children) out of wherever it is
+            if item.parent() is not None:
+                item.parent().removeChild(item)
+            elif item.treeWidget() is not None:
+                i = item.treeWidget().indexOfTopLevelItem(item)
+                item.treeWidget().takeTopLevelItem(i)
+
+        for item in self.allitems:
+            parent_uuid = item.userData().parent
+            # trash items aren't shown
+            if 'trash' == parent_uuid:
+                detach(item)
                 continue
-            # put into parent item
-            noparent = True
-            for i2 in self.allitems:
-                if i2.userData().uuid == item.userData().parent \
-                   and type(i2) is CollectionTreeWidgetItem:
-                    i2.addChild(item)
-                    noparent = False
-                    break
-                elif i2.userData().uuid == item.userData().parent:
+            # Find where the item belongs: in its parent collection, or
+            # at the top level (None).
+            i2 = None
+            if parent_uuid:
+                i2 = items_by_uuid.get(parent_uuid)
+                if i2 and type(i2) is not CollectionTreeWidgetItem:
                     log.error('cannot add child to non-collection type')
-                    log.error('problem doc: {}'.format(item.userData().uuid))
-                    break
-            # there is a parent on-file, but that collection doesn't
-            # exist. rM devices show this in the root collection.
-            if noparent:
+                    log.error('problem doc: {}'.format(
+                        item.userData().uuid))
+                    i2 = None
+                # If there is a parent on-file, but that collection
+                # doesn't exist, rM devices show this in the root
+                # collection.
+            # Items that are already in the right place stay there. A
+            # parent that was removed leaves its children attached to
+            # it, so they are moved too.
+            if i2 is None:
+                if item.parent() is None \
+                   and item.treeWidget() is not None:
+                    continue
+                detach(item)
                 self.treewidget.addTopLevelItem(item)
-                continue
+            else:
+                if item.parent() is i2:
+                    continue
+                detach(item)
+                i2.addChild(item)
         # Re-sort
         self.treewidget.sortItems(*self.treewidget.sort_direction)
 
@@ -1711,8 +1715,9 @@ class CollectionTreeWidgetItem(QTreeWidgetItem):
         # If the item was in the trash, then it may not be displayed (so
         # try/catch).
         try:
-            for i in range(0, self.childCount()):
-                item = self.child(i)
+            # Children detach themselves, so go over a copy
+            children = [self.child(i) for i in range(0, self.childCount())]
+            for item in children:
                 item.remove()
             if self.parent():
                 self.parent().removeChild(self)
@@ -1858,6 +1863,7 @@ class CollectionTreeWidgetItem(QTreeWidgetItem):
             QLineEdit.Normal, loadname)
         if ok:
             self.controller.model.collections.add(collection)
+            self.controller.model.invalidate_index()
             return collection.rename(text)
         return False
 